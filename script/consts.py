@@ -2,10 +2,37 @@
 HOST = '0.0.0.0:80'  # 生产环境监听所有IP地址的80端口
 TOKEN = 'xiexingyuan'  # 微信公众平台配置的Token
 
+# 存储后端配置
+STORAGE_BACKEND = 'json'  # 'json': JSON文件存储；'sqlite': SQLite数据库（WAL模式）
+# 用户/会话/通知数据按openid哈希分片的数量，修改后需运行 manage.py migrate-shards
+USER_DATA_SHARD_COUNT = 256
+# 统计计数写入磁盘的间隔（秒），进程异常退出时最多丢失这段时间内的统计
+STATISTICS_FLUSH_INTERVAL = 10
+# JSON后端延迟写入：请求只修改内存，由后台线程每隔一段时间（秒）合并写入磁盘
+# 仅适用于单进程部署；进程被强制杀死时最多丢失一个写入间隔内的修改
+STORAGE_WRITE_BEHIND = False
+STORAGE_WRITE_BEHIND_INTERVAL = 1
+# 写入确认前是否同步到磁盘（fsync）；关闭后写入延迟更低，但断电时可能丢失最近已确认的写入
+STORAGE_FSYNC = True
+# JSON编解码器：'auto' 自动选择已安装的最快实现（orjson > msgspec > 标准库json），也可指定 'orjson'/'msgspec'/'json'
+STORAGE_JSON_CODEC = 'auto'
+# JSON快照文件是否缩进格式化（调试时便于直接查看），生产环境使用紧凑格式
+STORAGE_JSON_PRETTY = False
+# 统计时间序列各粒度保留的桶数：最近30天的每小时、最近一年的每天、最近5年的每月
+STATISTICS_RETENTION = {'hour': 24 * 30, 'day': 365, 'month': 60}
+# 用户消息冷归档：每个用户最近的消息之外的旧消息按月份写入 data/user_messages_archive/ 下的 gzip 分段
+# 关闭后超出保留数量的旧消息直接丢弃
+MESSAGE_ARCHIVE_ENABLED = True
+
 # 暗号验证配置
 SECRET_CODE = '源源爱娇娇'  # 暗号，用户发送此内容即可通过验证
 SECRET_CODE_TIMEOUT = 300  # 暗号输入超时时间（秒），5分钟
 
+# 菜谱列表分页配置
+RECIPE_PAGE_SIZE = 20  # 每页显示的菜谱数
+WECHAT_TEXT_MAX_BYTES = 2048  # 微信被动回复文本消息的最大长度（UTF-8字节数）
+RECIPE_SEARCH_LIMIT = 10  # 搜索菜谱最多返回的结果数
+
 # 暗号验证提示消息
 SECRET_CODE_PROMPT = """🔐 身份验证
 
@@ -91,10 +118,12 @@ class Commands:
     # 菜谱功能关键词
     RECIPE_MENU = '菜谱'
     RECIPE_VIEW_LIST = '查看菜谱'
+    RECIPE_VIEW_LIST_PREFIX = '查看菜谱 '  # 菜谱列表翻页前缀，如 "查看菜谱 2"
     RECIPE_ADD = '记录菜谱'
     RECIPE_ADD_PREFIX = '记录菜谱 '  # 快捷记录菜谱前缀，如 "记录菜谱 红烧肉"
     RECIPE_RANDOM = '随机菜谱'
     RECIPE_DETAIL_PREFIX = '菜谱 '  # 菜谱详情前缀，如 "菜谱 1"
+    RECIPE_SEARCH_PREFIX = '搜菜谱 '  # 搜索菜谱前缀，如 "搜菜谱 红烧"
 
     # VIP信息查询关键词
     VIP_INFO_KEYWORD = '我的vip'
@@ -160,6 +189,17 @@ class SessionState:
     WAITING_RECIPE_CATEGORY = 'waiting_recipe_category'  # 等待选择菜谱分类
 
 
+# 各会话状态的有效期（秒），超过后会话失效并由后台线程清理
+SESSION_TTL = {
+    # 暗号本身5分钟内有效，会话多保留一段时间，以便提示用户“验证已过期”
+    SessionState.WAITING_VERIFY: 3600,
+    SessionState.WAITING_RECIPE: 1800,
+    SessionState.WAITING_RECIPE_CATEGORY: 1800,
+}
+SESSION_DEFAULT_TTL = 1800  # 未在上面配置的会话状态的有效期（秒）
+SESSION_SWEEP_INTERVAL = 60  # 过期会话清理间隔（秒）
+
+
 # ------------------------ 菜谱功能相关消息 ------------------------ #
 # 一级帮助菜单
 HELP_MESSAGE = """📖 功能列表
@@ -176,6 +216,7 @@ RECIPE_MENU_MESSAGE = """🍳 菜谱功能
 1️⃣ 发送「查看菜谱」- 查看菜谱列表
 2️⃣ 发送「记录菜谱」- 记录新菜谱（VIP专属）
 3️⃣ 发送「随机菜谱」- 随便吃点啥
+4️⃣ 发送「搜菜谱 关键词」- 搜索菜谱
 
 💡 发送「帮助」返回上级菜单"""
 
@@ -217,9 +258,29 @@ RECIPE_LIST_TEMPLATE = """📖 菜谱列表
 
 {recipe_list}
 
-共 {total} 个菜谱
+第 {page}/{total_pages} 页，共 {total} 个菜谱
+发送「菜谱 序号」查看详情
+发送「查看菜谱 页码」翻页"""
+
+# 搜索菜谱结果模板
+RECIPE_SEARCH_TEMPLATE = """🔍 搜索「{keyword}」
+
+{recipe_list}
+
+找到 {count} 个相关菜谱
 发送「菜谱 序号」查看详情"""
 
+# 搜索菜谱 - 没有结果
+RECIPE_SEARCH_EMPTY = """🔍 搜索「{keyword}」
+
+没有找到相关的菜谱~
+换个关键词试试，或发送「查看菜谱」浏览全部菜谱"""
+
+# 菜谱列表页码无效
+RECIPE_PAGE_INVALID = """❌ 页码无效
+
+菜谱列表共 {total_pages} 页，请发送「查看菜谱 页码」翻页~"""
+
 # 菜谱详情模板
 RECIPE_DETAIL_TEMPLATE = """🍳 {recipe_name}
 
@@ -257,6 +318,9 @@ NEW_RECIPE_NOTIFICATION = """
 # 菜谱记录失败
 RECIPE_ADD_FAILED = """❌ 菜谱记录失败，请稍后重试~"""
 
+# 数据保存失败（本次请求的修改都未生效）
+SAVE_FAILED = """❌ 操作失败，数据未能保存，请稍后重试~"""
+
 # 菜谱分类选择提示
 RECIPE_CATEGORY_PROMPT = """📝 已收到菜谱：{recipe_name}
 
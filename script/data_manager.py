@@ -1,21 +1,186 @@
 # -*- coding: utf-8 -*-
 # 数据持久化管理模块
 
+import atexit
+import copy
 import json
+import mmap
 import os
-from typing import Any, Dict, Optional
-from threading import Lock
+import time
+import zlib
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from itertools import chain, islice
+from typing import Any, Dict, Optional, Tuple
+from threading import Event, Lock, Thread, local
+
+import consts
+import timeseries
+from json_codec import JSONCodec, get_codec
+from message_archive import MessageArchive
+from recipe_search import RecipeSearchIndex
+from session_store import SessionStore
+from timeseries import StatisticsTimeSeries, hour_bucket
+from user_index import UserAttributeIndex
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，退化为只在进程内加锁
+    fcntl = None
+
+
+class DataCorruptionError(Exception):
+    """数据文件已损坏、无法解析（不返回默认值，以免随后的写入用空数据覆盖原有数据）"""
+
+
+def _fsync_dir(dir_path: str):
+    """同步目录项到磁盘，保证刚完成的重命名/删除在断电后依然有效"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(dir_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _is_process_alive(pid: int) -> bool:
+    """检查进程是否仍在运行"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+class FileLockRegistry:
+    """跨进程文件锁 - 每个文档对应 .locks 目录下的一个锁文件，使用 flock 加锁"""
+
+    def __init__(self, lock_dir: str):
+        self.lock_dir = lock_dir
+        # 锁文件名 -> 打开的文件描述符（长期持有，避免每次加锁都打开文件）
+        self._fds: Dict[str, int] = {}
+        # 当前进程以独占方式持有的锁，用于避免对同一描述符重复加共享锁导致降级
+        self._exclusive_held = set()
+        self._lock = Lock()
+
+    def _get_fd(self, name: str) -> int:
+        fd = self._fds.get(name)
+        if fd is None:
+            with self._lock:
+                fd = self._fds.get(name)
+                if fd is None:
+                    os.makedirs(self.lock_dir, exist_ok=True)
+                    lock_file = name.replace('/', '__').replace(os.sep, '__') + '.lock'
+                    lock_path = os.path.join(self.lock_dir, lock_file)
+                    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                    self._fds[name] = fd
+        return fd
+
+    @contextmanager
+    def exclusive(self, name: str):
+        """
+        获取独占锁（写操作使用）
+
+        调用方需已持有同名的进程内线程锁，保证同一进程内不会有两个线程同时操作同一描述符
+        """
+        if fcntl is None or name in self._exclusive_held:
+            # 已持有独占锁时可重入
+            yield
+            return
+        fd = self._get_fd(name)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self._exclusive_held.add(name)
+        try:
+            yield
+        finally:
+            self._exclusive_held.discard(name)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def shared(self, name: str):
+        """获取共享锁（从磁盘加载时使用）；已持有独占锁时直接复用"""
+        if fcntl is None or name in self._exclusive_held:
+            yield
+            return
+        fd = self._get_fd(name)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class _LazyDocument:
+    """
+    按偏移索引读取的大文档：快照通过内存映射访问，只解码被读取记录的片段
+
+    变更日志中快照之后的修改预先解析为覆盖层，读取时优先于快照
+    """
+
+    # 覆盖层中表示记录已被删除的标记
+    DELETED = object()
+
+    def __init__(self, signature, offsets: Dict[str, list], overlay: Dict, snapshot: mmap.mmap):
+        self.signature = signature
+        self.offsets = offsets
+        self.overlay = overlay
+        self.snapshot = snapshot
+
+    def get(self, codec: JSONCodec, key: Any, default_value: Any = None) -> Any:
+        value = self.overlay.get(key, default_value)
+        if value is self.DELETED:
+            return default_value
+        if key in self.overlay:
+            return value
+        position = self.offsets.get(key if isinstance(key, str) else str(key))
+        if position is None:
+            return default_value
+        offset, length = position
+        return codec.decode(self.snapshot[offset : offset + length])
+
+    def close(self):
+        self.snapshot.close()
 
 
 class JSONDataManager:
     """JSON数据持久化管理器"""
 
-    def __init__(self, data_dir: str = 'data'):
+    # load_data 返回缓存的共享对象，只有文档被修改（包括其他进程）后重新解析时才返回新对象
+    caches_documents = True
+
+    # 变更日志至少累积这么多操作才会触发压缩
+    LOG_COMPACT_MIN_OPS = 1000
+
+    # 记录数达到该值的字典文档在写快照时同时生成偏移索引，未缓存时 get() 只解码单条记录
+    LAZY_INDEX_MIN_KEYS = 1000
+
+    # 延迟写入队列中表示“需要重写整个快照”的标记
+    SNAPSHOT = None
+
+    def __init__(
+        self,
+        data_dir: str = 'data',
+        write_behind: bool = False,
+        flush_interval: float = 1,
+        codec: Optional[JSONCodec] = None,
+        pretty: bool = False,
+        fsync: bool = True,
+    ):
         """
         初始化数据管理器
 
         Args:
             data_dir: 数据存储目录，默认为项目根目录下的data文件夹
+            write_behind: 是否启用延迟写入（只修改内存并标记脏文档，由后台线程合并写入磁盘）
+            flush_interval: 延迟写入模式下后台线程的写入间隔（秒）
+            codec: JSON编解码器，默认自动选择已安装的最快实现
+            pretty: 快照文件是否缩进格式化（变更日志始终为紧凑的单行格式）
+            fsync: 每次写入是否同步到磁盘（快照替换、变更日志追加后返回前落盘）
         """
         # 获取项目根目录
         self.project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -24,8 +189,60 @@ class JSONDataManager:
         # 确保数据目录存在
         self._ensure_data_dir()
 
-        # 线程锁，确保文件操作的线程安全
+        self.codec = codec or get_codec()
+        self.pretty = pretty
+        self.fsync = fsync
+
+        # 每个文件一把锁（锁分段），不同文件的读写互不阻塞
+        self._file_locks: Dict[str, Lock] = {}
+        # 保护 _file_locks 本身的锁，只在首次为某个文件创建锁时短暂持有
         self._lock = Lock()
+        # 跨进程锁，允许多个工作进程共用同一数据目录
+        self._process_locks = FileLockRegistry(os.path.join(self.data_dir, '.locks'))
+
+        # 已解析文档的内存缓存: filename -> (文件签名, 数据)
+        # 写入时直接更新缓存；读取时仅在文件 mtime/size 变化后才重新解析
+        self._cache: Dict[str, Tuple[Tuple[Any, Any], Any]] = {}
+        # 未完整加载、按偏移索引读取的大文档: filename -> _LazyDocument
+        self._lazy: Dict[str, _LazyDocument] = {}
+
+        # 每个文档变更日志中尚未压缩的操作数
+        self._log_ops: Dict[str, int] = {}
+        # 每个文档变更日志中完整记录的字节数；之后的内容是崩溃时写了一半的行，追加前截掉
+        self._log_sizes: Dict[str, int] = {}
+
+        # 已确认存在的子目录
+        self._ensured_dirs = set()
+
+        # 延迟写入: filename -> 待追加的日志条目列表，或 SNAPSHOT 表示需要重写快照
+        # 同一文档在一个写入周期内的多次修改合并为一次写入
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self._dirty: Dict[str, Optional[list]] = {}
+        self._writer_thread = None
+        self._writer_lock = Lock()
+
+        # 批量提交的重做记录目录，启动时补写上次崩溃时未完成的提交
+        self._transactions_dir = os.path.join(self.data_dir, '.transactions')
+        self._recover_transactions()
+
+    def _get_lock(self, filename: str) -> Lock:
+        """获取文件对应的锁（首次访问时创建）"""
+        if filename.endswith('.json'):
+            filename = filename[:-5]
+        lock = self._file_locks.get(filename)
+        if lock is None:
+            with self._lock:
+                lock = self._file_locks.setdefault(filename, Lock())
+        return lock
+
+    @contextmanager
+    def _write_lock(self, filename: str):
+        """写操作加锁：进程内线程锁 + 跨进程独占文件锁"""
+        name = filename[:-5] if filename.endswith('.json') else filename
+        with self._get_lock(name):
+            with self._process_locks.exclusive(name):
+                yield
 
     def _ensure_data_dir(self):
         """确保数据目录存在"""
@@ -34,53 +251,663 @@ class JSONDataManager:
             print(f'创建数据目录: {self.data_dir}')
 
     def _get_file_path(self, filename: str) -> str:
-        """获取完整的文件路径"""
+        """获取完整的文件路径（文件名可以包含子目录，如分片文档 users/3f）"""
         if not filename.endswith('.json'):
             filename += '.json'
         return os.path.join(self.data_dir, filename)
 
-    def _save_data_internal(self, filename: str, data: Any, indent: int = 2) -> bool:
+    def _ensure_parent_dir(self, file_path: str):
+        """确保文件所在目录存在（分片文档位于子目录中）"""
+        parent_dir = os.path.dirname(file_path)
+        if parent_dir != self.data_dir and parent_dir not in self._ensured_dirs:
+            os.makedirs(parent_dir, exist_ok=True)
+            self._ensured_dirs.add(parent_dir)
+
+    def _get_log_path(self, filename: str) -> str:
+        """获取记录级变更日志（JSONL）的完整路径"""
+        if filename.endswith('.json'):
+            filename = filename[:-5]
+        return os.path.join(self.data_dir, filename + '.log')
+
+    def _get_index_path(self, filename: str) -> str:
+        """获取快照偏移索引的完整路径"""
+        if filename.endswith('.json'):
+            filename = filename[:-5]
+        return os.path.join(self.data_dir, filename + '.idx')
+
+    @staticmethod
+    def _get_file_signature(file_path: str) -> Optional[Tuple[int, int, int]]:
+        """获取文件签名（inode, mtime, size），文件不存在时返回None"""
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _get_document_signature(self, filename: str) -> Tuple[Any, Any]:
+        """获取文档签名：快照文件与变更日志的签名组合"""
+        return (
+            self._get_file_signature(self._get_file_path(filename)),
+            self._get_file_signature(self._get_log_path(filename)),
+        )
+
+    def _encode_indexed(self, data: Dict) -> Tuple[bytes, Dict[str, list]]:
+        """
+        逐条编码字典文档，同时记录每条记录的值在快照中的位置
+
+        Returns:
+            Tuple: (紧凑格式的快照内容, {记录键: [偏移, 长度]})
+        """
+        parts = []
+        offsets = {}
+        position = 0
+        for key, value in data.items():
+            key = key if isinstance(key, str) else str(key)
+            prefix = (b',' if parts else b'{') + self.codec.encode(key) + b':'
+            encoded = self.codec.encode(value)
+            offsets[key] = [position + len(prefix), len(encoded)]
+            parts.append(prefix)
+            parts.append(encoded)
+            position += len(prefix) + len(encoded)
+        parts.append(b'}')
+        return b''.join(parts), offsets
+
+    def _save_data_internal(self, filename: str, data: Any, pretty: bool = None) -> bool:
         """内部保存方法，不加锁"""
         try:
             file_path = self._get_file_path(filename)
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=indent)
+            pretty = self.pretty if pretty is None else pretty
+            offsets = None
+            if not pretty and isinstance(data, dict) and len(data) >= self.LAZY_INDEX_MIN_KEYS:
+                encoded, offsets = self._encode_indexed(data)
+            else:
+                encoded = self.codec.encode(data, pretty)
+            # 先写临时文件（同步到磁盘）再替换，崩溃时旧快照保持完整；
+            # 其他进程通过 inode 变化即可发现快照已更新
+            tmp_path = file_path + '.tmp'
+            self._ensure_parent_dir(tmp_path)
+            with open(tmp_path, 'wb') as f:
+                f.write(encoded)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, file_path)
+            # 完整快照已包含所有记录级变更，日志可以丢弃；
+            # 快照替换落盘后才删除日志，删除也要落盘，避免旧日志在断电后重新出现并被重放
+            log_path = self._get_log_path(filename)
+            if os.path.exists(log_path):
+                os.remove(log_path)
+            if self.fsync:
+                _fsync_dir(os.path.dirname(file_path))
+            self._log_ops[filename] = 0
+            self._log_sizes[filename] = 0
+            self._write_index_internal(filename, offsets)
+            # 写穿缓存：记录写入后的文件签名，后续读取无需重新解析
+            self._cache[filename] = (self._get_document_signature(filename), data)
             print(f'数据已保存到: {file_path}')
             return True
         except Exception as e:
+            # 写入失败时缓存可能与磁盘不一致，直接丢弃
+            self._cache.pop(filename, None)
             print(f'保存数据失败 {filename}: {str(e)}')
             return False
 
+    def _write_index_internal(self, filename: str, offsets: Optional[Dict[str, list]]):
+        """
+        写入（或删除过期的）快照偏移索引，需持有写锁
+
+        索引记录对应快照的文件签名，快照被替换后旧索引自动失效；索引可以随时从快照重建，
+        写入失败只影响读取速度，因此不同步到磁盘
+        """
+        index_path = self._get_index_path(filename)
+        try:
+            if offsets is None:
+                if os.path.exists(index_path):
+                    os.remove(index_path)
+                return
+            snapshot = self._get_file_signature(self._get_file_path(filename))
+            tmp_path = index_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.codec.encode({'snapshot': snapshot, 'offsets': offsets}))
+            os.replace(tmp_path, index_path)
+        except Exception as e:
+            print(f'写入快照索引失败 {filename}: {str(e)}')
+
+    def _replay_log_internal(self, filename: str, data: Dict, deleted: Any = None) -> int:
+        """
+        将变更日志重放到快照数据上，返回重放的操作数
+
+        最后一行不完整（写入中途崩溃，该写入未被确认）时忽略；其他位置的行无法解析说明日志已损坏
+
+        Args:
+            filename: 文件名
+            data: 快照数据
+            deleted: 不为None时删除操作记为 data[键] = deleted（构建覆盖层时使用），否则直接移除
+
+        Raises:
+            DataCorruptionError: 日志中间的记录无法解析
+        """
+        log_path = self._get_log_path(filename)
+        if not os.path.exists(log_path):
+            self._log_sizes[filename] = 0
+            return 0
+
+        op_count = 0
+        valid_size = 0
+        with open(log_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    print(f'忽略变更日志末尾不完整的记录 {log_path}: {line[:50]}')
+                    break
+                valid_size += len(line)
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = self.codec.decode(line)
+                except ValueError as e:
+                    raise DataCorruptionError(f'变更日志已损坏 {log_path}: {str(e)}') from e
+
+                if entry.get('op') == 'put':
+                    data[entry['k']] = entry['v']
+                elif entry.get('op') == 'del':
+                    if deleted is None:
+                        data.pop(entry['k'], None)
+                    else:
+                        data[entry['k']] = deleted
+                op_count += 1
+        self._log_sizes[filename] = valid_size
+        return op_count
+
     def _load_data_internal(self, filename: str, default_value: Any = None) -> Any:
         """内部加载方法，不加锁"""
         try:
             file_path = self._get_file_path(filename)
-            if not os.path.exists(file_path):
-                print(f'文件不存在: {file_path}，返回默认值')
-                return default_value
-
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            signature = self._get_document_signature(filename)
+
+            # 文件未被修改（包括其他进程）时直接返回缓存；尚未写入磁盘的脏文档以缓存为准
+            cached = self._cache.get(filename)
+            if cached is not None and (cached[0] == signature or filename in self._dirty):
+                return cached[1]
+
+            # 加共享锁读取，避免读到其他进程写了一半的快照或压缩中途的日志
+            name = filename[:-5] if filename.endswith('.json') else filename
+            with self._process_locks.shared(name):
+                signature = self._get_document_signature(filename)
+                if signature == (None, None):
+                    self._cache.pop(filename, None)
+                    print(f'文件不存在: {file_path}，返回默认值')
+                    return default_value
+
+                if signature[0] is not None:
+                    with open(file_path, 'rb') as f:
+                        try:
+                            data = self.codec.decode(f.read())
+                        except ValueError as e:
+                            raise DataCorruptionError(
+                                f'快照文件已损坏 {file_path}: {str(e)}'
+                            ) from e
+                else:
+                    data = {}
+                self._log_ops[filename] = self._replay_log_internal(filename, data)
+            self._cache[filename] = (signature, data)
+            self._drop_lazy_internal(filename)
             print(f'数据已从 {file_path} 加载')
             return data
         except Exception as e:
+            # 文件存在却读不出来时不能当作空文档返回默认值，否则随后的写入会覆盖原有数据
+            self._cache.pop(filename, None)
             print(f'加载数据失败 {filename}: {str(e)}')
-            return default_value
+            if isinstance(e, DataCorruptionError):
+                raise
+            raise DataCorruptionError(f'加载数据失败 {filename}: {str(e)}') from e
+
+    def _load_lazy_internal(self, filename: str) -> Optional[_LazyDocument]:
+        """
+        不完整加载文档，改为通过偏移索引读取单条记录，不加锁
+
+        Returns:
+            Optional[_LazyDocument]: 快照没有对应的有效索引时返回None（调用方回退到完整加载）
+        """
+        signature = self._get_document_signature(filename)
+        lazy = self._lazy.get(filename)
+        if lazy is not None and lazy.signature == signature:
+            return lazy
+        self._drop_lazy_internal(filename)
+        if signature[0] is None:
+            return None
 
-    def save_data(self, filename: str, data: Any, indent: int = 2) -> bool:
+        name = filename[:-5] if filename.endswith('.json') else filename
+        with self._process_locks.shared(name):
+            signature = self._get_document_signature(filename)
+            if signature[0] is None:
+                return None
+            try:
+                with open(self._get_index_path(filename), 'rb') as f:
+                    index = self.codec.decode(f.read())
+            except (OSError, ValueError):
+                return None
+            if index.get('snapshot') != list(signature[0]):
+                return None
+            with open(self._get_file_path(filename), 'rb') as f:
+                snapshot = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            overlay = {}
+            try:
+                self._replay_log_internal(filename, overlay, _LazyDocument.DELETED)
+            except Exception:
+                snapshot.close()
+                raise
+        lazy = _LazyDocument(signature, index['offsets'], overlay, snapshot)
+        self._lazy[filename] = lazy
+        return lazy
+
+    def _drop_lazy_internal(self, filename: str):
+        """释放按偏移索引读取的文档（完整加载或文档被删除后不再需要）"""
+        lazy = self._lazy.pop(filename, None)
+        if lazy is not None:
+            lazy.close()
+
+    def _append_log_internal(self, filename: str, data: Dict, entry: Dict) -> bool:
+        """
+        追加一条记录级变更到日志，不加锁
+
+        调用前 data 已经应用了该变更；日志过长时自动压缩为新的快照
+        """
+        if self.write_behind:
+            self._mark_dirty_internal(filename, data, entry)
+            return True
+        if not self._append_log_entries_internal(filename, data, [entry]):
+            self._cache.pop(filename, None)
+            return False
+        return True
+
+    def _commit_data_internal(self, filename: str, data: Any, pretty: bool = None) -> bool:
+        """保存整个文档，不加锁；延迟写入模式下只更新缓存并标记为脏"""
+        if self.write_behind:
+            self._mark_dirty_internal(filename, data, self.SNAPSHOT)
+            return True
+        return self._save_data_internal(filename, data, pretty)
+
+    def _mark_dirty_internal(self, filename: str, data: Any, entry: Optional[Dict]):
+        """
+        记录一次尚未写入磁盘的修改，需持有写锁
+
+        Args:
+            filename: 文件名
+            data: 修改后的完整数据
+            entry: 记录级变更日志条目；为 SNAPSHOT 时表示需要重写整个快照
+        """
+        self._cache[filename] = (self._get_document_signature(filename), data)
+        pending = self._dirty.get(filename, [])
+        if entry is self.SNAPSHOT or pending is self.SNAPSHOT:
+            # 快照会包含之前所有的记录级修改，不必再追加日志
+            self._dirty[filename] = self.SNAPSHOT
+        else:
+            pending.append(entry)
+            self._dirty[filename] = pending
+        if self._writer_thread is None:
+            self._start_writer_thread()
+
+    def _start_writer_thread(self):
+        """启动后台写入线程（首次产生脏文档时启动）"""
+        with self._writer_lock:
+            if self._writer_thread is not None:
+                return
+            self._writer_thread = Thread(target=self._writer_loop, name='data-writer', daemon=True)
+            self._writer_thread.start()
+            # 正常退出（包括 SIGTERM 转换的 sys.exit）时写入剩余的脏文档
+            atexit.register(self.flush)
+
+    def _writer_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                # 写入线程不能退出，否则之后的修改都只停留在内存中
+                print(f'延迟写入失败: {str(e)}')
+
+    def _write_dirty_internal(self, filename: str) -> bool:
+        """将一个脏文档写入磁盘，需持有写锁；失败时保留脏标记，下个周期重试"""
+        if filename not in self._dirty:
+            return True
+        pending = self._dirty.pop(filename)
+        data = self._cache[filename][1]
+        if pending is self.SNAPSHOT:
+            success = self._save_data_internal(filename, data)
+        else:
+            success = self._append_log_entries_internal(filename, data, pending)
+        if not success:
+            self._cache[filename] = (None, data)
+            # 失败期间可能又有新的修改被标记，两者任一需要重写快照时整体重写快照
+            previous = self._dirty.get(filename, [])
+            if pending is self.SNAPSHOT or previous is self.SNAPSHOT:
+                self._dirty[filename] = self.SNAPSHOT
+            else:
+                self._dirty[filename] = pending + previous
+        return success
+
+    def _append_log_entries_internal(self, filename: str, data: Dict, entries: list) -> bool:
+        """
+        一次性追加多条记录级变更到日志（同步到磁盘后才返回），需持有写锁
+
+        日志过长时自动压缩为新的快照
+        """
+        try:
+            lines = b''.join(self.codec.encode(entry) + b'\n' for entry in entries)
+            log_path = self._get_log_path(filename)
+            self._ensure_parent_dir(log_path)
+            with open(log_path, 'ab') as f:
+                # 截掉崩溃时写了一半的末行，新记录从完整的行之后开始
+                valid_size = self._log_sizes.get(filename)
+                if valid_size is not None and os.fstat(f.fileno()).st_size > valid_size:
+                    f.truncate(valid_size)
+                f.write(lines)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+                self._log_sizes[filename] = os.fstat(f.fileno()).st_size
+            self._cache[filename] = (self._get_document_signature(filename), data)
+            self._log_ops[filename] = self._log_ops.get(filename, 0) + len(entries)
+        except Exception as e:
+            print(f'写入变更日志失败 {filename}: {str(e)}')
+            return False
+
+        if self._log_ops[filename] > max(self.LOG_COMPACT_MIN_OPS, len(data)):
+            self._save_data_internal(filename, data)
+        return True
+
+    def _prepare_batch_internal(
+        self, filename: str, operations: list
+    ) -> Tuple[Any, Optional[list]]:
+        """
+        在最新数据上依次执行工作单元记录的操作，需持有写锁
+
+        Returns:
+            Tuple: (修改后的数据, 记录级日志条目列表；整文档修改时为 SNAPSHOT)
+        """
+        data = self._load_data_internal(filename, None)
+        entries = []
+        for operation in operations:
+            kind = operation[0]
+            if kind == 'save_data':
+                data, entries = operation[1], self.SNAPSHOT
+                continue
+            if kind == 'update_data':
+                data = operation[1](data if data is not None else operation[2])
+                entries = self.SNAPSHOT
+                continue
+
+            if data is None:
+                data = {}
+            if not isinstance(data, dict):
+                raise TypeError('文档不是字典类型')
+            key = operation[1]
+            if kind == 'update_key':
+                value = operation[2](data.get(key, operation[3]))
+                kind = 'delete' if value is None else 'put'
+            else:
+                value = operation[2] if kind == 'put' else None
+
+            if kind == 'put':
+                data[key] = value
+                entry = {'op': 'put', 'k': key, 'v': value}
+            elif key in data:
+                del data[key]
+                entry = {'op': 'del', 'k': key}
+            else:
+                continue
+            if entries is not self.SNAPSHOT:
+                entries.append(entry)
+        return data, entries
+
+    def _write_transaction_record(self, changes: Dict[str, Dict]) -> str:
+        """写入重做记录（先写临时文件再替换，并同步到磁盘），返回记录路径"""
+        os.makedirs(self._transactions_dir, exist_ok=True)
+        record_path = os.path.join(self._transactions_dir, f'{os.getpid()}-{time.time_ns()}.json')
+        tmp_path = record_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.codec.encode({'pid': os.getpid(), 'documents': changes}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, record_path)
+        return record_path
+
+    def _recover_transactions(self):
+        """
+        补写上次崩溃时未完成的批量提交
+
+        只补写仍保持提交前状态（签名未变）的文档：已写入的文档签名已变化，
+        被其他进程改写过的文档也不会被旧数据覆盖
+        """
+        if not os.path.isdir(self._transactions_dir):
+            return
+        for record_name in sorted(os.listdir(self._transactions_dir)):
+            record_path = os.path.join(self._transactions_dir, record_name)
+            if record_name.endswith('.tmp'):
+                # 重做记录没写完，说明提交尚未开始写入任何文档
+                os.remove(record_path)
+                continue
+            try:
+                with open(record_path, 'rb') as f:
+                    record = self.codec.decode(f.read())
+            except (OSError, ValueError) as e:
+                print(f'读取重做记录失败 {record_path}: {str(e)}')
+                continue
+            if record['pid'] != os.getpid() and _is_process_alive(record['pid']):
+                # 提交进程仍在运行，由它自己完成
+                continue
+
+            for filename, change in record['documents'].items():
+                with self._write_lock(filename):
+                    signature = json.loads(json.dumps(self._get_document_signature(filename)))
+                    if signature != change['signature']:
+                        continue
+                    if 'snapshot' in change:
+                        self._save_data_internal(filename, change['snapshot'])
+                    else:
+                        data = self._load_data_internal(filename, {})
+                        for entry in change['entries']:
+                            if entry['op'] == 'put':
+                                data[entry['k']] = entry['v']
+                            else:
+                                data.pop(entry['k'], None)
+                        self._append_log_entries_internal(filename, data, change['entries'])
+                    print(f'已补写未完成的批量提交: {filename}')
+            os.remove(record_path)
+
+    def commit_batch(self, operations: Dict[str, list]) -> bool:
+        """
+        原子地提交一个工作单元收集的所有操作，每个文档只写入一次
+
+        按文档名顺序加锁（避免死锁），在最新数据上重新执行操作；涉及多个文档时先写入
+        重做记录，进程在写入中途崩溃后，下次启动会补写剩余的文档；某个文档写入失败时立即
+        以完整快照重写，仍然失败则保留重做记录供下次启动补写。启用延迟写入时只标记
+        脏文档，由 flush 把它们放在同一次写入中（同样带重做记录）
+
+        Args:
+            operations: 文档名 -> 操作列表，操作为 (方法名, 参数...) 元组，
+                        方法名为 put/delete/update_key/update_data/save_data
+
+        Returns:
+            bool: 是否提交成功
+        """
+        filenames = sorted(operations)
+        with ExitStack() as stack:
+            for filename in filenames:
+                stack.enter_context(self._write_lock(filename))
+
+            signatures = {}
+            changes = {}
+            try:
+                for filename in filenames:
+                    signatures[filename] = self._get_document_signature(filename)
+                    data, entries = self._prepare_batch_internal(filename, operations[filename])
+                    if entries is self.SNAPSHOT or entries:
+                        changes[filename] = (data, entries)
+            except Exception as e:
+                # 操作可能已原地修改了缓存对象，全部丢弃以便下次从磁盘重新加载
+                for filename in filenames:
+                    self._cache.pop(filename, None)
+                print(f'批量提交失败: {str(e)}')
+                return False
+
+            if self.write_behind:
+                for filename, (data, entries) in changes.items():
+                    for entry in [self.SNAPSHOT] if entries is self.SNAPSHOT else entries:
+                        self._mark_dirty_internal(filename, data, entry)
+                return True
+
+            record_path = None
+            if len(changes) > 1:
+                record = {}
+                for filename, (data, entries) in changes.items():
+                    change = {'signature': signatures[filename]}
+                    if entries is self.SNAPSHOT:
+                        change['snapshot'] = data
+                    else:
+                        change['entries'] = entries
+                    record[filename] = change
+                try:
+                    record_path = self._write_transaction_record(record)
+                except Exception as e:
+                    for filename in filenames:
+                        self._cache.pop(filename, None)
+                    print(f'写入重做记录失败: {str(e)}')
+                    return False
+
+            failed = {}
+            for filename, (data, entries) in changes.items():
+                if entries is self.SNAPSHOT:
+                    written = self._save_data_internal(filename, data)
+                else:
+                    written = self._append_log_entries_internal(filename, data, entries)
+                if not written:
+                    failed[filename] = data
+
+            # 其他文档可能已经写入：立即用完整快照重写失败的文档（可能留下了写了一半的日志），
+            # 不让批量提交停留在部分生效的状态
+            for filename, data in list(failed.items()):
+                if self._save_data_internal(filename, data):
+                    del failed[filename]
+
+            if failed:
+                for filename in failed:
+                    self._cache.pop(filename, None)
+                if record_path is not None:
+                    self._rewrite_transaction_record_internal(record_path, failed)
+                return False
+            if record_path is not None:
+                os.remove(record_path)
+            return True
+
+    def _rewrite_transaction_record_internal(self, record_path: str, failed: Dict[str, Any]):
+        """
+        将仍未写入的文档重新记录为当前签名和完整快照，需持有这些文档的写锁
+
+        写入失败可能已经改变了文件签名（如追加了半行日志），原记录中的签名不再匹配，
+        下次启动时不会补写这些文档
+        """
+        record = {
+            filename: {'signature': self._get_document_signature(filename), 'snapshot': data}
+            for filename, data in failed.items()
+        }
+        try:
+            self._write_transaction_record(record)
+            os.remove(record_path)
+        except Exception as e:
+            print(f'更新重做记录失败: {str(e)}')
+
+    def flush(self) -> bool:
+        """
+        将延迟写入队列中的脏文档全部写入磁盘（未启用延迟写入时无操作）
+
+        所有脏文档一起加锁写入，批量提交标记的多个文档不会被拆到不同周期；
+        涉及多个文档时与 commit_batch 一样先写入重做记录
+
+        Returns:
+            bool: 是否全部写入成功
+        """
+        filenames = set(self._dirty)
+        while filenames:
+            with ExitStack() as stack:
+                for filename in sorted(filenames):
+                    stack.enter_context(self._write_lock(filename))
+                dirty = set(self._dirty)
+                if dirty <= filenames:
+                    return self._write_dirty_batch_internal(sorted(dirty))
+            # 等待加锁期间又有文档被标记，连同这些文档重新按顺序加锁
+            filenames |= dirty
+        return True
+
+    def _write_dirty_batch_internal(self, filenames: list) -> bool:
+        """写入一组脏文档，需持有这些文档的写锁；涉及多个文档时先写入重做记录"""
+        record_path = None
+        if len(filenames) > 1:
+            record = {}
+            for filename in filenames:
+                pending = self._dirty[filename]
+                change = {'signature': self._get_document_signature(filename)}
+                if pending is self.SNAPSHOT:
+                    change['snapshot'] = self._cache[filename][1]
+                else:
+                    change['entries'] = pending
+                record[filename] = change
+            try:
+                record_path = self._write_transaction_record(record)
+            except Exception as e:
+                # 保留脏标记，下个周期重试
+                print(f'写入重做记录失败: {str(e)}')
+                return False
+
+        failed = [filename for filename in filenames if not self._write_dirty_internal(filename)]
+        if record_path is not None:
+            if failed:
+                # 失败的文档保留脏标记，下个周期重试；在此之前崩溃时由重做记录补写
+                self._rewrite_transaction_record_internal(
+                    record_path, {filename: self._cache[filename][1] for filename in failed}
+                )
+            else:
+                os.remove(record_path)
+        return not failed
+
+    def invalidate_cache(self, filename: Optional[str] = None):
+        """
+        使内存缓存失效
+
+        延迟写入中尚未写入磁盘的修改只存在于缓存中，丢弃前先写入；写入失败的文档保留缓存
+
+        Args:
+            filename: 文件名，为None时清空全部缓存
+        """
+        filenames = set(self._cache) | set(self._lazy) if filename is None else {filename}
+        for name in filenames:
+            if name in self._dirty:
+                with self._write_lock(name):
+                    if not self._write_dirty_internal(name):
+                        print(f'未写入的修改保存失败，保留缓存: {name}')
+                        continue
+            with self._get_lock(name):
+                if name in self._dirty:
+                    # 写入后又被修改
+                    continue
+                self._cache.pop(name, None)
+                self._drop_lazy_internal(name)
+
+    def save_data(self, filename: str, data: Any, pretty: bool = None) -> bool:
         """
         保存数据到JSON文件
 
         Args:
             filename: 文件名（不需要包含.json后缀）
             data: 要保存的数据
-            indent: JSON格式化缩进
+            pretty: 是否缩进格式化，为None时使用数据管理器的设置
 
         Returns:
             bool: 保存是否成功
         """
-        with self._lock:
-            return self._save_data_internal(filename, data, indent)
+        with self._write_lock(filename):
+            return self._commit_data_internal(filename, data, pretty)
 
     def load_data(self, filename: str, default_value: Any = None) -> Any:
         """
@@ -92,113 +919,1343 @@ class JSONDataManager:
 
         Returns:
             Any: 加载的数据，文件不存在时返回default_value
+
+        Note:
+            返回的是内存缓存中的共享对象，请勿原地修改；需要修改时请使用 update_data
         """
-        with self._lock:
+        with self._get_lock(filename):
             return self._load_data_internal(filename, default_value)
 
     def update_data(self, filename: str, update_func, default_value: Any = None) -> bool:
         """
-        更新JSON文件中的数据
+        更新JSON文件中的数据
+
+        Args:
+            filename: 文件名
+            update_func: 更新函数，接收当前数据作为参数，返回更新后的数据
+            default_value: 文件不存在时的默认值
+
+        Returns:
+            bool: 更新是否成功
+        """
+        try:
+            with self._write_lock(filename):
+                current_data = self._load_data_internal(filename, default_value)
+                updated_data = update_func(current_data)
+                return self._commit_data_internal(filename, updated_data)
+        except Exception as e:
+            # update_func 可能已原地修改了缓存对象，丢弃缓存以便下次从磁盘重新加载
+            self._cache.pop(filename, None)
+            print(f'更新数据失败 {filename}: {str(e)}')
+            return False
+
+    def get(self, filename: str, key: str, default_value: Any = None) -> Any:
+        """
+        读取文档中的单条记录
+
+        Args:
+            filename: 文件名
+            key: 记录键
+            default_value: 记录不存在时返回的默认值
+
+        Returns:
+            Any: 记录值（缓存中的共享对象，请勿原地修改）
+
+        Note:
+            文档尚未完整加载且快照带有偏移索引（大文档）时，通过内存映射只解码该记录，
+            不把整个文档读入内存
+        """
+        with self._get_lock(filename):
+            cached = self._cache.get(filename)
+            if cached is None or (
+                filename not in self._dirty and cached[0] != self._get_document_signature(filename)
+            ):
+                try:
+                    lazy = self._load_lazy_internal(filename)
+                except DataCorruptionError:
+                    raise
+                except Exception as e:
+                    print(f'按索引读取失败 {filename}: {str(e)}')
+                    lazy = None
+                if lazy is not None:
+                    return lazy.get(self.codec, key, default_value)
+            data = self._load_data_internal(filename, {})
+            return data.get(key, default_value)
+
+    def put(self, filename: str, key: str, value: Any) -> bool:
+        """
+        写入文档中的单条记录
+
+        只向变更日志追加一行，写入成本与单条记录大小相关，而与整个文档大小无关
+
+        Args:
+            filename: 文件名
+            key: 记录键
+            value: 记录值
+
+        Returns:
+            bool: 写入是否成功
+        """
+        with self._write_lock(filename):
+            data = self._load_data_internal(filename, {})
+            if not isinstance(data, dict):
+                print(f'写入记录失败 {filename}: 文档不是字典类型')
+                return False
+            data[key] = value
+            return self._append_log_internal(filename, data, {'op': 'put', 'k': key, 'v': value})
+
+    def delete(self, filename: str, key: str) -> bool:
+        """
+        删除文档中的单条记录
+
+        Args:
+            filename: 文件名
+            key: 记录键
+
+        Returns:
+            bool: 是否成功（记录不存在也视为成功）
+        """
+        with self._write_lock(filename):
+            data = self._load_data_internal(filename, {})
+            if not isinstance(data, dict):
+                print(f'删除记录失败 {filename}: 文档不是字典类型')
+                return False
+            if key not in data:
+                return True
+            del data[key]
+            return self._append_log_internal(filename, data, {'op': 'del', 'k': key})
+
+    def update_key(self, filename: str, key: str, update_func, default_value: Any = None) -> bool:
+        """
+        原子地更新文档中的单条记录
+
+        Args:
+            filename: 文件名
+            key: 记录键
+            update_func: 更新函数，接收当前记录值，返回新的记录值；返回None表示删除该记录
+            default_value: 记录不存在时传给更新函数的默认值
+
+        Returns:
+            bool: 更新是否成功
+        """
+        try:
+            with self._write_lock(filename):
+                data = self._load_data_internal(filename, {})
+                if not isinstance(data, dict):
+                    print(f'更新记录失败 {filename}: 文档不是字典类型')
+                    return False
+                value = update_func(data.get(key, default_value))
+                if value is None:
+                    if key not in data:
+                        return True
+                    del data[key]
+                    return self._append_log_internal(filename, data, {'op': 'del', 'k': key})
+                data[key] = value
+                return self._append_log_internal(
+                    filename, data, {'op': 'put', 'k': key, 'v': value}
+                )
+        except Exception as e:
+            self._cache.pop(filename, None)
+            print(f'更新记录失败 {filename}/{key}: {str(e)}')
+            return False
+
+    def delete_file(self, filename: str) -> bool:
+        """
+        删除JSON文件
+
+        Args:
+            filename: 文件名
+
+        Returns:
+            bool: 删除是否成功
+        """
+        try:
+            with self._write_lock(filename):
+                file_path = self._get_file_path(filename)
+                self._cache.pop(filename, None)
+                self._drop_lazy_internal(filename)
+                self._log_ops.pop(filename, None)
+                self._log_sizes.pop(filename, None)
+                self._write_index_internal(filename, None)
+                log_path = self._get_log_path(filename)
+                # 尚未写入磁盘的修改直接丢弃
+                existed = filename in self._dirty
+                self._dirty.pop(filename, None)
+                if os.path.exists(log_path):
+                    os.remove(log_path)
+                    existed = True
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                    existed = True
+                if existed:
+                    print(f'文件已删除: {file_path}')
+                    return True
+                else:
+                    print(f'文件不存在: {file_path}')
+                    return False
+        except Exception as e:
+            print(f'删除文件失败 {filename}: {str(e)}')
+            return False
+
+    def list_files(self) -> list:
+        """
+        列出所有JSON文件
+
+        Returns:
+            list: JSON文件名列表（不包含.json后缀，子目录中的分片文档形如 users/3f）
+        """
+        try:
+            files = []
+            for root, dirs, filenames in os.walk(self.data_dir):
+                # 跳过锁文件等隐藏目录
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                prefix = os.path.relpath(root, self.data_dir).replace(os.sep, '/')
+                prefix = '' if prefix == '.' else prefix + '/'
+                for filename in sorted(filenames):
+                    if filename.endswith('.json'):
+                        name = filename[:-5]  # 移除.json后缀
+                    elif filename.endswith('.log'):
+                        name = filename[:-4]  # 只有变更日志、尚未生成快照的文档
+                    else:
+                        continue
+                    if prefix + name not in files:
+                        files.append(prefix + name)
+            # 延迟写入模式下尚未落盘的新文档
+            files += sorted(name for name in list(self._dirty) if name not in files)
+            return files
+        except Exception as e:
+            print(f'列出文件失败: {str(e)}')
+            return []
+
+    def create_message_journal(self, filename: str, max_messages: int = 100, archive: bool = False):
+        """创建与本后端配套的用户消息存储（archive 为 True 时超出保留数量的消息写入冷归档）"""
+        return MessageJournal(self, filename, max_messages, archive)
+
+
+class MessageJournal:
+    """用户消息日志 - 追加写入的JSONL日志 + 每个用户固定长度的环形缓冲"""
+
+    # 日志行数至少达到这么多才会触发压缩
+    COMPACT_MIN_LINES = 10000
+
+    def __init__(
+        self,
+        data_manager: JSONDataManager,
+        filename: str,
+        max_messages: int = 100,
+        archive: bool = False,
+    ):
+        """
+        初始化消息日志
+
+        Args:
+            data_manager: 数据管理器（用于定位数据目录和迁移旧数据）
+            filename: 日志文件名（不需要包含后缀）
+            max_messages: 每个用户保留的最近消息数
+            archive: 是否将超出保留数量的消息写入冷归档（压缩日志时批量写入）
+        """
+        self.data_manager = data_manager
+        self.filename = filename
+        self.max_messages = max_messages
+        self.journal_path = os.path.join(data_manager.data_dir, filename + '.jsonl')
+        self.archive = (
+            MessageArchive(
+                os.path.join(data_manager.data_dir, filename + '_archive'), data_manager.codec
+            )
+            if archive
+            else None
+        )
+
+        self._lock = Lock()
+        # 跨进程锁，与数据管理器共用 .locks 目录
+        self._process_locks = FileLockRegistry(os.path.join(data_manager.data_dir, '.locks'))
+        self._lock_name = filename + '.jsonl'
+        # openid -> 最近消息的环形缓冲，超出容量时自动淘汰最旧的消息
+        self._buffers: Dict[str, deque] = {}
+        # openid -> 已被淘汰但尚未归档的消息（仍在日志中，下次压缩时写入冷归档）
+        self._evicted: Dict[str, list] = {}
+        # 日志中的总行数（包括已被淘汰或删除的记录）与仍有效的消息数，用于判断何时压缩
+        self._line_count = 0
+        self._live_count = 0
+        # 已读取到的日志字节偏移；其他进程追加后只需读取新增部分
+        self._offset = 0
+        # 最近一次读写后的日志文件签名，文件被外部修改时重新加载
+        self._signature = None
+        self._loaded = False
+
+    @contextmanager
+    def _write_lock(self):
+        """写操作加锁：进程内线程锁 + 跨进程独占文件锁"""
+        with self._lock:
+            with self._process_locks.exclusive(self._lock_name):
+                yield
+
+    def _new_buffer(self) -> deque:
+        return deque(maxlen=self.max_messages)
+
+    def _apply_internal(self, entry: Dict):
+        """将一条日志记录应用到环形缓冲，不加锁"""
+        self._line_count += 1
+        openid = entry['o']
+        if entry.get('d'):
+            buffer = self._buffers.pop(openid, None)
+            if buffer:
+                self._live_count -= len(buffer)
+            self._evicted.pop(openid, None)
+            return
+        buffer = self._buffers.get(openid)
+        if buffer is None:
+            buffer = self._buffers[openid] = self._new_buffer()
+        if len(buffer) < self.max_messages:
+            self._live_count += 1
+        elif self.archive is not None:
+            self._evicted.setdefault(openid, []).append(buffer[0])
+        buffer.append(entry['m'])
+
+    def _migrate_legacy_internal(self):
+        """将旧版 user_messages.json 文档迁移为追加日志，不加锁"""
+        legacy = self.data_manager.load_data(self.filename, None)
+        if not legacy:
+            return
+
+        for openid, messages in legacy.items():
+            buffer = self._new_buffer()
+            buffer.extend(messages)
+            self._buffers[openid] = buffer
+        self._rewrite_internal()
+        self.data_manager.delete_file(self.filename)
+        print(f'已将 {len(legacy)} 个用户的消息记录迁移到 {self.journal_path}')
+
+    def _read_from_internal(self, offset: int):
+        """从指定偏移读取日志中完整的行并应用，不加锁"""
+        with open(self.journal_path, 'rb') as f:
+            f.seek(offset)
+            for raw_line in f:
+                if not raw_line.endswith(b'\n'):
+                    # 不完整的最后一行，等写入完成后再读
+                    break
+                offset += len(raw_line)
+                line = raw_line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = self.data_manager.codec.decode(line)
+                except ValueError:
+                    print(f'忽略损坏的消息日志行: {line[:50]}')
+                    continue
+                self._apply_internal(entry)
+        self._offset = offset
+
+    def _load_internal(self):
+        """从日志重建环形缓冲（其他进程只追加时增量读取），需持有线程锁"""
+        signature = JSONDataManager._get_file_signature(self.journal_path)
+        if self._loaded and signature == self._signature:
+            return
+
+        with self._process_locks.shared(self._lock_name):
+            signature = JSONDataManager._get_file_signature(self.journal_path)
+            if (
+                self._loaded
+                and signature is not None
+                and self._signature is not None
+                and signature[0] == self._signature[0]
+                and signature[2] >= self._offset
+            ):
+                # 同一个文件只是被追加了内容，只读取新增部分
+                self._read_from_internal(self._offset)
+                self._signature = signature
+                return
+
+            self._buffers = {}
+            self._evicted = {}
+            self._line_count = 0
+            self._live_count = 0
+            self._offset = 0
+            self._loaded = True
+            if signature is not None:
+                self._read_from_internal(0)
+                self._signature = signature
+                print(f'消息日志已从 {self.journal_path} 加载')
+                return
+
+        # 日志不存在时尝试迁移旧版文档（需要独占锁）
+        with self._process_locks.exclusive(self._lock_name):
+            if JSONDataManager._get_file_signature(self.journal_path) is None:
+                self._migrate_legacy_internal()
+            else:
+                # 其他进程抢先完成了迁移
+                self._read_from_internal(0)
+            self._signature = JSONDataManager._get_file_signature(self.journal_path)
+
+    def _append_internal(self, entries: list):
+        """一次性追加多行到日志（同步到磁盘后才返回），需持有写锁并已加载日志"""
+        codec = self.data_manager.codec
+        with open(self.journal_path, 'ab') as f:
+            # 截掉崩溃时写了一半的末行（加载时已读到最后一个完整行），新记录从完整的行之后开始
+            if os.fstat(f.fileno()).st_size > self._offset:
+                f.truncate(self._offset)
+            f.write(b''.join(codec.encode(entry) + b'\n' for entry in entries))
+            f.flush()
+            if self.data_manager.fsync:
+                os.fsync(f.fileno())
+            self._offset = f.tell()
+        for entry in entries:
+            self._apply_internal(entry)
+        self._signature = JSONDataManager._get_file_signature(self.journal_path)
+
+    def _rewrite_internal(self):
+        """只保留环形缓冲中仍然有效的消息，重写日志，需持有写锁"""
+        if self._evicted:
+            # 先归档（同步到磁盘）再重写日志，崩溃时消息至多在归档中重复，不会丢失
+            archived = self.archive.write(
+                (
+                    (openid, message)
+                    for openid, messages in self._evicted.items()
+                    for message in messages
+                ),
+                f'{time.time_ns()}-{os.getpid()}',
+            )
+            self._evicted = {}
+            print(f'已归档 {archived} 条超出保留数量的消息')
+
+        tmp_path = self.journal_path + '.tmp'
+        line_count = 0
+        codec = self.data_manager.codec
+        with open(tmp_path, 'wb') as f:
+            for openid, buffer in self._buffers.items():
+                for message in buffer:
+                    f.write(codec.encode({'o': openid, 'm': message}) + b'\n')
+                    line_count += 1
+            self._offset = f.tell()
+            f.flush()
+            if self.data_manager.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        if self.data_manager.fsync:
+            _fsync_dir(os.path.dirname(self.journal_path))
+        self._line_count = line_count
+        self._live_count = line_count
+        self._signature = JSONDataManager._get_file_signature(self.journal_path)
+
+    def _maybe_compact_internal(self):
+        """日志中的过期记录超过有效记录时压缩，需持有写锁"""
+        if self._line_count > max(self.COMPACT_MIN_LINES, self._live_count * 2):
+            self._rewrite_internal()
+            print(f'消息日志已压缩: {self._line_count} 条有效记录')
+
+    def append(self, openid: str, message: Dict) -> bool:
+        """
+        追加一条用户消息
+
+        Args:
+            openid: 用户openid
+            message: 消息记录
+
+        Returns:
+            bool: 是否成功
+        """
+        try:
+            with self._write_lock():
+                self._load_internal()
+                self._append_internal([{'o': openid, 'm': message}])
+                self._maybe_compact_internal()
+                return True
+        except Exception as e:
+            self._loaded = False
+            print(f'记录消息失败 {openid}: {str(e)}')
+            return False
+
+    def get(self, openid: str, limit: int = 10) -> list:
+        """
+        获取用户最近的消息
+
+        Args:
+            openid: 用户openid
+            limit: 返回消息数量限制，小于等于0时返回全部保留的消息
+
+        Returns:
+            list: 消息列表，按时间从旧到新
+        """
+        try:
+            with self._lock:
+                self._load_internal()
+                buffer = self._buffers.get(openid)
+                if not buffer:
+                    return []
+                if limit <= 0 or limit >= len(buffer):
+                    return list(buffer)
+                return list(islice(buffer, len(buffer) - limit, None))
+        except Exception as e:
+            self._loaded = False
+            print(f'读取消息失败 {openid}: {str(e)}')
+            return []
+
+    def delete(self, openid: str) -> bool:
+        """
+        删除用户的所有消息（追加一条删除标记）
+
+        Args:
+            openid: 用户openid
+
+        Returns:
+            bool: 用户是否有消息被删除
+        """
+        return self.delete_many([openid]) > 0
+
+    def delete_many(self, openids) -> int:
+        """
+        批量删除多个用户的所有消息（一次追加所有删除标记，归档分段各重写一次）
+
+        Args:
+            openids: 用户openid序列
+
+        Returns:
+            int: 有消息被删除的用户数
+        """
+        try:
+            with self._write_lock():
+                self._load_internal()
+                openids = set(openids)
+                deleted = (
+                    set(self.archive.delete_many(openids)) if self.archive is not None else set()
+                )
+                present = [openid for openid in openids if openid in self._buffers]
+                if present:
+                    self._append_internal([{'o': openid, 'd': 1} for openid in present])
+                    self._maybe_compact_internal()
+                return len(deleted.union(present))
+        except Exception as e:
+            self._loaded = False
+            print(f'删除消息失败: {str(e)}')
+            return 0
+
+    def get_history(self, openid: str, limit: int = 20, before: Optional[float] = None) -> list:
+        """
+        分页获取用户的完整消息历史（包括冷归档），从 before 往前取 limit 条
+
+        Args:
+            openid: 用户openid
+            limit: 本页消息数
+            before: 只返回时间戳早于该值的消息，为None时从最新的消息开始
+
+        Returns:
+            list: 消息列表，按时间从旧到新；下一页以第一条消息的时间戳作为 before
+        """
+        try:
+            with self._lock:
+                self._load_internal()
+                # 环形缓冲中是最近的消息，已淘汰未归档的消息在它之前
+                recent = self._evicted.get(openid, []) + list(self._buffers.get(openid, ()))
+        except Exception as e:
+            self._loaded = False
+            print(f'读取消息失败 {openid}: {str(e)}')
+            return []
+
+        newest_first = (
+            message
+            for message in reversed(recent)
+            if before is None or message.get('timestamp', 0) < before
+        )
+        if self.archive is not None:
+            newest_first = chain(newest_first, self.archive.iter_messages(openid, before))
+        return list(islice(newest_first, limit))[::-1]
+
+    def compact(self) -> bool:
+        """
+        立即压缩日志，丢弃已被淘汰或删除的消息
+
+        Returns:
+            bool: 是否成功
+        """
+        try:
+            with self._write_lock():
+                self._load_internal()
+                self._rewrite_internal()
+                return True
+        except Exception as e:
+            self._loaded = False
+            print(f'压缩消息日志失败: {str(e)}')
+            return False
+
+
+class UserIdTable:
+    """
+    openid 与紧凑整数编号的驻留表
+
+    编号从1开始递增分配，分配后永不改变（删除用户后也保留，不会回收给其他用户），
+    因此各进程可以一直缓存已知的映射。文档中以openid为键、编号为值；
+    编号到openid的反向映射在内存中按需从该文档重建
+    """
+
+    def __init__(self, data_manager, filename: str, counters_file: str, counter_name: str):
+        """
+        初始化驻留表
+
+        Args:
+            data_manager: 存储后端（分配编号直接提交，不进入工作单元）
+            filename: 映射文档名
+            counters_file: 计数器文档名
+            counter_name: 编号序列的计数器名称
+        """
+        self.data_manager = data_manager
+        self.filename = filename
+        self.counters_file = counters_file
+        self.counter_name = counter_name
+
+        self._ids: Dict[str, int] = {}
+        self._openids: Dict[int, str] = {}
+        self._lock = Lock()
+
+    def _remember(self, openid: str, user_id: int):
+        with self._lock:
+            self._ids[openid] = user_id
+            self._openids[user_id] = openid
+
+    def get_id(self, openid: str) -> Optional[int]:
+        """
+        查询openid的编号（不分配）
+
+        Args:
+            openid: 用户的openid
+
+        Returns:
+            int: 编号，尚未分配时为None
+        """
+        user_id = self._ids.get(openid)
+        if user_id is None:
+            user_id = self.data_manager.get(self.filename, openid)
+            if user_id is not None:
+                self._remember(openid, user_id)
+        return user_id
+
+    def get_openid(self, user_id: int) -> Optional[str]:
+        """
+        查询编号对应的openid（本进程未见过的编号从映射文档重建反向映射）
+
+        Args:
+            user_id: 用户编号
+
+        Returns:
+            str: openid，编号不存在时为None
+        """
+        openid = self._openids.get(user_id)
+        if openid is None:
+            mapping = self.data_manager.load_data(self.filename, {})
+            with self._lock:
+                self._ids.update(mapping)
+                self._openids.update((value, key) for key, value in mapping.items())
+                openid = self._openids.get(user_id)
+        return openid
+
+    def intern(self, openid: str) -> int:
+        """
+        获取openid的编号，尚未分配时分配一个新编号
+
+        Args:
+            openid: 用户的openid
+
+        Returns:
+            int: 编号
+
+        Raises:
+            RuntimeError: 分配失败
+        """
+        user_id = self.get_id(openid)
+        if user_id is None:
+            user_id = self.intern_many([openid])[openid]
+        return user_id
+
+    def intern_many(self, openids) -> Dict[str, int]:
+        """
+        批量获取编号，为所有尚未分配的openid一次预留一段编号并一次写入映射
+
+        多个进程同时为同一openid分配时以先写入的为准，落败方预留的编号作废
+
+        Args:
+            openids: openid序列
+
+        Returns:
+            Dict[str, int]: openid -> 编号
+
+        Raises:
+            RuntimeError: 分配失败
+        """
+        result = {}
+        missing = []
+        for openid in dict.fromkeys(openids):
+            user_id = self.get_id(openid)
+            if user_id is None:
+                missing.append(openid)
+            else:
+                result[openid] = user_id
+        if not missing:
+            return result
+
+        reserved = None
+
+        def reserve(current):
+            nonlocal reserved
+            reserved = current or 0
+            return reserved + len(missing)
+
+        if not self.data_manager.update_key(self.counters_file, self.counter_name, reserve, 0):
+            raise RuntimeError('分配用户编号失败')
+
+        def assign(user_id):
+            return lambda current: user_id if current is None else current
+
+        operations = [
+            ('update_key', openid, assign(reserved + offset), None)
+            for offset, openid in enumerate(missing, 1)
+        ]
+        if not self.data_manager.commit_batch({self.filename: operations}):
+            raise RuntimeError('写入用户编号失败')
+        for openid in missing:
+            # 读回实际生效的编号（可能已被其他进程抢先分配）
+            user_id = self.data_manager.get(self.filename, openid)
+            self._remember(openid, user_id)
+            result[openid] = user_id
+        return result
+
+
+class StatisticsCounter:
+    """统计计数器 - 在内存中累加事件计数，定期批量合并到统计文档的时间序列中"""
+
+    def __init__(
+        self, data_manager, filename: str, flush_interval: float, retention: Dict[str, int]
+    ):
+        """
+        初始化统计计数器
+
+        Args:
+            data_manager: 数据管理器
+            filename: 统计文档名
+            flush_interval: 写入间隔（秒），即进程异常退出时最多丢失的统计时长
+            retention: 各时间粒度保留的桶数，如 {'hour': 720, 'day': 365, 'month': 60}
+        """
+        self.data_manager = data_manager
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.retention = retention
+
+        self._lock = Lock()
+        # (小时序号, 事件类型) -> 尚未写入磁盘的增量
+        self._pending: Dict[Tuple[int, str], int] = {}
+        self._flush_thread = None
+        self._stop_event = Event()
+
+    def increment(self, event_type: str) -> bool:
+        """
+        事件计数加一（只修改内存）
+
+        Args:
+            event_type: 事件类型
+
+        Returns:
+            bool: 始终为True
+        """
+        key = (hour_bucket(time.time()), event_type)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+            if self._flush_thread is None:
+                self._start_flush_thread()
+        return True
+
+    def _start_flush_thread(self):
+        """启动后台定期写入线程（首次计数时启动，避免导入模块就创建线程）"""
+        self._flush_thread = Thread(target=self._flush_loop, name='statistics-flush', daemon=True)
+        self._flush_thread.start()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f'写入统计失败: {str(e)}')
+
+    def stop(self) -> bool:
+        """
+        停止后台写入线程并写入剩余的增量（服务退出时调用，可重复调用）
+
+        Returns:
+            bool: 是否成功
+        """
+        self._stop_event.set()
+        flush_thread = self._flush_thread
+        if flush_thread is not None and flush_thread.is_alive():
+            flush_thread.join(self.flush_interval)
+        return self.flush()
+
+    def _load_merged(self) -> Tuple[Dict, StatisticsTimeSeries]:
+        """读取磁盘上的统计并合并内存增量，返回 (累计总数, 时间序列)"""
+        with self._lock:
+            pending = dict(self._pending)
+
+        stats = self.data_manager.load_data(self.filename, {})
+        total = dict(stats.get('total', {}))
+        series = self._load_series(stats)
+        self._merge(total, series, pending)
+        return total, series
+
+    def _load_series(self, stats: Dict) -> StatisticsTimeSeries:
+        """从统计文档恢复时间序列，并导入旧版按日期保存的 daily 统计"""
+        series = StatisticsTimeSeries(self.retention, stats.get('series'))
+        for day, counts in stats.get('daily', {}).items():
+            for event_type, count in counts.items():
+                series.add_day(event_type, day, count)
+        return series
+
+    @staticmethod
+    def _merge(total: Dict, series: StatisticsTimeSeries, pending: Dict[Tuple[int, str], int]):
+        for (hour, event_type), count in pending.items():
+            series.add(event_type, hour, count)
+            total[event_type] = total.get(event_type, 0) + count
+
+    def get_summary(self) -> Dict:
+        """
+        获取累计总数和按天统计（包含内存中尚未写入磁盘的计数）
+
+        Returns:
+            Dict: {'daily': {日期: {事件类型: 次数}}, 'total': {事件类型: 次数}}
+        """
+        total, series = self._load_merged()
+        daily = {}
+        for event_type in series.series:
+            result = series.query(event_type, timeseries.DAY, None, time.time())
+            for day, count in zip(result['labels'], result['counts']):
+                if count:
+                    daily.setdefault(day, {})[event_type] = count
+        return {'daily': dict(sorted(daily.items())), 'total': total}
+
+    def query(
+        self, event_type: str, resolution: str, start_time: Optional[float], end_time: float
+    ) -> Dict:
+        """
+        按时间粒度查询事件计数（包含内存中尚未写入磁盘的计数）
+
+        Args:
+            event_type: 事件类型
+            resolution: 时间粒度（hour/day/month）
+            start_time: 开始时间戳，为None时从保留范围的起点开始
+            end_time: 结束时间戳
+
+        Returns:
+            Dict: 见 StatisticsTimeSeries.query
+        """
+        _, series = self._load_merged()
+        return series.query(event_type, resolution, start_time, end_time)
+
+    def flush(self) -> bool:
+        """
+        将内存中的增量合并写入统计文档
+
+        Returns:
+            bool: 是否成功
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return True
+
+        def update_stats(current_stats):
+            current_stats = current_stats or {}
+            total = current_stats.get('total', {})
+            series = self._load_series(current_stats)
+            self._merge(total, series, pending)
+            return {'total': total, 'series': series.to_dict()}
+
+        success = self.data_manager.update_data(self.filename, update_stats, {})
+        if not success:
+            # 写入失败时把增量放回去，下次再试
+            with self._lock:
+                for key, count in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + count
+        return success
+
+
+class UnitOfWork:
+    """
+    工作单元 - 收集一次请求中的所有写操作，结束时按文档合并、原子地一次提交
+
+    提供与数据管理器相同的读写接口；读操作能看到本工作单元中尚未提交的修改
+    """
+
+    # 记录级覆盖层中表示“已删除”的标记
+    _DELETED = object()
+
+    def __init__(self, data_manager):
+        self.data_manager = data_manager
+        # 文档名 -> 按调用顺序记录的操作，提交时在最新数据上重新执行
+        self._operations: Dict[str, list] = {}
+        # 只有记录级修改的文档: 文档名 -> {记录键: 新值或 _DELETED}
+        self._overlays: Dict[str, Dict[str, Any]] = {}
+        # 整体读取或整体修改过的文档: 文档名 -> 应用了本工作单元修改的副本
+        self._documents: Dict[str, Any] = {}
+        # 提交成功后执行的非文档写入（如追加用户消息）
+        self._after_commit: list = []
+        # 提交结果，尚未提交时为None
+        self.committed: Optional[bool] = None
+
+    def _materialize(self, filename: str, default_value: Any) -> Any:
+        """获取应用了本工作单元修改的完整文档副本"""
+        if filename in self._documents:
+            return self._documents[filename]
+        data = copy.deepcopy(self.data_manager.load_data(filename, default_value))
+        overlay = self._overlays.pop(filename, {})
+        if overlay and data is None:
+            data = {}
+        for key, value in overlay.items():
+            if value is self._DELETED:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        self._documents[filename] = data
+        return data
+
+    def _record(self, filename: str, *operation):
+        self._operations.setdefault(filename, []).append(operation)
+
+    def load_data(self, filename: str, default_value: Any = None) -> Any:
+        """读取整个文档（包含本工作单元中的修改），返回值请勿原地修改"""
+        if filename not in self._operations:
+            return self.data_manager.load_data(filename, default_value)
+        data = self._materialize(filename, default_value)
+        return default_value if data is None else data
+
+    def get(self, filename: str, key: str, default_value: Any = None) -> Any:
+        """读取单条记录（包含本工作单元中的修改）"""
+        if filename in self._documents:
+            data = self._documents[filename]
+            return data.get(key, default_value) if isinstance(data, dict) else default_value
+        overlay = self._overlays.get(filename)
+        if overlay is None or key not in overlay:
+            return self.data_manager.get(filename, key, default_value)
+        value = overlay[key]
+        return default_value if value is self._DELETED else value
+
+    def put(self, filename: str, key: str, value: Any) -> bool:
+        self._record(filename, 'put', key, value)
+        if filename in self._documents:
+            self._documents[filename][key] = value
+        else:
+            self._overlays.setdefault(filename, {})[key] = value
+        return True
+
+    def delete(self, filename: str, key: str) -> bool:
+        self._record(filename, 'delete', key)
+        if filename in self._documents:
+            self._documents[filename].pop(key, None)
+        else:
+            self._overlays.setdefault(filename, {})[key] = self._DELETED
+        return True
+
+    def update_key(self, filename: str, key: str, update_func, default_value: Any = None) -> bool:
+        self._record(filename, 'update_key', key, update_func, default_value)
+        value = update_func(copy.deepcopy(self.get(filename, key, default_value)))
+        if filename in self._documents:
+            if value is None:
+                self._documents[filename].pop(key, None)
+            else:
+                self._documents[filename][key] = value
+        else:
+            self._overlays.setdefault(filename, {})[key] = self._DELETED if value is None else value
+        return True
+
+    def update_data(self, filename: str, update_func, default_value: Any = None) -> bool:
+        data = self._materialize(filename, copy.deepcopy(default_value))
+        self._record(filename, 'update_data', update_func, default_value)
+        self._documents[filename] = update_func(data)
+        return True
+
+    def save_data(self, filename: str, data: Any, pretty: bool = None) -> bool:
+        self._record(filename, 'save_data', data)
+        self._overlays.pop(filename, None)
+        self._documents[filename] = data
+        return True
+
+    def after_commit(self, func, *args):
+        """登记提交成功后才执行的写操作"""
+        self._after_commit.append((func, args))
+
+    def commit(self) -> bool:
+        """
+        提交所有修改，每个涉及的文档只写入一次
+
+        Returns:
+            bool: 是否提交成功（失败时所有文档修改都不生效）
+        """
+        operations, self._operations = self._operations, {}
+        after_commit, self._after_commit = self._after_commit, []
+        self._overlays.clear()
+        self._documents.clear()
+
+        if operations and not self.data_manager.commit_batch(operations):
+            self.committed = False
+            return False
+        self.committed = True
+        for func, args in after_commit:
+            func(*args)
+        return True
+
+
+# 已创建的共享存储引擎: (后端, 数据目录绝对路径) -> 数据管理器
+_shared_data_managers: Dict[Tuple[str, str], Any] = {}
+_shared_data_managers_lock = Lock()
+
+
+def create_data_manager(data_dir: str = 'data'):
+    """
+    按配置获取存储后端
+
+    同一数据目录只创建一个共享实例，保证所有调用方共用同一份缓存和同一组文件锁
+
+    Args:
+        data_dir: 数据存储目录
+
+    Returns:
+        JSONDataManager 或 SQLiteDataManager（由 consts.STORAGE_BACKEND 决定）
+    """
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    key = (consts.STORAGE_BACKEND, os.path.normpath(os.path.join(project_root, data_dir)))
+
+    with _shared_data_managers_lock:
+        manager = _shared_data_managers.get(key)
+        if manager is None:
+            if consts.STORAGE_BACKEND == 'sqlite':
+                from sqlite_data_manager import SQLiteDataManager
+
+                manager = SQLiteDataManager(
+                    data_dir, get_codec(consts.STORAGE_JSON_CODEC), consts.STORAGE_FSYNC
+                )
+            else:
+                manager = JSONDataManager(
+                    data_dir,
+                    consts.STORAGE_WRITE_BEHIND,
+                    consts.STORAGE_WRITE_BEHIND_INTERVAL,
+                    get_codec(consts.STORAGE_JSON_CODEC),
+                    consts.STORAGE_JSON_PRETTY,
+                    consts.STORAGE_FSYNC,
+                )
+            _shared_data_managers[key] = manager
+        return manager
+
+
+class UserContext:
+    """
+    请求级用户上下文 - 一次请求中每项用户状态最多读取一次
+
+    各项状态在首次访问时读取并缓存，是请求开始时的快照；本请求内的修改不会反映到上下文中
+    （verify_and_save_vip 等接收上下文的方法除外）
+    """
+
+    # 尚未读取的标记
+    _UNSET = object()
+
+    def __init__(self, user_data_manager: 'UserDataManager', openid: str):
+        self.user_data_manager = user_data_manager
+        self.openid = openid
+        self._vip_info = self._UNSET
+        self._session = self._UNSET
+        self._user_info = self._UNSET
+        self._unread_recipe_count = self._UNSET
+
+    @property
+    def vip_info(self) -> Optional[Dict]:
+        """VIP用户信息，不是VIP时为None"""
+        if self._vip_info is self._UNSET:
+            self._vip_info = self.user_data_manager.get_vip_info(self.openid)
+        return self._vip_info
+
+    @vip_info.setter
+    def vip_info(self, value: Optional[Dict]):
+        self._vip_info = value
+
+    @property
+    def is_vip(self) -> bool:
+        """是否是有效的VIP用户（尚未读取VIP信息时通过 is_vip_user 查询）"""
+        if self._vip_info is self._UNSET:
+            return self.user_data_manager.is_vip_user(self.openid)
+        return self.vip_info is not None and self.vip_info.get('status') == 'active'
+
+    @property
+    def session(self) -> Optional[Dict]:
+        """会话状态，没有会话时为None"""
+        if self._session is self._UNSET:
+            self._session = self.user_data_manager.get_user_session_state(self.openid)
+        return self._session
+
+    @property
+    def user_info(self) -> Optional[Dict]:
+        """用户基本信息，不存在时为None"""
+        if self._user_info is self._UNSET:
+            self._user_info = self.user_data_manager.get_user_info(self.openid)
+        return self._user_info
+
+    @user_info.setter
+    def user_info(self, value: Optional[Dict]):
+        self._user_info = value
+
+    @property
+    def unread_recipe_count(self) -> int:
+        """未读的新菜谱通知数（只有VIP用户会收到通知）"""
+        if self._unread_recipe_count is self._UNSET:
+            self._unread_recipe_count = (
+                self.user_data_manager.get_unread_recipe_count(self.openid) if self.is_vip else 0
+            )
+        return self._unread_recipe_count
+
+    @unread_recipe_count.setter
+    def unread_recipe_count(self, value: int):
+        self._unread_recipe_count = value
+
+
+class UserDataManager:
+    """用户数据管理器 - 专门用于管理微信用户数据"""
+
+    def __init__(self):
+        self.data_manager = create_data_manager()
+        self.users_file = 'users'
+        self.user_messages_file = 'user_messages'
+        self.statistics_file = 'statistics'
+        self.vip_users_file = 'vip_users'  # VIP用户数据文件
+        self.user_sessions_file = 'user_sessions'  # 用户会话状态文件（验证、菜谱录入等）
+        self.recipes_file = 'recipes'  # 菜谱数据文件
+        self.recipe_search_file = 'recipe_search_index'  # 菜谱搜索倒排索引文件
+        self.recipe_notifications_file = (
+            'recipe_notifications'  # 旧版菜谱通知记录文件（仅用于迁移）
+        )
+        self.recipe_cursors_file = 'recipe_read_cursors'  # 用户菜谱已读游标文件
+        self.storage_layout_file = 'storage_layout'  # 存储布局元数据（分片数等）
+        self.counters_file = 'counters'  # 持久化计数器（VIP ID序列、用户编号序列等）
+
+        # 按openid哈希分片存储的文档，单条写入和压缩的成本只与分片大小相关
+        self.sharded_files = (
+            self.users_file,
+            self.user_sessions_file,
+            self.recipe_cursors_file,
+        )
+        self.shard_count = self._load_shard_count()
+
+        # 统计计数先在内存中累加，定期批量写入，进程退出时也会写入
+        self.statistics_counter = StatisticsCounter(
+            self.data_manager,
+            self.statistics_file,
+            consts.STATISTICS_FLUSH_INTERVAL,
+            consts.STATISTICS_RETENTION,
+        )
+        atexit.register(self.shutdown)
+
+        # 用户消息使用追加日志存储，每个用户只保留最近100条，更早的消息写入冷归档
+        self.message_journal = self.data_manager.create_message_journal(
+            self.user_messages_file, 100, consts.MESSAGE_ARCHIVE_ENABLED
+        )
+
+        # 每个请求线程当前的工作单元
+        self._local = local()
+
+        # 有效VIP用户的openid集合及其来源的VIP文档对象；文档被重新解析（包括其他进程写入）后重建，
+        # 本进程的 verify_and_save_vip / delete_users 提交后同步更新
+        self._vip_openids: Optional[set] = None
+        self._vip_source = None
+        self._vip_openids_lock = Lock()
+
+        # 会话按状态设置有效期，过期会话由后台线程按过期索引清理
+        self.session_store = SessionStore(
+            self,
+            consts.SESSION_TTL,
+            consts.SESSION_DEFAULT_TTL,
+            consts.SESSION_SWEEP_INTERVAL,
+        )
+
+        # 用户属性二级索引（关注状态、VIP状态、是否首次关注、关注日期），随 save_user_info 同步更新
+        # openid 与紧凑整数编号的驻留表，索引等内部数据使用编号代替28位的openid
+        self.user_ids = UserIdTable(self.data_manager, 'user_ids', self.counters_file, 'user_id')
+        self.user_index = UserAttributeIndex(self)
+
+        self._migrate_recipe_notifications()
+        self._migrate_recipe_category_ids()
+        self.user_index.ensure_built()
+
+    # ==================== 工作单元 ==================== #
+
+    def _run_after_commit(self, func, *args):
+        """在当前工作单元提交成功后执行 func（不在工作单元中时立即执行）"""
+        unit_of_work = getattr(self._local, 'unit_of_work', None)
+        if unit_of_work is not None:
+            unit_of_work.after_commit(func, *args)
+            return True
+        return func(*args)
+
+    @property
+    def store(self):
+        """当前线程的工作单元；不在工作单元中时为存储后端本身"""
+        return getattr(self._local, 'unit_of_work', None) or self.data_manager
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        在一个工作单元中执行一次请求的所有写操作
 
-        Args:
-            filename: 文件名
-            update_func: 更新函数，接收当前数据作为参数，返回更新后的数据
-            default_value: 文件不存在时的默认值
+        块内的修改先在内存中累积（块内读取可以看到），正常退出时按文档合并后原子提交，
+        每个涉及的文档只写入一次；块内抛出异常时所有修改都被丢弃。嵌套调用并入外层工作单元
 
-        Returns:
-            bool: 更新是否成功
+        块内生成的回复只有在提交成功后才能发送，退出后检查 unit_of_work.committed
+        （为False时提交失败）
         """
+        if getattr(self._local, 'unit_of_work', None) is not None:
+            yield self._local.unit_of_work
+            return
+
+        unit_of_work = UnitOfWork(self.data_manager)
+        self._local.unit_of_work = unit_of_work
         try:
-            with self._lock:
-                current_data = self._load_data_internal(filename, default_value)
-                updated_data = update_func(current_data)
-                return self._save_data_internal(filename, updated_data)
-        except Exception as e:
-            print(f'更新数据失败 {filename}: {str(e)}')
-            return False
+            yield unit_of_work
+        finally:
+            self._local.unit_of_work = None
+        if not unit_of_work.commit():
+            print('工作单元提交失败，本次请求的修改未保存')
 
-    def delete_file(self, filename: str) -> bool:
+    def get_user_context(self, openid: str) -> UserContext:
         """
-        删除JSON文件
+        创建请求级用户上下文
 
         Args:
-            filename: 文件名
+            openid: 用户的openid
 
         Returns:
-            bool: 删除是否成功
+            UserContext: 按需读取并缓存VIP信息、会话状态、用户信息和未读通知数的上下文
         """
-        try:
-            with self._lock:
-                file_path = self._get_file_path(filename)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    print(f'文件已删除: {file_path}')
-                    return True
-                else:
-                    print(f'文件不存在: {file_path}')
-                    return False
-        except Exception as e:
-            print(f'删除文件失败 {filename}: {str(e)}')
-            return False
+        return UserContext(self, openid)
 
-    def list_files(self) -> list:
+    # ==================== 分片存储 ==================== #
+
+    def _load_shard_count(self) -> int:
         """
-        列出所有JSON文件
+        读取磁盘上实际使用的分片数
 
-        Returns:
-            list: JSON文件名列表（不包含.json后缀）
+        全新的数据目录直接采用配置的分片数；已有未分片数据时继续按原布局读写，
+        需要运行 manage.py migrate-shards 完成迁移
         """
-        try:
-            files = []
-            if os.path.exists(self.data_dir):
-                for filename in os.listdir(self.data_dir):
-                    if filename.endswith('.json'):
-                        files.append(filename[:-5])  # 移除.json后缀
-            return files
-        except Exception as e:
-            print(f'列出文件失败: {str(e)}')
-            return []
+        layout = self.data_manager.load_data(self.storage_layout_file, None)
+        if layout is not None:
+            shard_count = layout.get('user_shard_count', 1)
+            if shard_count != consts.USER_DATA_SHARD_COUNT:
+                print(
+                    f'警告: 数据按 {shard_count} 个分片存储，与配置的 '
+                    f'{consts.USER_DATA_SHARD_COUNT} 不一致，请运行 manage.py migrate-shards'
+                )
+            return shard_count
 
+        existing_files = self.data_manager.list_files()
+        if any(filename in existing_files for filename in self.sharded_files):
+            if consts.USER_DATA_SHARD_COUNT != 1:
+                print('警告: 用户数据尚未分片，请运行 manage.py migrate-shards 迁移')
+            return 1
 
-class UserDataManager:
-    """用户数据管理器 - 专门用于管理微信用户数据"""
+        self.data_manager.save_data(
+            self.storage_layout_file, {'user_shard_count': consts.USER_DATA_SHARD_COUNT}
+        )
+        return consts.USER_DATA_SHARD_COUNT
+
+    @staticmethod
+    def _shard_name(base: str, shard: int, shard_count: int) -> str:
+        """分片文档名，如 users/3f；只有一个分片时就是原文档名"""
+        if shard_count <= 1:
+            return base
+        width = len(f'{shard_count - 1:x}')
+        return f'{base}/{shard:0{width}x}'
+
+    @staticmethod
+    def _shard_index(openid: str, shard_count: int) -> int:
+        """openid对应的分片序号（使用稳定的crc32，不受进程哈希随机化影响）"""
+        return zlib.crc32(openid.encode('utf-8')) % shard_count if shard_count > 1 else 0
+
+    def _shard_file(self, base: str, openid: str) -> str:
+        """获取openid所在的分片文档名"""
+        return self._shard_name(base, self._shard_index(openid, self.shard_count), self.shard_count)
+
+    def _iter_shard_files(self, base: str, shard_count: int = None) -> list:
+        """列出某个分片文档当前存在的所有分片"""
+        if shard_count is None:
+            shard_count = self.shard_count
+        if shard_count <= 1:
+            return [base] if base in self.data_manager.list_files() else []
+        return [
+            filename
+            for filename in self.data_manager.list_files()
+            if filename.startswith(base + '/')
+        ]
+
+    def migrate_shards(self, shard_count: int) -> Dict[str, int]:
+        """
+        将用户、会话、通知数据迁移到新的分片数（包括从未分片的旧文件迁移）
+
+        应在服务停止时运行
 
-    def __init__(self):
-        self.data_manager = JSONDataManager()
-        self.users_file = 'users'
-        self.user_messages_file = 'user_messages'
-        self.statistics_file = 'statistics'
-        self.vip_users_file = 'vip_users'  # VIP用户数据文件
-        self.user_sessions_file = 'user_sessions'  # 用户会话状态文件（验证、菜谱录入等）
-        self.recipes_file = 'recipes'  # 菜谱数据文件
-        self.recipe_notifications_file = 'recipe_notifications'  # 菜谱通知记录文件
+        Args:
+            shard_count: 新的分片数，1 表示不分片
+
+        Returns:
+            Dict: 每个文档迁移的记录数
+        """
+        summary = {}
+        for base in self.sharded_files:
+            old_files = self._iter_shard_files(base)
+            records = {}
+            for filename in old_files:
+                records.update(self.data_manager.load_data(filename, {}))
+
+            shards: Dict[str, Dict] = {}
+            for openid, record in records.items():
+                shard_file = self._shard_name(
+                    base, self._shard_index(openid, shard_count), shard_count
+                )
+                shards.setdefault(shard_file, {})[openid] = record
+
+            for filename, data in shards.items():
+                self.data_manager.save_data(filename, data)
+            for filename in old_files:
+                if filename not in shards:
+                    self.data_manager.delete_file(filename)
+
+            summary[base] = len(records)
+            print(f'{base}: {len(records)} 条记录 -> {len(shards)} 个分片')
+
+        def update_layout(layout):
+            layout['user_shard_count'] = shard_count
+            return layout
+
+        self.data_manager.update_data(self.storage_layout_file, update_layout, {})
+        self.shard_count = shard_count
+        return summary
+
+    # ==================== 用户信息管理 ==================== #
 
     def save_user_info(self, openid: str, user_info: Dict) -> bool:
         """
-        保存用户信息
+        保存用户信息，并在同一个工作单元中更新用户属性索引
 
         Args:
             openid: 用户的openid
-            user_info: 用户信息字典
+            user_info: 用户信息字典（请传入新的字典，不要原地修改读取到的用户信息）
 
         Returns:
             bool: 保存是否成功
         """
+        # 添加时间戳
+        import time
 
-        def update_users(current_users):
-            if current_users is None:
-                current_users = {}
-
-            # 添加时间戳
-            import time
-
-            user_info['last_update'] = time.time()
-            user_info['last_update_str'] = time.strftime('%Y-%m-%d %H:%M:%S')
-
-            current_users[openid] = user_info
-            return current_users
+        user_info['last_update'] = time.time()
+        user_info['last_update_str'] = time.strftime('%Y-%m-%d %H:%M:%S')
 
-        return self.data_manager.update_data(self.users_file, update_users, {})
+        # 在外层工作单元中时随外层一起提交
+        with self.unit_of_work() as unit_of_work:
+            filename = self._shard_file(self.users_file, openid)
+            previous = self.store.get(filename, openid)
+            success = self.store.put(filename, openid, user_info) and self.user_index.update(
+                openid, previous, user_info
+            )
+        return success and unit_of_work.committed is not False
 
     def get_user_info(self, openid: str) -> Optional[Dict]:
         """
@@ -210,47 +2267,122 @@ class UserDataManager:
         Returns:
             Dict: 用户信息，不存在时返回None
         """
-        users = self.data_manager.load_data(self.users_file, {})
-        return users.get(openid)
+        return self.store.get(self._shard_file(self.users_file, openid), openid)
 
-    def record_user_message(self, openid: str, message_type: str, content: str) -> bool:
+    def iter_users(self):
         """
-        记录用户消息
+        逐个分片遍历所有用户信息
+
+        Returns:
+            Iterator: (openid, 用户信息) 迭代器
+        """
+        for filename in self._iter_shard_files(self.users_file):
+            yield from self.data_manager.load_data(filename, {}).items()
+
+    def find_unsubscribed_users(self, before: float) -> list:
+        """
+        查找在指定时间之前取消关注、之后没有重新关注的用户
 
         Args:
-            openid: 用户openid
-            message_type: 消息类型（text, image等）
-            content: 消息内容
+            before: 时间戳，取消关注时间早于该值的用户才会返回
 
         Returns:
-            bool: 记录是否成功
+            list: openid列表
+        """
+        openids = []
+        for openid in self.user_index.iter_openids({'status': 'unsubscribed'}):
+            user_info = self.get_user_info(openid) or {}
+            # 没有记录取消关注时间的旧数据以最后更新时间为准
+            unsubscribe_time = user_info.get('unsubscribe_time') or user_info.get('last_update')
+            try:
+                if float(unsubscribe_time) < before:
+                    openids.append(openid)
+            except (TypeError, ValueError):
+                continue
+        return openids
+
+    def count_users(
+        self,
+        status: str = None,
+        vip_status: str = None,
+        first_subscribe: bool = None,
+        subscribed_after: float = None,
+        subscribed_before: float = None,
+    ) -> int:
+        """
+        按属性统计用户数（从用户属性索引读取，不遍历用户信息）
+
+        Args:
+            status: 关注状态，如 subscribed / unsubscribed
+            vip_status: VIP状态，如 vip
+            first_subscribe: 是否首次关注
+            subscribed_after: 关注时间不早于该时间戳
+            subscribed_before: 关注时间早于该时间戳
+
+        Returns:
+            int: 满足所有条件的用户数
+        """
+        filters = self._user_filters(status, vip_status, first_subscribe)
+        return self.user_index.count(filters, subscribed_after, subscribed_before)
+
+    def list_users(
+        self,
+        status: str = None,
+        vip_status: str = None,
+        first_subscribe: bool = None,
+        subscribed_after: float = None,
+        subscribed_before: float = None,
+        offset: int = 0,
+        limit: int = 20,
+    ) -> list:
         """
+        按属性分页列出用户（有关注时间条件时按关注时间从新到旧排列）
 
-        def update_messages(current_messages):
-            if current_messages is None:
-                current_messages = {}
+        Args:
+            status: 关注状态，如 subscribed / unsubscribed
+            vip_status: VIP状态，如 vip
+            first_subscribe: 是否首次关注
+            subscribed_after: 关注时间不早于该时间戳
+            subscribed_before: 关注时间早于该时间戳
+            offset: 跳过的用户数
+            limit: 本页用户数
 
-            if openid not in current_messages:
-                current_messages[openid] = []
+        Returns:
+            list: openid列表
+        """
+        filters = self._user_filters(status, vip_status, first_subscribe)
+        return self.user_index.list_openids(
+            filters, subscribed_after, subscribed_before, offset, limit
+        )
 
-            import time
+    @staticmethod
+    def _user_filters(status, vip_status, first_subscribe) -> Dict:
+        """组装等值筛选条件，忽略未指定的属性"""
+        filters = {'status': status, 'vip_status': vip_status, 'first_subscribe': first_subscribe}
+        return {field: value for field, value in filters.items() if value is not None}
 
-            message_record = {
-                'type': message_type,
-                'content': content,
-                'timestamp': time.time(),
-                'time_str': time.strftime('%Y-%m-%d %H:%M:%S'),
-            }
+    def record_user_message(self, openid: str, message_type: str, content: str) -> bool:
+        """
+        记录用户消息
 
-            current_messages[openid].append(message_record)
+        Args:
+            openid: 用户openid
+            message_type: 消息类型（text, image等）
+            content: 消息内容
 
-            # 只保留最近100条消息
-            if len(current_messages[openid]) > 100:
-                current_messages[openid] = current_messages[openid][-100:]
+        Returns:
+            bool: 记录是否成功
+        """
+        import time
 
-            return current_messages
+        message_record = {
+            'type': message_type,
+            'content': content,
+            'timestamp': time.time(),
+            'time_str': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
 
-        return self.data_manager.update_data(self.user_messages_file, update_messages, {})
+        return self._run_after_commit(self.message_journal.append, openid, message_record)
 
     def get_user_messages(self, openid: str, limit: int = 10) -> list:
         """
@@ -263,9 +2395,23 @@ class UserDataManager:
         Returns:
             list: 消息历史列表
         """
-        all_messages = self.data_manager.load_data(self.user_messages_file, {})
-        user_messages = all_messages.get(openid, [])
-        return user_messages[-limit:] if limit > 0 else user_messages
+        return self.message_journal.get(openid, limit)
+
+    def get_user_message_history(
+        self, openid: str, limit: int = 20, before: Optional[float] = None
+    ) -> list:
+        """
+        分页获取用户的完整消息历史（包括冷归档中的旧消息）
+
+        Args:
+            openid: 用户openid
+            limit: 每页消息数
+            before: 只返回时间戳早于该值的消息，为None时从最新的消息开始
+
+        Returns:
+            list: 消息列表，按时间从旧到新；翻到下一页时以第一条消息的时间戳作为 before
+        """
+        return self.message_journal.get_history(openid, limit, before)
 
     def update_statistics(self, event_type: str) -> bool:
         """
@@ -278,72 +2424,148 @@ class UserDataManager:
             bool: 更新是否成功
         """
 
-        def update_stats(current_stats):
-            if current_stats is None:
-                current_stats = {}
-
-            import time
+        return self.statistics_counter.increment(event_type)
 
-            today = time.strftime('%Y-%m-%d')
+    def get_statistics(self) -> Dict:
+        """
+        获取统计数据（包含内存中尚未写入磁盘的计数）
 
-            # 初始化今日统计
-            if 'daily' not in current_stats:
-                current_stats['daily'] = {}
-            if today not in current_stats['daily']:
-                current_stats['daily'][today] = {}
+        Returns:
+            Dict: 统计数据
+        """
+        return self.statistics_counter.get_summary()
 
-            # 初始化总统计
-            if 'total' not in current_stats:
-                current_stats['total'] = {}
+    def query_statistics(
+        self,
+        event_type: str,
+        resolution: str = timeseries.HOUR,
+        start_time: float = None,
+        end_time: float = None,
+    ) -> Dict:
+        """
+        按小时/天/月查询某类事件的计数序列
 
-            # 更新统计
-            current_stats['daily'][today][event_type] = (
-                current_stats['daily'][today].get(event_type, 0) + 1
-            )
-            current_stats['total'][event_type] = current_stats['total'].get(event_type, 0) + 1
+        例如最近14天每小时的文本消息数：
+        query_statistics('text_message', 'hour', time.time() - 14 * 86400)
 
-            # 只保留最近30天的数据
-            import datetime
+        Args:
+            event_type: 事件类型（如：subscribe, unsubscribe, text_message等）
+            resolution: 时间粒度（hour/day/month）
+            start_time: 开始时间戳，默认为该粒度保留范围的起点
+            end_time: 结束时间戳，默认为当前时间
 
-            cutoff_date = (datetime.datetime.now() - datetime.timedelta(days=30)).strftime(
-                '%Y-%m-%d'
-            )
-            dates_to_remove = [date for date in current_stats['daily'].keys() if date < cutoff_date]
-            for date in dates_to_remove:
-                del current_stats['daily'][date]
+        Returns:
+            Dict: labels 为时间标签列表，counts 为对应的计数列表，total 为区间合计；
+                  超出保留范围的桶计数为0
+        """
+        if resolution not in timeseries.RESOLUTIONS:
+            raise ValueError(f'不支持的时间粒度: {resolution}')
+        if end_time is None:
+            end_time = time.time()
+        return self.statistics_counter.query(event_type, resolution, start_time, end_time)
 
-            return current_stats
+    def flush(self) -> bool:
+        """
+        将内存中尚未写入磁盘的数据立即写入（服务退出时调用）
 
-        return self.data_manager.update_data(self.statistics_file, update_stats, {})
+        Returns:
+            bool: 是否成功
+        """
+        statistics_flushed = self.statistics_counter.flush()
+        # 统计写入可能还在存储层的延迟写入队列中，最后统一落盘
+        return self.data_manager.flush() and statistics_flushed
 
-    def get_statistics(self) -> Dict:
+    def shutdown(self) -> bool:
         """
-        获取统计数据
+        停止后台线程并写入内存中的剩余数据（SIGTERM 处理和 atexit 中调用，可重复调用）
 
         Returns:
-            Dict: 统计数据
+            bool: 是否成功
         """
-        return self.data_manager.load_data(self.statistics_file, {})
+        self.session_store.stop()
+        statistics_flushed = self.statistics_counter.stop()
+        return self.data_manager.flush() and statistics_flushed
 
     # ==================== VIP用户管理功能 ==================== #
 
+    def _next_sequence(self, name: str, seed_func) -> int:
+        """
+        原子地递增持久化计数器并返回新值
+
+        直接提交到存储后端（不进入当前工作单元），在文档写锁/数据库事务内完成读取和递增，
+        并发请求（包括多进程）不会得到相同的值；所在工作单元回滚时该值作废，序列可能留有空号
+
+        Args:
+            name: 计数器名称
+            seed_func: 计数器不存在时返回初始值（已使用的最大值）的函数
+
+        Returns:
+            int: 递增后的值，失败时返回None
+        """
+        allocated = None
+
+        def increment(current):
+            nonlocal allocated
+            allocated = (seed_func() if current is None else current) + 1
+            return allocated
+
+        if not self.data_manager.update_key(self.counters_file, name, increment):
+            return None
+        return allocated
+
+    def _max_vip_number(self) -> int:
+        """已分配的最大VIP编号（仅在计数器不存在时用于初始化）"""
+        numbers = [0]
+        for vip_info in self.data_manager.load_data(self.vip_users_file, {}).values():
+            suffix = vip_info.get('vip_id', '').rpartition('-')[2]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+        return max(numbers)
+
     def _generate_vip_id(self) -> str:
         """
-        生成专属VIP ID
+        生成专属VIP ID（由持久化计数器分配，不会重复）
 
         Returns:
             str: 格式化的VIP ID，如 VIP-0001
         """
-        vip_users = self.data_manager.load_data(self.vip_users_file, {})
-        next_number = len(vip_users) + 1
+        next_number = self._next_sequence('vip_id', self._max_vip_number)
+        if next_number is None:
+            raise RuntimeError('分配VIP ID失败')
         return f'VIP-{next_number:04d}'
 
-    def verify_and_save_vip(self, openid: str) -> Dict:
+    def _get_vip_openids(self) -> set:
+        """
+        有效VIP用户的openid集合
+
+        load_data 在VIP文档未变化时返回同一个缓存对象（只检查文件签名），
+        返回新对象说明文档已被重新解析（如其他进程写入），此时重建集合
+        """
+        vip_users = self.data_manager.load_data(self.vip_users_file, {})
+        with self._vip_openids_lock:
+            if self._vip_openids is None or vip_users is not self._vip_source:
+                self._vip_source = vip_users
+                self._vip_openids = {
+                    openid
+                    for openid, vip_info in vip_users.items()
+                    if vip_info.get('status') == 'active'
+                }
+            return self._vip_openids
+
+    def _update_vip_openids(self, added=(), removed=()):
+        """本进程提交VIP变更后同步更新已加载的VIP集合"""
+        with self._vip_openids_lock:
+            if self._vip_openids is not None:
+                self._vip_openids.update(added)
+                self._vip_openids.difference_update(removed)
+
+    def verify_and_save_vip(self, openid: str, user_context: UserContext = None) -> Dict:
         """
         验证暗号并保存VIP用户信息
 
         Args:
             openid: 用户的openid
+            user_context: 请求级用户上下文，提供时复用其中的VIP信息和用户信息，并同步更新
 
         Returns:
             Dict: 包含验证结果的字典
@@ -353,8 +2575,11 @@ class UserDataManager:
         """
         import time
 
+        if user_context is None:
+            user_context = self.get_user_context(openid)
+
         # 检查是否已经是VIP用户
-        existing_vip = self.get_vip_info(openid)
+        existing_vip = user_context.vip_info
         if existing_vip:
             return {
                 'is_new': False,
@@ -377,21 +2602,26 @@ class UserDataManager:
         }
 
         # 保存VIP信息
-        def update_vip_users(current_vip_users):
-            if current_vip_users is None:
-                current_vip_users = {}
-            current_vip_users[openid] = vip_info
-            return current_vip_users
-
-        success = self.data_manager.update_data(self.vip_users_file, update_vip_users, {})
+        success = self.store.put(self.vip_users_file, openid, vip_info)
 
         if success:
+            user_context.vip_info = vip_info
+            self._run_after_commit(self._update_vip_openids, [openid])
+
+            # 成为VIP之后新增的菜谱才算作新菜谱通知
+            self.store.put(
+                self._shard_file(self.recipe_cursors_file, openid),
+                openid,
+                {'seen': self._get_latest_recipe_id(), 'own': 0},
+            )
+
             # 同时更新用户基本信息中的VIP状态
-            user_info = self.get_user_info(openid) or {}
+            user_info = dict(user_context.user_info or {})
             user_info['vip_status'] = 'vip'
             user_info['vip_id'] = vip_id
             user_info['vip_verify_time'] = verify_time_str
             self.save_user_info(openid, user_info)
+            user_context.user_info = user_info
 
             # 更新统计
             self.update_statistics('vip_verification')
@@ -410,21 +2640,25 @@ class UserDataManager:
         Returns:
             Dict: VIP用户信息，不存在时返回None
         """
-        vip_users = self.data_manager.load_data(self.vip_users_file, {})
-        return vip_users.get(openid)
+        return self.store.get(self.vip_users_file, openid)
 
     def is_vip_user(self, openid: str) -> bool:
         """
         检查用户是否是VIP
 
+        JSON后端查询内存中的VIP集合（VIP文档变化后自动重建，各进程结果一致）；
+        SQLite后端每次读取全表代价高，直接按主键查询该用户的VIP记录
+
         Args:
             openid: 用户的openid
 
         Returns:
             bool: 是否是VIP用户
         """
-        vip_info = self.get_vip_info(openid)
-        return vip_info is not None and vip_info.get('status') == 'active'
+        if not getattr(self.data_manager, 'caches_documents', False):
+            vip_info = self.get_vip_info(openid)
+            return vip_info is not None and vip_info.get('status') == 'active'
+        return openid in self._get_vip_openids()
 
     def get_all_vip_users(self) -> Dict:
         """
@@ -433,7 +2667,7 @@ class UserDataManager:
         Returns:
             Dict: 所有VIP用户信息
         """
-        return self.data_manager.load_data(self.vip_users_file, {})
+        return self.store.load_data(self.vip_users_file, {})
 
     def get_vip_count(self) -> int:
         """
@@ -442,7 +2676,7 @@ class UserDataManager:
         Returns:
             int: VIP用户总数
         """
-        vip_users = self.data_manager.load_data(self.vip_users_file, {})
+        vip_users = self.store.load_data(self.vip_users_file, {})
         return len(vip_users)
 
     def delete_user_data(self, openid: str) -> bool:
@@ -456,60 +2690,50 @@ class UserDataManager:
             bool: 删除是否成功
         """
         print(f'开始删除用户 {openid} 的所有数据...')
+        success = self.delete_users([openid])
+        if success:
+            print(f'用户 {openid} 的所有数据已删除')
+        return success
 
-        # 1. 删除用户基本信息
-        def delete_from_users(users):
-            if users and openid in users:
-                del users[openid]
-                print(f'已删除用户基本信息: {openid}')
-            return users or {}
-
-        self.data_manager.update_data(self.users_file, delete_from_users, {})
-
-        # 2. 删除用户消息记录
-        def delete_from_messages(messages):
-            if messages and openid in messages:
-                del messages[openid]
-                print(f'已删除用户消息记录: {openid}')
-            return messages or {}
-
-        self.data_manager.update_data(self.user_messages_file, delete_from_messages, {})
-
-        # 3. 删除VIP信息
-        def delete_from_vip(vip_users):
-            if vip_users and openid in vip_users:
-                del vip_users[openid]
-                print(f'已删除用户VIP信息: {openid}')
-            return vip_users or {}
-
-        self.data_manager.update_data(self.vip_users_file, delete_from_vip, {})
-
-        # 4. 删除用户会话状态
-        def delete_from_sessions(sessions):
-            if sessions and openid in sessions:
-                del sessions[openid]
-                print(f'已删除用户会话状态: {openid}')
-            return sessions or {}
+    def delete_users(self, openids) -> bool:
+        """
+        批量删除多个用户的所有相关数据
 
-        self.data_manager.update_data(self.user_sessions_file, delete_from_sessions, {})
+        所有文档的删除在一个工作单元中提交，每个涉及的文档（分片）只写入一次；
+        提交成功后再删除消息记录（日志追加一次、归档分段各重写一次）。
+        在外层工作单元中调用时随外层一起提交
 
-        # 5. 删除菜谱通知
-        def delete_from_notifications(notifications):
-            if notifications and openid in notifications:
-                del notifications[openid]
-                print(f'已删除用户菜谱通知: {openid}')
-            return notifications or {}
+        Args:
+            openids: 用户openid序列
 
-        self.data_manager.update_data(self.recipe_notifications_file, delete_from_notifications, {})
+        Returns:
+            bool: 删除是否成功
+        """
+        openids = list(dict.fromkeys(openids))
+        if not openids:
+            return True
 
-        print(f'用户 {openid} 的所有数据已删除')
-        return True
+        with self.unit_of_work() as unit_of_work:
+            self.user_index.remove_many({openid: self.get_user_info(openid) for openid in openids})
+            for openid in openids:
+                for base in self.sharded_files:
+                    self.store.delete(self._shard_file(base, openid), openid)
+                self.store.delete(self.vip_users_file, openid)
+            self._run_after_commit(self._update_vip_openids, (), openids)
+            self._run_after_commit(self._delete_user_messages, openids)
+        return unit_of_work.committed is not False
+
+    def _delete_user_messages(self, openids: list):
+        """删除用户的消息记录（包括冷归档）"""
+        deleted = self.message_journal.delete_many(openids)
+        if deleted:
+            print(f'已删除 {deleted} 个用户的消息记录')
 
     # ==================== 用户会话状态管理 ==================== #
 
     def set_user_session_state(self, openid: str, state: str, extra_data: Dict = None) -> bool:
         """
-        设置用户会话状态
+        设置用户会话状态（有效期由 consts.SESSION_TTL 按会话状态决定）
 
         Args:
             openid: 用户的openid
@@ -519,24 +2743,7 @@ class UserDataManager:
         Returns:
             bool: 是否成功
         """
-        import time
-
-        def update_sessions(current_sessions):
-            if current_sessions is None:
-                current_sessions = {}
-
-            session_data = {
-                'state': state,
-                'start_time': time.time(),
-                'start_time_str': time.strftime('%Y-%m-%d %H:%M:%S'),
-            }
-            if extra_data:
-                session_data.update(extra_data)
-
-            current_sessions[openid] = session_data
-            return current_sessions
-
-        return self.data_manager.update_data(self.user_sessions_file, update_sessions, {})
+        return self.session_store.set(openid, state, extra_data)
 
     def get_user_session_state(self, openid: str) -> Optional[Dict]:
         """
@@ -546,10 +2753,9 @@ class UserDataManager:
             openid: 用户的openid
 
         Returns:
-            Dict: 会话状态信息，不存在时返回None
+            Dict: 会话状态信息，不存在或已超过有效期时返回None
         """
-        sessions = self.data_manager.load_data(self.user_sessions_file, {})
-        return sessions.get(openid)
+        return self.session_store.get(openid)
 
     def clear_user_session_state(self, openid: str) -> bool:
         """
@@ -561,19 +2767,17 @@ class UserDataManager:
         Returns:
             bool: 是否成功
         """
-
-        def update_sessions(current_sessions):
-            if current_sessions is None:
-                current_sessions = {}
-            if openid in current_sessions:
-                del current_sessions[openid]
-            return current_sessions
-
-        return self.data_manager.update_data(self.user_sessions_file, update_sessions, {})
+        return self.session_store.clear(openid)
 
     # ==================== 菜谱管理功能 ==================== #
 
-    def add_recipe(self, openid: str, recipe_content: str, category: str = None) -> Dict:
+    def add_recipe(
+        self,
+        openid: str,
+        recipe_content: str,
+        category: str = None,
+        user_context: UserContext = None,
+    ) -> Dict:
         """
         添加菜谱
 
@@ -581,11 +2785,12 @@ class UserDataManager:
             openid: 用户的openid
             recipe_content: 菜谱内容
             category: 菜谱分类 ('meat' 或 'veg')
+            user_context: 请求级用户上下文，提供时复用其中的VIP信息
 
         Returns:
             Dict: 包含添加结果的字典
                   - success: bool, 是否成功
-                  - recipe_id: int, 菜谱ID
+                  - recipe_id: int, 菜谱ID（在工作单元中调用时提交成功后才填入，之前为None）
                   - recipe_name: str, 菜谱名称
         """
         import time
@@ -601,10 +2806,12 @@ class UserDataManager:
             recipe_name = recipe_name.split(':', 1)[1].strip()
 
         # 获取用户VIP信息用于显示创建者
-        vip_info = self.get_vip_info(openid)
+        vip_info = user_context.vip_info if user_context else self.get_vip_info(openid)
         creator_name = vip_info['vip_id'] if vip_info else openid[:8]
+        added_recipe = None
 
         def update_recipes(current_recipes):
+            nonlocal added_recipe
             if current_recipes is None:
                 current_recipes = {'list': [], 'next_id': 1}
 
@@ -621,70 +2828,98 @@ class UserDataManager:
                 'create_time_str': time.strftime('%Y-%m-%d %H:%M:%S'),
             }
 
+            # 分类索引与菜谱列表一起更新
+            category_ids = self._get_category_ids(current_recipes)
+            if category:
+                category_ids.setdefault(category, []).append(recipe_id)
+
             current_recipes['list'].append(recipe)
             current_recipes['next_id'] = recipe_id + 1
+            current_recipes['category_ids'] = category_ids
 
+            added_recipe = recipe
             return current_recipes
 
-        success = self.data_manager.update_data(
+        success = self.store.update_data(
             self.recipes_file, update_recipes, {'list': [], 'next_id': 1}
         )
 
+        result = {
+            'success': success,
+            'recipe_id': None,
+            'recipe_name': recipe_name,
+        }
+
+        def on_commit():
+            # 提交时在最新数据上重新执行了 update_recipes，added_recipe 是实际保存的菜谱
+            result['recipe_id'] = added_recipe['id']
+            self._catch_up_search_index()
+
         if success:
-            # 记录新菜谱通知（用于通知其他VIP用户）
-            self._record_new_recipe_notification(openid, recipe_name)
+            # 搜索索引只根据已提交的菜谱补建，未提交的菜谱序号在提交时可能改变
+            self._run_after_commit(on_commit)
+            # 菜谱序号递增即通知了其他VIP用户；创建者自己的菜谱不算未读
+            self.store.update_key(
+                self._shard_file(self.recipe_cursors_file, openid),
+                openid,
+                lambda cursor: dict(cursor, own=cursor['own'] + 1) if cursor else None,
+            )
             print(f'菜谱添加成功: {recipe_name} (分类: {category}) by {creator_name}')
 
-        recipes = self.data_manager.load_data(self.recipes_file, {'list': [], 'next_id': 1})
-        recipe_id = recipes['next_id'] - 1
+        return result
 
-        return {
-            'success': success,
-            'recipe_id': recipe_id,
-            'recipe_name': recipe_name,
-        }
+    def _get_latest_recipe_id(self) -> int:
+        """最新菜谱的序号（菜谱ID单调递增，即全局菜谱序列的当前值）"""
+        return self.store.get(self.recipes_file, 'next_id', 1) - 1
 
-    def _record_new_recipe_notification(self, creator_openid: str, recipe_name: str) -> bool:
+    def _migrate_recipe_notifications(self):
         """
-        记录新菜谱通知（用于通知其他VIP用户）
+        将旧版逐条保存的菜谱通知转换为已读游标（只执行一次）
 
-        Args:
-            creator_openid: 创建者openid
-            recipe_name: 菜谱名称
-
-        Returns:
-            bool: 是否成功
+        已读游标 = 当前菜谱序号 - 旧版未读通知数，迁移后删除旧的通知文件
         """
-        import time
+        layout = self.data_manager.load_data(self.storage_layout_file, {})
+        if layout.get('recipe_read_cursors'):
+            return
 
-        # 获取所有VIP用户，为他们记录通知
-        vip_users = self.get_all_vip_users()
+        legacy_files = self._iter_shard_files(self.recipe_notifications_file)
+        notifications = {}
+        for filename in legacy_files:
+            notifications.update(self.data_manager.load_data(filename, {}))
 
-        def update_notifications(current_notifications):
-            if current_notifications is None:
-                current_notifications = {}
+        latest_id = self._get_latest_recipe_id()
+        for openid in self.data_manager.load_data(self.vip_users_file, {}):
+            unread = len(notifications.get(openid, []))
+            self.data_manager.put(
+                self._shard_file(self.recipe_cursors_file, openid),
+                openid,
+                {'seen': max(latest_id - unread, 0), 'own': 0},
+            )
+        for filename in legacy_files:
+            self.data_manager.delete_file(filename)
 
-            for openid in vip_users.keys():
-                # 不通知创建者自己
-                if openid == creator_openid:
-                    continue
+        def update_layout(layout):
+            layout['recipe_read_cursors'] = True
+            return layout
 
-                if openid not in current_notifications:
-                    current_notifications[openid] = []
+        self.data_manager.update_data(self.storage_layout_file, update_layout, {})
+        if legacy_files:
+            print(f'已将 {len(notifications)} 个用户的菜谱通知迁移为已读游标')
 
-                current_notifications[openid].append(
-                    {
-                        'recipe_name': recipe_name,
-                        'time': time.time(),
-                        'time_str': time.strftime('%Y-%m-%d %H:%M:%S'),
-                    }
-                )
+    def _migrate_recipe_category_ids(self):
+        """为没有分类索引的旧版菜谱数据补建并保存分类索引（只执行一次）"""
+        recipes = self.data_manager.load_data(self.recipes_file, None)
+        if not isinstance(recipes, dict) or 'category_ids' in recipes:
+            return
 
-            return current_notifications
+        def add_category_ids(current):
+            # 其他进程可能已经补建或新增了菜谱，在最新数据上构建
+            if 'category_ids' not in current:
+                current['category_ids'] = self._build_category_ids(current.get('list', []))
+            return current
 
-        return self.data_manager.update_data(
-            self.recipe_notifications_file, update_notifications, {}
-        )
+        if self.data_manager.update_data(self.recipes_file, add_category_ids, {}):
+            print(f'已为 {len(recipes.get("list", []))} 个菜谱建立分类索引')
 
     def get_new_recipe_notifications(self, openid: str) -> list:
         """
@@ -694,31 +2929,62 @@ class UserDataManager:
             openid: 用户的openid
 
         Returns:
-            list: 新菜谱通知列表
+            list: 新菜谱通知列表（已读游标之后、非本人创建的菜谱）
         """
-        notifications = self.data_manager.load_data(self.recipe_notifications_file, {})
-        return notifications.get(openid, [])
+        cursor = self.store.get(self._shard_file(self.recipe_cursors_file, openid), openid)
+        if cursor is None:
+            return []
 
-    def clear_recipe_notifications(self, openid: str) -> bool:
+        notifications = []
+        for recipe in reversed(self.get_recipe_list()):
+            if recipe['id'] <= cursor['seen']:
+                break
+            if recipe.get('creator_openid') != openid:
+                notifications.append(
+                    {
+                        'recipe_name': recipe['name'],
+                        'time': recipe.get('create_time'),
+                        'time_str': recipe.get('create_time_str'),
+                    }
+                )
+        notifications.reverse()
+        return notifications
+
+    def get_unread_recipe_count(self, openid: str) -> int:
         """
-        清除用户的菜谱通知
+        获取用户未读的新菜谱通知数
 
         Args:
             openid: 用户的openid
 
         Returns:
-            bool: 是否成功
+            int: 未读通知数 = 最新菜谱序号 - 已读游标 - 游标之后本人创建的菜谱数
+        """
+        cursor = self.store.get(self._shard_file(self.recipe_cursors_file, openid), openid)
+        if cursor is None:
+            return 0
+        return max(self._get_latest_recipe_id() - cursor['seen'] - cursor['own'], 0)
+
+    def clear_recipe_notifications(self, openid: str) -> bool:
         """
+        清除用户的菜谱通知（已读游标移动到最新菜谱）
 
-        def update_notifications(current_notifications):
-            if current_notifications is None:
-                current_notifications = {}
-            if openid in current_notifications:
-                del current_notifications[openid]
-            return current_notifications
+        Args:
+            openid: 用户的openid
 
-        return self.data_manager.update_data(
-            self.recipe_notifications_file, update_notifications, {}
+        Returns:
+            bool: 是否成功
+        """
+        cursor_file = self._shard_file(self.recipe_cursors_file, openid)
+        cursor = self.store.get(cursor_file, openid)
+        latest_id = self._get_latest_recipe_id()
+        if cursor is None or (cursor['seen'] == latest_id and cursor['own'] == 0):
+            # 不是VIP，或者没有未读菜谱
+            return True
+        return self.store.update_key(
+            cursor_file,
+            openid,
+            lambda cursor: {'seen': latest_id, 'own': 0} if cursor else None,
         )
 
     def get_recipe_list(self) -> list:
@@ -728,9 +2994,70 @@ class UserDataManager:
         Returns:
             list: 菜谱列表
         """
-        recipes = self.data_manager.load_data(self.recipes_file, {'list': [], 'next_id': 1})
+        recipes = self.store.load_data(self.recipes_file, {'list': [], 'next_id': 1})
         return recipes.get('list', [])
 
+    def get_recipe_version(self) -> int:
+        """
+        获取菜谱列表版本号（菜谱只由 add_recipe 追加，最新菜谱序号变化即列表变化）
+
+        Returns:
+            int: 菜谱列表版本号
+        """
+        return self._get_latest_recipe_id()
+
+    def search_recipes(self, keyword: str, limit: int = None) -> list:
+        """
+        按关键词搜索菜谱（菜名和内容），结果按相关度排序
+
+        只读取关键词对应的倒排列表，不逐个扫描菜谱内容
+
+        Args:
+            keyword: 搜索关键词
+            limit: 最多返回的结果数，默认为 consts.RECIPE_SEARCH_LIMIT
+
+        Returns:
+            list: 菜谱列表
+        """
+        if limit is None:
+            limit = consts.RECIPE_SEARCH_LIMIT
+
+        recipe_list = self.get_recipe_list()
+        index_data = self.data_manager.load_data(self.recipe_search_file, {})
+        latest_id = self.data_manager.get(self.recipes_file, 'next_id', 1) - 1
+        if index_data.get('indexed_id', 0) < latest_id:
+            # 旧数据没有索引，或有菜谱未被索引（如添加后进程退出）：只补建缺失的部分
+            index_data = self._catch_up_search_index()
+
+        recipe_ids = RecipeSearchIndex(index_data).search(keyword, limit)
+        return [
+            recipe
+            for recipe in (self._find_recipe_by_id(recipe_list, i) for i in recipe_ids)
+            if recipe is not None
+        ]
+
+    def _catch_up_search_index(self) -> Dict:
+        """
+        将已提交但尚未索引的菜谱加入搜索索引
+
+        只读取已提交的菜谱，不受工作单元中尚未提交的菜谱影响
+
+        Returns:
+            Dict: 补建后的索引数据
+        """
+        recipe_list = self.data_manager.load_data(self.recipes_file, {}).get('list', [])
+
+        def catch_up(current_index):
+            index = RecipeSearchIndex(current_index)
+            start = index.indexed_id
+            for recipe in recipe_list[start:]:
+                if recipe['id'] > start:
+                    index.add(recipe)
+            return index.to_dict()
+
+        self.data_manager.update_data(self.recipe_search_file, catch_up, {})
+        return self.data_manager.load_data(self.recipe_search_file, {})
+
     def get_recipe_by_index(self, index: int) -> Optional[Dict]:
         """
         通过序号获取菜谱（序号从1开始）
@@ -760,6 +3087,39 @@ class UserDataManager:
             return None
         return random.choice(recipe_list)
 
+    @staticmethod
+    def _build_category_ids(recipe_list: list) -> Dict[str, list]:
+        """从菜谱列表构建分类索引（分类 -> 菜谱ID列表）"""
+        category_ids = {}
+        for recipe in recipe_list:
+            if recipe.get('category'):
+                category_ids.setdefault(recipe['category'], []).append(recipe['id'])
+        return category_ids
+
+    @staticmethod
+    def _get_category_ids(recipes: Dict) -> Dict[str, list]:
+        """获取分类索引（分类 -> 菜谱ID列表），启动时已为旧数据补建"""
+        return recipes.get('category_ids', {})
+
+    @staticmethod
+    def _find_recipe_by_id(recipe_list: list, recipe_id: int) -> Optional[Dict]:
+        """按ID查找菜谱：菜谱只追加不删除，ID与位置一一对应，直接按位置访问"""
+        if 1 <= recipe_id <= len(recipe_list) and recipe_list[recipe_id - 1]['id'] == recipe_id:
+            return recipe_list[recipe_id - 1]
+        for recipe in recipe_list:
+            if recipe['id'] == recipe_id:
+                return recipe
+        return None
+
+    def _pick_random_recipe(self, recipes: Dict, category: str) -> Optional[Dict]:
+        """从已加载的菜谱数据中按分类索引随机取一个菜谱"""
+        import random
+
+        recipe_ids = self._get_category_ids(recipes).get(category)
+        if not recipe_ids:
+            return None
+        return self._find_recipe_by_id(recipes.get('list', []), random.choice(recipe_ids))
+
     def get_random_recipe_by_category(self, category: str) -> Optional[Dict]:
         """
         按分类获取随机菜谱
@@ -770,18 +3130,12 @@ class UserDataManager:
         Returns:
             Dict: 随机菜谱信息，该分类为空时返回None
         """
-        import random
-
-        recipe_list = self.get_recipe_list()
-        # 筛选指定分类的菜谱
-        category_recipes = [r for r in recipe_list if r.get('category') == category]
-        if not category_recipes:
-            return None
-        return random.choice(category_recipes)
+        recipes = self.store.load_data(self.recipes_file, {'list': [], 'next_id': 1})
+        return self._pick_random_recipe(recipes, category)
 
     def get_random_recipe_pair(self) -> Dict:
         """
-        获取一荤一素的随机菜谱组合
+        获取一荤一素的随机菜谱组合（只读取一次菜谱数据）
 
         Returns:
             Dict: 包含荤菜和素菜的字典
@@ -789,8 +3143,9 @@ class UserDataManager:
                   - veg: Dict 或 None, 随机素菜
                   - has_any: bool, 是否至少有一个菜谱
         """
-        meat_recipe = self.get_random_recipe_by_category('meat')
-        veg_recipe = self.get_random_recipe_by_category('veg')
+        recipes = self.store.load_data(self.recipes_file, {'list': [], 'next_id': 1})
+        meat_recipe = self._pick_random_recipe(recipes, consts.RecipeCategory.MEAT)
+        veg_recipe = self._pick_random_recipe(recipes, consts.RecipeCategory.VEGETABLE)
 
         return {
             'meat': meat_recipe,
@@ -808,6 +3163,20 @@ class UserDataManager:
         return len(self.get_recipe_list())
 
 
-# 全局实例
-data_manager = JSONDataManager()
-user_data_manager = UserDataManager()
+# 全局实例在首次访问时创建（from data_manager import user_data_manager 同样适用），
+# 只导入存储后端类（如性能测试脚本）时不会读写 data 目录或执行数据迁移
+_global_instances_lock = Lock()
+_global_instance_factories = {
+    'data_manager': create_data_manager,
+    'user_data_manager': UserDataManager,
+}
+
+
+def __getattr__(name: str):
+    factory = _global_instance_factories.get(name)
+    if factory is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    with _global_instances_lock:
+        if name not in globals():
+            globals()[name] = factory()
+    return globals()[name]
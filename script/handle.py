@@ -8,6 +8,10 @@ from xml_templates import WeChatXMLTemplate
 import consts
 from data_manager import user_data_manager, data_manager
 
+# 已渲染的菜谱列表分页缓存：页码 -> (菜谱列表版本号, 回复文本)
+# 版本号随 add_recipe 变化，缓存随之失效；同一版本下重复查看不再重新渲染
+_recipe_page_cache = {}
+
 
 class Handle(object):
     def __init__(self):
@@ -49,8 +53,16 @@ class Handle(object):
             if not recMsg:
                 return 'success'
 
-            # 根据消息类型分发处理
-            return self._dispatch_message(recMsg)
+            # 根据消息类型分发处理，本次请求的所有数据修改在处理结束后一次性提交
+            with user_data_manager.unit_of_work() as unit_of_work:
+                reply = self._dispatch_message(recMsg)
+
+            # 提交失败时回复已生成的成功提示会误导用户，改为提示重试
+            if unit_of_work.committed is False:
+                return self._create_text_response(
+                    recMsg.FromUserName, recMsg.ToUserName, consts.SAVE_FAILED
+                )
+            return reply
 
         except Exception as e:
             return self._handle_exception(e)
@@ -73,27 +85,29 @@ class Handle(object):
 
     def _dispatch_message(self, recMsg):
         """根据消息类型分发处理"""
+        # 请求级用户上下文，VIP信息、会话状态等在本次请求中最多读取一次
+        user_context = user_data_manager.get_user_context(recMsg.FromUserName)
         if isinstance(recMsg, receive.Msg):
-            return self._handle_message(recMsg)
+            return self._handle_message(recMsg, user_context)
         elif isinstance(recMsg, receive.EventMsg):
-            return self._handle_event(recMsg)
+            return self._handle_event(recMsg, user_context)
         else:
             print('不支持的消息类型：', getattr(recMsg, 'MsgType', 'Unknown'))
             return 'success'
 
-    def _handle_message(self, recMsg):
+    def _handle_message(self, recMsg, user_context):
         """处理普通消息"""
         msg_type = recMsg.MsgType
 
         if msg_type == consts.WeChatMsgType.TEXT:
-            return self._handle_text_message(recMsg)
+            return self._handle_text_message(recMsg, user_context)
         elif msg_type == consts.WeChatMsgType.IMAGE:
             return self._handle_image_message(recMsg)
         else:
             print(f'不支持的消息类型: {msg_type}')
             return 'success'
 
-    def _handle_event(self, recMsg):
+    def _handle_event(self, recMsg, user_context):
         """处理事件消息"""
         event_type = recMsg.Event
 
@@ -101,9 +115,9 @@ class Handle(object):
         print(f'用户OpenID: {recMsg.FromUserName}')
 
         if event_type == consts.WeChatEventType.SUBSCRIBE:
-            return self._handle_subscribe_event(recMsg)
+            return self._handle_subscribe_event(recMsg, user_context)
         elif event_type == consts.WeChatEventType.UNSUBSCRIBE:
-            return self._handle_unsubscribe_event(recMsg)
+            return self._handle_unsubscribe_event(recMsg, user_context)
         else:
             print(f'未处理的事件类型: {event_type}')
             return 'success'
@@ -116,7 +130,7 @@ class Handle(object):
         traceback.print_exc()
         return 'success'  # 返回success避免微信重复推送
 
-    def _handle_text_message(self, recMsg):
+    def _handle_text_message(self, recMsg, user_context):
         """处理文本消息"""
         toUser = recMsg.FromUserName
         fromUser = recMsg.ToUserName
@@ -131,36 +145,38 @@ class Handle(object):
         user_data_manager.update_statistics('text_message')
 
         # 首先检查用户是否处于验证会话中
-        verify_reply = self._handle_verify_session(toUser, user_content)
+        verify_reply = self._handle_verify_session(user_context, user_content)
         if verify_reply:
             return self._create_text_response(toUser, fromUser, verify_reply)
 
         # 检查用户是否处于菜谱录入模式
-        recipe_reply = self._handle_recipe_session(toUser, user_content)
+        recipe_reply = self._handle_recipe_session(user_context, user_content)
         if recipe_reply:
             return self._create_text_response(toUser, fromUser, recipe_reply)
 
         # 根据用户输入生成回复内容
-        reply_content = self._generate_text_reply(toUser, user_content)
+        reply_content = self._generate_text_reply(user_context, user_content)
 
         # 检查是否有新菜谱通知需要附加
-        reply_content = self._append_recipe_notification(toUser, reply_content)
+        reply_content = self._append_recipe_notification(user_context, reply_content)
 
         return self._create_text_response(toUser, fromUser, reply_content)
 
-    def _handle_verify_session(self, user_openid, user_content):
+    def _handle_verify_session(self, user_context, user_content):
         """
         处理验证会话中的用户输入
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
             user_content: 用户发送的消息内容
 
         Returns:
             str: 如果用户在验证会话中返回验证结果消息，否则返回None
         """
+        user_openid = user_context.openid
+
         # 检查用户是否在验证会话中
-        session = user_data_manager.get_user_session_state(user_openid)
+        session = user_context.session
 
         if not session or session.get('state') != consts.SessionState.WAITING_VERIFY:
             # 用户不在验证会话中，不处理
@@ -189,7 +205,7 @@ class Handle(object):
             user_data_manager.clear_user_session_state(user_openid)
 
             # 调用VIP验证和保存
-            result = user_data_manager.verify_and_save_vip(user_openid)
+            result = user_data_manager.verify_and_save_vip(user_openid, user_context)
 
             if result['is_new']:
                 # 新VIP用户
@@ -210,7 +226,7 @@ class Handle(object):
             print(f'用户 {user_openid} 输入了错误的暗号: {user_content}')
             return consts.SECRET_CODE_WRONG
 
-    def _generate_text_reply(self, user_openid, user_content):
+    def _generate_text_reply(self, user_context, user_content):
         """根据用户输入生成回复内容"""
         # 统一转换为小写用于关键词匹配
         content_lower = user_content.lower()
@@ -223,7 +239,7 @@ class Handle(object):
         # ==================== 2. 精确匹配命令 ==================== #
         # 验证相关关键词
         if content_lower in consts.Commands.VERIFY_KEYWORDS:
-            return self._handle_verify_keyword(user_openid)
+            return self._handle_verify_keyword(user_context)
 
         # 帮助菜单关键词
         if content_lower in consts.Commands.HELP_KEYWORDS:
@@ -233,9 +249,9 @@ class Handle(object):
         if user_content == consts.Commands.RECIPE_MENU:
             return consts.RECIPE_MENU_MESSAGE
         if user_content == consts.Commands.RECIPE_VIEW_LIST:
-            return self._handle_view_recipe_list(user_openid)
+            return self._handle_view_recipe_list(user_context)
         if user_content == consts.Commands.RECIPE_ADD:
-            return self._handle_start_recipe_input(user_openid)
+            return self._handle_start_recipe_input(user_context)
         if user_content == consts.Commands.RECIPE_RANDOM:
             return self._handle_random_recipe()
 
@@ -244,7 +260,19 @@ class Handle(object):
         if user_content.startswith(consts.Commands.RECIPE_ADD_PREFIX):
             recipe_content = user_content[len(consts.Commands.RECIPE_ADD_PREFIX) :].strip()
             if recipe_content:
-                return self._handle_quick_add_recipe(user_openid, recipe_content)
+                return self._handle_quick_add_recipe(user_context, recipe_content)
+
+        # 搜索菜谱：搜菜谱 + 关键词（如 "搜菜谱 红烧"）
+        if user_content.startswith(consts.Commands.RECIPE_SEARCH_PREFIX):
+            keyword = user_content[len(consts.Commands.RECIPE_SEARCH_PREFIX) :].strip()
+            if keyword:
+                return self._handle_search_recipe(user_context, keyword)
+
+        # 菜谱列表翻页：查看菜谱 + 页码（如 "查看菜谱 2"）
+        if user_content.startswith(consts.Commands.RECIPE_VIEW_LIST_PREFIX):
+            page = user_content[len(consts.Commands.RECIPE_VIEW_LIST_PREFIX) :].strip()
+            if page.isdigit():
+                return self._handle_view_recipe_list(user_context, int(page))
 
         # 菜谱详情：菜谱 + 序号（如 "菜谱 1"）
         if user_content.startswith(consts.Commands.RECIPE_DETAIL_PREFIX):
@@ -255,10 +283,10 @@ class Handle(object):
         # ==================== 4. 模糊匹配命令 ==================== #
         # 查看VIP信息
         if consts.Commands.VIP_INFO_KEYWORD in content_lower:
-            return self._handle_vip_info_query(user_openid)
+            return self._handle_vip_info_query(user_context)
 
         # ==================== 5. 默认回复（最低优先级） ==================== #
-        return self._generate_default_reply(user_openid, user_content, content_lower)
+        return self._generate_default_reply(user_context, user_content, content_lower)
 
     def _check_custom_reply_rules(self, user_content):
         """
@@ -302,17 +330,17 @@ class Handle(object):
         except ValueError:
             return None
 
-    def _handle_vip_info_query(self, user_openid):
+    def _handle_vip_info_query(self, user_context):
         """
         处理VIP信息查询
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
 
         Returns:
             str: VIP信息回复
         """
-        vip_info = user_data_manager.get_vip_info(user_openid)
+        vip_info = user_context.vip_info
         if not vip_info:
             return consts.NOT_VIP_MESSAGE
 
@@ -323,20 +351,19 @@ class Handle(object):
             status=status,
         )
 
-    def _generate_default_reply(self, user_openid, user_content, content_lower):
+    def _generate_default_reply(self, user_context, user_content, content_lower):
         """
         生成默认回复
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
             user_content: 用户发送的消息内容
             content_lower: 小写形式的消息内容
 
         Returns:
             str: 默认回复内容
         """
-        is_vip = user_data_manager.is_vip_user(user_openid)
-        vip_prefix = consts.VIP_PREFIX if is_vip else ''
+        vip_prefix = consts.VIP_PREFIX if user_context.is_vip else ''
 
         # 问候语回复
         if any(keyword in content_lower for keyword in consts.Commands.GREETING_KEYWORDS):
@@ -347,19 +374,19 @@ class Handle(object):
 
     # ==================== 菜谱功能处理方法 ==================== #
 
-    def _handle_recipe_session(self, user_openid, user_content):
+    def _handle_recipe_session(self, user_context, user_content):
         """
         处理菜谱录入会话中的用户输入
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
             user_content: 用户发送的消息内容
 
         Returns:
             str: 如果用户在菜谱录入会话中返回处理结果消息，否则返回None
         """
         # 检查用户会话状态
-        session = user_data_manager.get_user_session_state(user_openid)
+        session = user_context.session
         if not session:
             return None
 
@@ -367,11 +394,11 @@ class Handle(object):
 
         # 处理等待菜谱内容的状态
         if state == consts.SessionState.WAITING_RECIPE:
-            return self._handle_waiting_recipe_content(user_openid, user_content)
+            return self._handle_waiting_recipe_content(user_context.openid, user_content)
 
         # 处理等待选择分类的状态
         if state == consts.SessionState.WAITING_RECIPE_CATEGORY:
-            return self._handle_waiting_recipe_category(user_openid, user_content, session)
+            return self._handle_waiting_recipe_category(user_context, user_content, session)
 
         return None
 
@@ -401,8 +428,10 @@ class Handle(object):
         print(f'用户 {user_openid} 输入菜谱: {recipe_name}，等待选择分类')
         return consts.RECIPE_CATEGORY_PROMPT.format(recipe_name=recipe_name)
 
-    def _handle_waiting_recipe_category(self, user_openid, user_content, session):
+    def _handle_waiting_recipe_category(self, user_context, user_content, session):
         """处理等待选择菜谱分类"""
+        user_openid = user_context.openid
+
         # 用户发送取消
         if user_content in consts.Commands.CANCEL_KEYWORDS:
             user_data_manager.clear_user_session_state(user_openid)
@@ -419,7 +448,7 @@ class Handle(object):
         recipe_name = session.get('recipe_name', '')
 
         # 保存菜谱（带分类）
-        result = user_data_manager.add_recipe(user_openid, recipe_content, category)
+        result = user_data_manager.add_recipe(user_openid, recipe_content, category, user_context)
 
         # 清除会话状态
         user_data_manager.clear_user_session_state(user_openid)
@@ -433,41 +462,45 @@ class Handle(object):
         else:
             return consts.RECIPE_ADD_FAILED
 
-    def _handle_start_recipe_input(self, user_openid):
+    def _handle_start_recipe_input(self, user_context):
         """
         开始菜谱录入流程（VIP专属）
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
 
         Returns:
             str: 回复消息
         """
         # 检查是否是VIP用户
-        if not user_data_manager.is_vip_user(user_openid):
+        if not user_context.is_vip:
             return consts.RECIPE_VIP_ONLY
 
+        user_openid = user_context.openid
+
         # 设置用户会话状态为等待菜谱输入
         user_data_manager.set_user_session_state(user_openid, consts.SessionState.WAITING_RECIPE)
 
         print(f'用户 {user_openid} 进入菜谱录入模式')
         return consts.RECIPE_INPUT_PROMPT
 
-    def _handle_quick_add_recipe(self, user_openid, recipe_content):
+    def _handle_quick_add_recipe(self, user_context, recipe_content):
         """
         快捷记录菜谱（VIP专属）- 进入分类选择流程
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
             recipe_content: 菜谱内容
 
         Returns:
             str: 回复消息
         """
         # 检查是否是VIP用户
-        if not user_data_manager.is_vip_user(user_openid):
+        if not user_context.is_vip:
             return consts.RECIPE_VIP_ONLY
 
+        user_openid = user_context.openid
+
         # 解析菜名（用于提示）
         lines = recipe_content.strip().split('\n')
         recipe_name = lines[0].strip()
@@ -486,24 +519,92 @@ class Handle(object):
         print(f'用户 {user_openid} 快捷输入菜谱: {recipe_name}，等待选择分类')
         return consts.RECIPE_CATEGORY_PROMPT.format(recipe_name=recipe_name)
 
-    def _handle_view_recipe_list(self, user_openid):
+    def _handle_view_recipe_list(self, user_context, page=1):
         """
-        处理查看菜谱列表
+        处理查看菜谱列表（分页）
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
+            page: 页码（从1开始）
 
         Returns:
             str: 回复消息
         """
-        recipe_list = user_data_manager.get_recipe_list()
+        version = user_data_manager.get_recipe_version()
+        cached = _recipe_page_cache.get(page)
+        if cached and cached[0] == version:
+            reply = cached[1]
+        else:
+            recipe_list = user_data_manager.get_recipe_list()
+            if not recipe_list:
+                return consts.RECIPE_LIST_EMPTY
+
+            total_pages = -(-len(recipe_list) // consts.RECIPE_PAGE_SIZE)
+            if not 1 <= page <= total_pages:
+                return consts.RECIPE_PAGE_INVALID.format(total_pages=total_pages)
+
+            reply = self._render_recipe_page(recipe_list, page, total_pages)
+            _recipe_page_cache[page] = (version, reply)
+
+        # 清除用户的菜谱通知（已查看）
+        user_data_manager.clear_recipe_notifications(user_context.openid)
+        user_context.unread_recipe_count = 0
+
+        return reply
+
+    def _render_recipe_page(self, recipe_list, page, total_pages):
+        """
+        渲染一页菜谱列表
+
+        每页菜谱数固定，每行按字节预算截断过长的菜名，保证整页不超过微信文本消息的长度限制
+
+        Args:
+            recipe_list: 完整菜谱列表
+            page: 页码（从1开始）
+            total_pages: 总页数
+
+        Returns:
+            str: 回复消息
+        """
+        page_size = consts.RECIPE_PAGE_SIZE
+        start = (page - 1) * page_size
+        page_recipes = recipe_list[start : start + page_size]
+
+        def render(recipe_list_text):
+            return consts.RECIPE_LIST_TEMPLATE.format(
+                recipe_list=recipe_list_text,
+                page=page,
+                total_pages=total_pages,
+                total=len(recipe_list),
+            )
+
+        return self._render_recipe_lines(render, enumerate(page_recipes, start + 1), page_size)
+
+    def _render_recipe_lines(self, render, numbered_recipes, max_lines, reserved_bytes=0):
+        """
+        渲染菜谱列表行并套用模板
+
+        模板本身、行间换行和预留部分之外的字节平均分给每一行，按字节预算截断过长的菜名，
+        保证回复不超过微信文本消息的长度限制
 
-        if not recipe_list:
-            return consts.RECIPE_LIST_EMPTY
+        Args:
+            render: 模板函数，接收菜谱列表文本，返回完整回复
+            numbered_recipes: (序号, 菜谱) 列表
+            max_lines: 最多的行数（用于计算每行的字节预算）
+            reserved_bytes: 为之后附加到回复末尾的内容（如新菜谱通知）预留的字节数
+
+        Returns:
+            str: 回复消息
+        """
+        line_budget = (
+            consts.WECHAT_TEXT_MAX_BYTES
+            - len(render('').encode('utf-8'))
+            - (max_lines - 1)
+            - reserved_bytes
+        ) // max_lines
 
-        # 构建菜谱列表文本
         recipe_lines = []
-        for i, recipe in enumerate(recipe_list, 1):
+        for i, recipe in numbered_recipes:
             # 格式化日期，只显示月-日
             create_date = recipe.get('create_time_str', '')[:10]
             if create_date:
@@ -521,17 +622,63 @@ class Handle(object):
             else:
                 category_icon = '📝'
 
-            recipe_lines.append(f'{i}. {category_icon} {recipe["name"]} ({create_date})')
+            prefix = f'{i}. {category_icon} '
+            suffix = f' ({create_date})'
+            name_budget = line_budget - len((prefix + suffix).encode('utf-8'))
+            name = self._truncate_utf8(recipe['name'], name_budget)
+            recipe_lines.append(f'{prefix}{name}{suffix}')
 
-        recipe_list_text = '\n'.join(recipe_lines)
+        return render('\n'.join(recipe_lines))
 
-        # 清除用户的菜谱通知（已查看）
-        user_data_manager.clear_recipe_notifications(user_openid)
+    def _handle_search_recipe(self, user_context, keyword):
+        """
+        处理搜索菜谱
+
+        Args:
+            user_context: 请求级用户上下文（用于为新菜谱通知预留长度）
+            keyword: 搜索关键词
+
+        Returns:
+            str: 回复消息
+        """
+        keyword = self._truncate_utf8(keyword, 60)
+        recipes = user_data_manager.search_recipes(keyword)
+        if not recipes:
+            return consts.RECIPE_SEARCH_EMPTY.format(keyword=keyword)
+
+        def render(recipe_list_text):
+            return consts.RECIPE_SEARCH_TEMPLATE.format(
+                keyword=keyword, recipe_list=recipe_list_text, count=len(recipes)
+            )
 
-        return consts.RECIPE_LIST_TEMPLATE.format(
-            recipe_list=recipe_list_text, total=len(recipe_list)
+        # 菜谱ID与列表序号一致，可直接用于「菜谱 序号」；回复之后还会附加新菜谱通知
+        notification = self._recipe_notification(user_context)
+        return self._render_recipe_lines(
+            render,
+            [(recipe['id'], recipe) for recipe in recipes],
+            consts.RECIPE_SEARCH_LIMIT,
+            len(notification.encode('utf-8')),
         )
 
+    @staticmethod
+    def _truncate_utf8(text, max_bytes):
+        """
+        按UTF-8字节数截断文本，超出时以省略号结尾（不会截断在多字节字符中间）
+
+        Args:
+            text: 原始文本
+            max_bytes: 最大字节数
+
+        Returns:
+            str: 截断后的文本
+        """
+        encoded = text.encode('utf-8')
+        if len(encoded) <= max_bytes:
+            return text
+        ellipsis = '…'
+        keep = max(max_bytes - len(ellipsis.encode('utf-8')), 0)
+        return encoded[:keep].decode('utf-8', errors='ignore') + ellipsis
+
     def _handle_view_recipe_detail(self, index):
         """
         处理查看菜谱详情
@@ -604,45 +751,52 @@ class Handle(object):
             meat_section=meat_section, veg_section=veg_section
         )
 
-    def _append_recipe_notification(self, user_openid, reply_content):
+    def _append_recipe_notification(self, user_context, reply_content):
         """
         检查并附加新菜谱通知
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
             reply_content: 原始回复内容
 
         Returns:
             str: 附加通知后的回复内容
         """
-        # 只对VIP用户检查通知
-        if not user_data_manager.is_vip_user(user_openid):
-            return reply_content
+        return reply_content + self._recipe_notification(user_context)
 
-        # 获取未读通知
-        notifications = user_data_manager.get_new_recipe_notifications(user_openid)
+    def _recipe_notification(self, user_context):
+        """
+        新菜谱通知文本
 
-        if notifications:
-            # 附加通知
-            return reply_content + consts.NEW_RECIPE_NOTIFICATION.format(count=len(notifications))
+        Args:
+            user_context: 请求级用户上下文
 
-        return reply_content
+        Returns:
+            str: 通知文本，没有未读菜谱时为空字符串
+        """
+        # 未读通知数（只有VIP用户会收到通知）
+        count = user_context.unread_recipe_count
+        if count:
+            return consts.NEW_RECIPE_NOTIFICATION.format(count=count)
+        return ''
 
-    def _handle_verify_keyword(self, user_openid):
+    def _handle_verify_keyword(self, user_context):
         """
         处理验证关键词
 
         Args:
-            user_openid: 用户的OpenID
+            user_context: 请求级用户上下文
 
         Returns:
             str: 回复消息
         """
         import time
 
+        user_openid = user_context.openid
+
         # 检查用户是否已经是VIP
-        if user_data_manager.is_vip_user(user_openid):
-            vip_info = user_data_manager.get_vip_info(user_openid)
+        if user_context.is_vip:
+            vip_info = user_context.vip_info
             return consts.ALREADY_VIP_MESSAGE.format(
                 vip_id=vip_info['vip_id'], verify_time=vip_info['verify_time_str']
             )
@@ -672,7 +826,7 @@ class Handle(object):
 
         return self._create_text_response(toUser, fromUser, consts.IMAGE_REPLY)
 
-    def _handle_subscribe_event(self, recMsg):
+    def _handle_subscribe_event(self, recMsg, user_context):
         """处理关注事件"""
         toUser = recMsg.FromUserName
         fromUser = recMsg.ToUserName
@@ -699,7 +853,7 @@ class Handle(object):
         }
 
         # 检查是否是老用户重新关注
-        existing_user = user_data_manager.get_user_info(toUser)
+        existing_user = user_context.user_info
         if existing_user:
             user_info['first_subscribe'] = False
             user_info['previous_unsubscribe_time'] = existing_user.get('unsubscribe_time', '')
@@ -715,13 +869,27 @@ class Handle(object):
 
         return self._create_text_response(toUser, fromUser, welcome_content)
 
-    def _handle_unsubscribe_event(self, recMsg):
+    def _handle_unsubscribe_event(self, recMsg, user_context):
         """处理取消关注事件"""
         toUser = recMsg.FromUserName
+        create_time = getattr(recMsg, 'CreateTime', '')
 
         print(f'用户取消关注: {toUser}')
 
-        # 保留用户数据，仅清除当前会话状态
+        # 保留用户数据，记录取消关注时间（manage.py purge-users 据此清理长期未回来的用户），
+        # 并清除当前会话状态
+        existing_user = user_context.user_info
+        if existing_user:
+            import time
+
+            unsubscribe_time = create_time or str(int(time.time()))
+            user_info = dict(existing_user)
+            user_info['status'] = 'unsubscribed'
+            user_info['unsubscribe_time'] = unsubscribe_time
+            user_info['unsubscribe_time_str'] = time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(int(unsubscribe_time))
+            )
+            user_data_manager.save_user_info(toUser, user_info)
         user_data_manager.clear_user_session_state(toUser)
 
         # 更新统计数据
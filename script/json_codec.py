@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# JSON编解码模块：统一标准库 json 与可选的 orjson / msgspec，存储层通过编解码器读写数据
+
+import json
+from typing import Any, Dict, Union
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # msgspec 为可选依赖
+    msgspec = None
+
+
+class JSONCodec:
+    """
+    JSON编解码器（标准库实现，始终可用）
+
+    encode 返回 UTF-8 字节串，中文不转义；pretty 模式缩进2格便于调试，否则输出紧凑格式。
+    decode 接受字节串或字符串，数据无效时抛出 ValueError
+    """
+
+    name = 'json'
+
+    def encode(self, data: Any, pretty: bool = False) -> bytes:
+        if pretty:
+            text = json.dumps(data, ensure_ascii=False, indent=2)
+        else:
+            text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+        return text.encode('utf-8')
+
+    def decode(self, data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """orjson 编解码器（非字符串键与标准库一样转换为字符串）"""
+
+    name = 'orjson'
+
+    def encode(self, data: Any, pretty: bool = False) -> bytes:
+        option = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, option=option)
+
+    def decode(self, data: Union[bytes, str]) -> Any:
+        # orjson.JSONDecodeError 是 ValueError 的子类
+        return orjson.loads(data)
+
+
+class MsgspecCodec(JSONCodec):
+    """msgspec 编解码器"""
+
+    name = 'msgspec'
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def encode(self, data: Any, pretty: bool = False) -> bytes:
+        encoded = self._encoder.encode(data)
+        return msgspec.json.format(encoded, indent=2) if pretty else encoded
+
+    def decode(self, data: Union[bytes, str]) -> Any:
+        try:
+            return self._decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+
+
+def available_codecs() -> Dict[str, JSONCodec]:
+    """当前环境中可用的编解码器，按优先级从高到低排列"""
+    codecs = {}
+    if orjson is not None:
+        codecs[OrjsonCodec.name] = OrjsonCodec()
+    if msgspec is not None:
+        codecs[MsgspecCodec.name] = MsgspecCodec()
+    codecs[JSONCodec.name] = JSONCodec()
+    return codecs
+
+
+def get_codec(name: str = 'auto') -> JSONCodec:
+    """
+    获取编解码器
+
+    Args:
+        name: 'auto'（选择可用的最快实现）、'orjson'、'msgspec' 或 'json'
+
+    Returns:
+        JSONCodec: 编解码器；指定的实现未安装时回退到标准库并给出提示
+    """
+    codecs = available_codecs()
+    if name == 'auto':
+        return next(iter(codecs.values()))
+    codec = codecs.get(name)
+    if codec is None:
+        print(f'JSON编解码器 {name} 不可用，使用标准库 json')
+        return codecs[JSONCodec.name]
+    return codec
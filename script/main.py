@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 # filename: main.py
+import signal
+import sys
+
 import web
 import consts
+from data_manager import user_data_manager
 from handle import Handle
 
 
@@ -25,6 +29,16 @@ def fixed_group(seq, size):
         yield x
 
 
+def handle_sigterm(signum, frame):
+    """
+    systemd 停止服务时发送 SIGTERM：先停止后台线程并写入内存中的数据
+    （统计计数、延迟写入队列），再转换为正常退出
+    """
+    print('收到 SIGTERM，正在退出...')
+    user_data_manager.shutdown()
+    sys.exit(0)
+
+
 # 替换原有的 group 函数
 web.utils.group = fixed_group
 
@@ -34,10 +48,9 @@ urls = (
 )
 
 if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, handle_sigterm)
     app = web.application(urls, globals())
     # 指定端口80，便于生产环境部署
     # web.py使用系统参数来指定端口
-    import sys
-
     sys.argv = ['main.py', consts.HOST]
     app.run()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# 数据维护命令行工具
+#
+# 使用方法:
+#   cd script
+#   python manage.py migrate-shards                  # 按 consts.USER_DATA_SHARD_COUNT 重新分片
+#   python manage.py migrate-shards --shard-count 64 # 指定分片数
+#   python manage.py purge-users --unsubscribed-days 90 --dry-run  # 查看将被清理的用户数
+#   python manage.py purge-users --unsubscribed-days 90  # 删除取消关注超过90天的用户数据
+#   python manage.py rebuild-user-index              # 从用户信息重建用户属性索引
+
+import argparse
+import time
+
+import consts
+from data_manager import user_data_manager
+
+
+def migrate_shards(args):
+    """将用户、会话、通知数据迁移到新的分片数"""
+    shard_count = args.shard_count or consts.USER_DATA_SHARD_COUNT
+    if shard_count < 1:
+        print('分片数必须大于0')
+        return 1
+
+    print(f'=== 迁移用户数据分片: {user_data_manager.shard_count} -> {shard_count} ===')
+    summary = user_data_manager.migrate_shards(shard_count)
+    print(f'迁移完成，共 {sum(summary.values())} 条记录')
+    if shard_count != consts.USER_DATA_SHARD_COUNT:
+        print(f'提示: 请同步修改 consts.USER_DATA_SHARD_COUNT = {shard_count}')
+    return 0
+
+
+def purge_users(args):
+    """批量删除取消关注超过指定天数的用户的所有数据"""
+    if args.unsubscribed_days < 0 or args.batch_size < 1:
+        print('天数不能小于0，批量大小必须大于0')
+        return 1
+
+    before = time.time() - args.unsubscribed_days * 86400
+    openids = user_data_manager.find_unsubscribed_users(before)
+    print(f'=== 取消关注超过 {args.unsubscribed_days} 天的用户: {len(openids)} 个 ===')
+    if args.dry_run or not openids:
+        return 0
+
+    start = time.time()
+    deleted = 0
+    for offset in range(0, len(openids), args.batch_size):
+        batch = openids[offset : offset + args.batch_size]
+        if not user_data_manager.delete_users(batch):
+            print(f'删除失败，已删除 {deleted} 个用户')
+            return 1
+        deleted += len(batch)
+        print(f'已删除 {deleted}/{len(openids)} 个用户')
+    print(f'清理完成，耗时 {time.time() - start:.1f} 秒')
+    return 0
+
+
+def rebuild_user_index(args):
+    """遍历所有用户信息重建用户属性索引（索引与用户信息不一致时使用）"""
+    print('=== 重建用户属性索引 ===')
+    if not user_data_manager.user_index.rebuild():
+        print('重建失败')
+        return 1
+    print(f'重建完成，已关注用户: {user_data_manager.count_users(status="subscribed")} 个')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据维护工具（请在服务停止时运行）')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    shards_parser = subparsers.add_parser('migrate-shards', help='迁移用户数据到新的分片数')
+    shards_parser.add_argument(
+        '--shard-count', type=int, help='新的分片数，默认使用 consts.USER_DATA_SHARD_COUNT'
+    )
+    shards_parser.set_defaults(func=migrate_shards)
+
+    purge_parser = subparsers.add_parser('purge-users', help='删除长期取消关注的用户数据')
+    purge_parser.add_argument(
+        '--unsubscribed-days', type=int, required=True, help='取消关注超过多少天的用户'
+    )
+    purge_parser.add_argument(
+        '--batch-size', type=int, default=1000, help='每次提交删除的用户数，默认1000'
+    )
+    purge_parser.add_argument('--dry-run', action='store_true', help='只统计，不删除')
+    purge_parser.set_defaults(func=purge_users)
+
+    index_parser = subparsers.add_parser('rebuild-user-index', help='重建用户属性索引')
+    index_parser.set_defaults(func=rebuild_user_index)
+
+    args = parser.parse_args()
+    raise SystemExit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
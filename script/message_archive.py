@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+# 用户消息冷归档模块：超出热数据窗口的消息按月份分区写入 gzip 压缩分段，每个分段附带按openid的小索引
+
+import gzip
+import os
+import time
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from json_codec import JSONCodec
+
+
+class MessageArchive:
+    """
+    用户消息冷归档
+
+    目录结构：
+        <archive_dir>/<YYYY-MM>/<批次标记>.jsonl.gz    分段文件，每行 {"o": openid, "m": 消息}，按openid排序
+        <archive_dir>/<YYYY-MM>/<批次标记>.idx         分段索引 {openid: [最早时间戳, 最晚时间戳, 消息数]}
+
+    分段和索引都先写临时文件再替换，索引最后写入，有索引的分段才是完整的。
+    读取某个用户的历史时只解压索引中包含该用户的分段
+    """
+
+    SEGMENT_SUFFIX = '.jsonl.gz'
+    # 索引不能以 .json 结尾，否则会被存储后端当作普通文档列出和导入
+    INDEX_SUFFIX = '.idx'
+    # 旧版索引后缀，发现时改名为 INDEX_SUFFIX
+    LEGACY_INDEX_SUFFIX = '.idx.json'
+
+    def __init__(self, archive_dir: str, codec: JSONCodec):
+        """
+        初始化消息归档
+
+        Args:
+            archive_dir: 归档目录
+            codec: JSON编解码器
+        """
+        self.archive_dir = archive_dir
+        self.codec = codec
+        # 已加载的分段索引: 分段路径 -> {openid: [最早时间戳, 最晚时间戳, 消息数]}
+        self._indexes: Dict[str, Dict[str, list]] = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _partition_of(message: Dict) -> str:
+        """消息所属的时间分区（按本地时间的月份）"""
+        return time.strftime('%Y-%m', time.localtime(message.get('timestamp', 0)))
+
+    def _write_file(self, path: str, data: bytes):
+        """先写临时文件并同步到磁盘，再替换目标文件"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def write(self, records: Iterable[Tuple[str, Dict]], tag: str) -> int:
+        """
+        归档一批消息，每个时间分区写入一个分段
+
+        Args:
+            records: (openid, 消息) 序列
+            tag: 批次标记（分段文件名）；同一分区中已存在同名分段时跳过，便于崩溃后重试
+
+        Returns:
+            int: 归档的消息数
+        """
+        partitions: Dict[str, Dict[str, List[Dict]]] = {}
+        count = 0
+        for openid, message in records:
+            partitions.setdefault(self._partition_of(message), {}).setdefault(openid, []).append(
+                message
+            )
+            count += 1
+
+        for partition, users in partitions.items():
+            self._write_segment(os.path.join(self.archive_dir, partition, tag), users)
+        return count
+
+    def _write_segment(self, base_path: str, users: Dict[str, List[Dict]]):
+        """写入一个分段及其索引"""
+        segment_path = base_path + self.SEGMENT_SUFFIX
+        index_path = base_path + self.INDEX_SUFFIX
+        if os.path.exists(index_path):
+            return
+        os.makedirs(os.path.dirname(base_path), exist_ok=True)
+
+        index = {}
+        lines = []
+        for openid in sorted(users):
+            messages = sorted(users[openid], key=lambda message: message.get('timestamp', 0))
+            lines.extend(self.codec.encode({'o': openid, 'm': message}) for message in messages)
+            index[openid] = [
+                messages[0].get('timestamp', 0),
+                messages[-1].get('timestamp', 0),
+                len(messages),
+            ]
+        self._write_file(segment_path, gzip.compress(b'\n'.join(lines) + b'\n'))
+        self._write_file(index_path, self.codec.encode(index))
+        with self._lock:
+            self._indexes[segment_path] = index
+
+    def _get_indexes(self) -> Dict[str, Dict[str, list]]:
+        """所有完整分段的索引（其他进程新写入的分段在这里发现）"""
+        segment_paths = set()
+        if os.path.isdir(self.archive_dir):
+            for partition in os.listdir(self.archive_dir):
+                partition_dir = os.path.join(self.archive_dir, partition)
+                if not os.path.isdir(partition_dir):
+                    continue
+                for name in os.listdir(partition_dir):
+                    if name.endswith(self.LEGACY_INDEX_SUFFIX):
+                        legacy_path = os.path.join(partition_dir, name)
+                        name = name[: -len(self.LEGACY_INDEX_SUFFIX)] + self.INDEX_SUFFIX
+                        try:
+                            os.replace(legacy_path, os.path.join(partition_dir, name))
+                        except FileNotFoundError:
+                            # 其他进程已经改名
+                            pass
+                    if name.endswith(self.INDEX_SUFFIX):
+                        base_path = os.path.join(partition_dir, name[: -len(self.INDEX_SUFFIX)])
+                        segment_paths.add(base_path + self.SEGMENT_SUFFIX)
+
+        with self._lock:
+            for segment_path in list(self._indexes):
+                if segment_path not in segment_paths:
+                    del self._indexes[segment_path]
+            for segment_path in segment_paths - self._indexes.keys():
+                index_path = segment_path[: -len(self.SEGMENT_SUFFIX)] + self.INDEX_SUFFIX
+                try:
+                    with open(index_path, 'rb') as f:
+                        self._indexes[segment_path] = self.codec.decode(f.read())
+                except (OSError, ValueError) as e:
+                    print(f'读取归档索引失败 {index_path}: {str(e)}')
+            return dict(self._indexes)
+
+    def _read_user(self, segment_path: str, openid: str) -> List[Dict]:
+        """流式解压分段，只解析该用户的行（分段按openid排序，读完该用户即停止）"""
+        prefix = self.codec.encode({'o': openid})[:-1] + b','
+        messages = []
+        with gzip.open(segment_path, 'rb') as f:
+            for line in f:
+                if line.startswith(prefix):
+                    messages.append(self.codec.decode(line)['m'])
+                elif messages:
+                    break
+        return messages
+
+    def iter_messages(self, openid: str, before: Optional[float] = None) -> Iterator[Dict]:
+        """
+        按时间从新到旧逐条返回用户的归档消息
+
+        Args:
+            openid: 用户openid
+            before: 只返回时间戳早于该值的消息，为None时不限制
+
+        Returns:
+            Iterator[Dict]: 消息迭代器
+        """
+        segments = []
+        seen = set()
+        for segment_path, index in self._get_indexes().items():
+            entry = index.get(openid)
+            if entry is None or (before is not None and entry[0] >= before):
+                continue
+            # 同一用户的归档批次时间不重叠，索引条目完全相同的只可能是崩溃重试写入的重复分段
+            if tuple(entry) in seen:
+                continue
+            seen.add(tuple(entry))
+            segments.append((entry[1], segment_path))
+
+        for _, segment_path in sorted(segments, reverse=True):
+            try:
+                messages = self._read_user(segment_path, openid)
+            except OSError as e:
+                # 分段可能刚被删除用户时重写
+                print(f'读取归档分段失败 {segment_path}: {str(e)}')
+                continue
+            for message in reversed(messages):
+                if before is None or message.get('timestamp', 0) < before:
+                    yield message
+
+    def delete(self, openid: str) -> int:
+        """
+        从所有包含该用户的分段中删除其消息（只重写这些分段）
+
+        Args:
+            openid: 用户openid
+
+        Returns:
+            int: 删除的消息数
+        """
+        return self.delete_many([openid]).get(openid, 0)
+
+    def delete_many(self, openids: Iterable[str]) -> Dict[str, int]:
+        """
+        批量删除多个用户的归档消息，每个涉及的分段只重写一次
+
+        Args:
+            openids: 用户openid序列
+
+        Returns:
+            Dict[str, int]: 有消息被删除的用户 -> 删除的消息数
+        """
+        targets = set(openids)
+        removed: Dict[str, int] = {}
+        for segment_path, index in self._get_indexes().items():
+            matched = targets.intersection(index)
+            if not matched:
+                continue
+            base_path = segment_path[: -len(self.SEGMENT_SUFFIX)]
+            index_path = base_path + self.INDEX_SUFFIX
+            # 每行以 {"o":openid, 开头，按前缀过滤，不必解析整行
+            prefixes = {self.codec.encode({'o': openid})[:-1] + b',' for openid in matched}
+            lengths = {len(prefix) for prefix in prefixes}
+            with gzip.open(segment_path, 'rb') as f:
+                lines = [
+                    line for line in f if not any(line[:length] in prefixes for length in lengths)
+                ]
+            for openid in matched:
+                removed[openid] = removed.get(openid, 0) + index[openid][2]
+            index = {key: value for key, value in index.items() if key not in matched}
+
+            if index:
+                self._write_file(segment_path, gzip.compress(b''.join(lines)))
+                self._write_file(index_path, self.codec.encode(index))
+            else:
+                os.remove(index_path)
+                os.remove(segment_path)
+            with self._lock:
+                self._indexes.pop(segment_path, None)
+        return removed
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# 菜谱搜索模块：按字符二元组（bigram）建立菜名和内容的倒排索引，搜索时只读取关键词对应的倒排列表
+
+from typing import Dict, List, Set
+
+# 菜名命中的权重（内容命中为1）
+NAME_WEIGHT = 3
+
+
+def text_tokens(text: str) -> Set[str]:
+    """
+    文本的索引词：每个连续片段（按空白切分）中的单字和相邻两字
+
+    Args:
+        text: 原始文本
+
+    Returns:
+        Set[str]: 索引词集合
+    """
+    tokens = set()
+    for segment in text.lower().split():
+        tokens.update(segment)
+        tokens.update(segment[i : i + 2] for i in range(len(segment) - 1))
+    return tokens
+
+
+def query_tokens(keyword: str) -> Set[str]:
+    """
+    关键词的查询词：有相邻两字时只用二元组（更精确），单字关键词退化为单字匹配
+
+    Args:
+        keyword: 搜索关键词
+
+    Returns:
+        Set[str]: 查询词集合
+    """
+    tokens = set()
+    for segment in keyword.lower().split():
+        if len(segment) == 1:
+            tokens.add(segment)
+        else:
+            tokens.update(segment[i : i + 2] for i in range(len(segment) - 1))
+    return tokens
+
+
+class RecipeSearchIndex:
+    """
+    菜谱倒排索引
+
+    序列化格式：
+        {
+            'indexed_id': 已建立索引的最新菜谱ID,
+            'name': {索引词: [菜谱ID, ...]},
+            'content': {索引词: [菜谱ID, ...]}
+        }
+    菜谱只追加不删除，倒排列表中的ID保持递增
+    """
+
+    FIELDS = ('name', 'content')
+
+    def __init__(self, data: Dict = None):
+        data = data or {}
+        self.indexed_id = data.get('indexed_id', 0)
+        self.postings: Dict[str, Dict[str, List[int]]] = {
+            field: data.get(field, {}) for field in self.FIELDS
+        }
+
+    def add(self, recipe: Dict):
+        """
+        增量添加一个菜谱
+
+        Args:
+            recipe: 菜谱信息（需包含 id、name、content）
+        """
+        recipe_id = recipe['id']
+        for field in self.FIELDS:
+            postings = self.postings[field]
+            for token in text_tokens(recipe.get(field) or ''):
+                postings.setdefault(token, []).append(recipe_id)
+        self.indexed_id = max(self.indexed_id, recipe_id)
+
+    def search(self, keyword: str, limit: int) -> List[int]:
+        """
+        搜索菜谱
+
+        得分 = 各查询词在菜名中命中的次数 * NAME_WEIGHT + 在内容中命中的次数，
+        得分相同时较新的菜谱排在前面
+
+        Args:
+            keyword: 搜索关键词
+            limit: 最多返回的结果数
+
+        Returns:
+            List[int]: 按相关度排序的菜谱ID列表
+        """
+        scores: Dict[int, int] = {}
+        for token in query_tokens(keyword):
+            for field in self.FIELDS:
+                weight = NAME_WEIGHT if field == 'name' else 1
+                for recipe_id in self.postings[field].get(token, ()):
+                    scores[recipe_id] = scores.get(recipe_id, 0) + weight
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return [recipe_id for recipe_id, _ in ranked[:limit]]
+
+    def to_dict(self) -> Dict:
+        return {'indexed_id': self.indexed_id, **self.postings}
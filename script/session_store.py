@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# 用户会话存储模块：按会话状态设置有效期，过期索引按时间分桶，后台线程只处理到期的桶
+
+import time
+from threading import Event, Lock, Thread
+from typing import Dict, Optional
+
+
+class SessionStore:
+    """
+    用户会话存储
+
+    会话记录保存在按openid分片的 user_sessions 文档中，并带有 retain_until（保留截止时间）；
+    过期索引 user_session_expiry 与会话使用相同的分片规则，每个分片以时间桶序号为键、
+    到期的openid列表为值，设置会话只修改所在分片。后台清理线程只读取已到期的桶，
+    清理成本与过期会话数相关，而与用户总数无关
+    """
+
+    def __init__(
+        self,
+        user_data_manager,
+        ttl_by_state: Dict[str, float],
+        default_ttl: float,
+        sweep_interval: float,
+    ):
+        """
+        初始化会话存储
+
+        Args:
+            user_data_manager: 用户数据管理器（提供存储入口和分片规则）
+            ttl_by_state: 会话状态 -> 有效期（秒）
+            default_ttl: 未配置的会话状态使用的有效期（秒）
+            sweep_interval: 清理间隔（秒），同时也是过期索引的时间桶宽度
+        """
+        self.user_data_manager = user_data_manager
+        self.sessions_file = user_data_manager.user_sessions_file
+        self.expiry_index_file = 'user_session_expiry'
+        self.ttl_by_state = ttl_by_state
+        self.default_ttl = default_ttl
+        self.sweep_interval = sweep_interval
+
+        self._lock = Lock()
+        self._sweep_thread = None
+        self._stop_event = Event()
+
+    def _shard_file(self, openid: str) -> str:
+        return self.user_data_manager._shard_file(self.sessions_file, openid)
+
+    def _index_file(self, openid: str) -> str:
+        return self.user_data_manager._shard_file(self.expiry_index_file, openid)
+
+    def _iter_index_files(self) -> list:
+        """列出所有过期索引分片（包括分片数变化前的分片和旧版未分片的索引）"""
+        base = self.expiry_index_file
+        return [
+            filename
+            for filename in self.user_data_manager.data_manager.list_files()
+            if filename == base or filename.startswith(base + '/')
+        ]
+
+    def _bucket(self, timestamp: float) -> str:
+        """时间戳所在的时间桶（向上取整，保证桶到期时桶内会话都已过期）"""
+        return str(int(-(-timestamp // self.sweep_interval)))
+
+    def _ensure_sweeper(self):
+        """启动后台清理线程（首次使用会话时启动，避免导入模块就创建线程）"""
+        if self._sweep_thread is not None:
+            return
+        with self._lock:
+            if self._sweep_thread is None:
+                self._sweep_thread = Thread(
+                    target=self._sweep_loop, name='session-sweeper', daemon=True
+                )
+                self._sweep_thread.start()
+
+    def stop(self):
+        """停止后台清理线程（服务退出时调用，可重复调用）"""
+        self._stop_event.set()
+        sweep_thread = self._sweep_thread
+        if sweep_thread is not None and sweep_thread.is_alive():
+            sweep_thread.join(self.sweep_interval)
+
+    def _sweep_loop(self):
+        indexed = False
+        while True:
+            # 补建索引失败（如文档损坏）时下个周期重试，不能让清理线程退出
+            if not indexed:
+                try:
+                    self._index_legacy_sessions()
+                    indexed = True
+                except Exception as e:
+                    print(f'补建会话过期索引失败: {str(e)}')
+            if self._stop_event.wait(self.sweep_interval):
+                return
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f'清理过期会话失败: {str(e)}')
+
+    def _index_legacy_sessions(self):
+        """为过期索引建立之前保存的会话补建索引（只在没有任何索引分片时执行一次）"""
+        store = self.user_data_manager.data_manager
+        if self._iter_index_files():
+            return
+
+        indexes: Dict[str, Dict[str, list]] = {}
+        for filename in self.user_data_manager._iter_shard_files(self.sessions_file):
+            for openid, session in list(store.load_data(filename, {}).items()):
+                retain_until = self._retain_until(session)
+                if 'retain_until' not in session:
+                    store.put(filename, openid, dict(session, retain_until=retain_until))
+                index = indexes.setdefault(self._index_file(openid), {})
+                index.setdefault(self._bucket(retain_until), []).append(openid)
+
+        # 扫描期间 set() 可能已经写入了索引，按桶合并而不是覆盖
+        def merge_func(index):
+            def merge(current):
+                merged = dict(current or {})
+                for bucket, openids in index.items():
+                    existing = merged.get(bucket, [])
+                    known = set(existing)
+                    merged[bucket] = existing + [
+                        openid for openid in openids if openid not in known
+                    ]
+                return merged
+
+            return merge
+
+        for index_file, index in indexes.items():
+            store.update_data(index_file, merge_func(index), {})
+        count = sum(len(openids) for index in indexes.values() for openids in index.values())
+        print(f'已为 {count} 个会话建立过期索引')
+
+    def _get_ttl(self, state: Optional[str]) -> float:
+        return self.ttl_by_state.get(state, self.default_ttl)
+
+    def _retain_until(self, session: Dict) -> float:
+        """会话的保留截止时间；升级前保存的会话没有该字段，按开始时间和状态推算"""
+        retain_until = session.get('retain_until')
+        if retain_until is None:
+            retain_until = session.get('start_time', 0) + self._get_ttl(session.get('state'))
+        return retain_until
+
+    def set(self, openid: str, state: str, extra_data: Dict = None) -> bool:
+        """
+        设置用户会话状态，有效期由会话状态决定
+
+        Args:
+            openid: 用户的openid
+            state: 会话状态
+            extra_data: 额外数据
+
+        Returns:
+            bool: 是否成功
+        """
+        self._ensure_sweeper()
+        now = time.time()
+        session_data = {
+            'state': state,
+            'start_time': now,
+            'start_time_str': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'retain_until': now + self._get_ttl(state),
+        }
+        if extra_data:
+            session_data.update(extra_data)
+
+        def add_to_bucket(openids):
+            return openids if openid in openids else openids + [openid]
+
+        store = self.user_data_manager.store
+        if not store.put(self._shard_file(openid), openid, session_data):
+            return False
+        return store.update_key(
+            self._index_file(openid), self._bucket(session_data['retain_until']), add_to_bucket, []
+        )
+
+    def get(self, openid: str) -> Optional[Dict]:
+        """
+        获取用户会话状态（已超过有效期但尚未被清理的会话视为不存在）
+
+        Args:
+            openid: 用户的openid
+
+        Returns:
+            Dict: 会话状态信息，不存在时返回None
+        """
+        self._ensure_sweeper()
+        session = self.user_data_manager.store.get(self._shard_file(openid), openid)
+        if session is not None and self._retain_until(session) <= time.time():
+            return None
+        return session
+
+    def clear(self, openid: str) -> bool:
+        """
+        清除用户会话状态（过期索引中的条目留给清理线程跳过）
+
+        Args:
+            openid: 用户的openid
+
+        Returns:
+            bool: 是否成功
+        """
+        return self.user_data_manager.store.delete(self._shard_file(openid), openid)
+
+    def sweep(self, now: float = None) -> int:
+        """
+        删除所有已到期时间桶中的过期会话
+
+        Args:
+            now: 当前时间戳，默认为 time.time()
+
+        Returns:
+            int: 删除的会话数
+        """
+        if now is None:
+            now = time.time()
+        store = self.user_data_manager.data_manager
+        due_buckets = [
+            (index_file, bucket, list(openids))
+            for index_file in self._iter_index_files()
+            for bucket, openids in store.load_data(index_file, {}).items()
+            if int(bucket) * self.sweep_interval <= now
+        ]
+
+        removed = 0
+        for index_file, bucket, openids in due_buckets:
+            for openid in openids:
+                shard_file = self._shard_file(openid)
+                # 会话可能已被清除，或重新设置后有了新的有效期（由新的时间桶负责）
+                session = store.get(shard_file, openid)
+                if session is None or session.get('retain_until', now) > now:
+                    continue
+
+                def drop_expired(session):
+                    if session is not None and session.get('retain_until', now) <= now:
+                        return None
+                    return session
+
+                store.update_key(shard_file, openid, drop_expired)
+                removed += 1
+            store.delete(index_file, bucket)
+
+        if removed:
+            print(f'已清理 {removed} 个过期会话')
+        return removed
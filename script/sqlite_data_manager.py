@@ -0,0 +1,708 @@
+# -*- coding: utf-8 -*-
+# SQLite数据持久化模块（与 JSONDataManager 接口一致的存储后端）
+
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, Optional
+
+from itertools import chain, islice
+
+from json_codec import JSONCodec, get_codec
+from message_archive import MessageArchive
+
+
+class SQLiteDataManager:
+    """SQLite数据持久化管理器 - 每个文档一张以记录键为主键的表，WAL模式"""
+
+    # 数据库文件名
+    DB_FILENAME = 'storage.db'
+
+    # 存放非字典类型文档（整体序列化）的登记表
+    DOCUMENTS_TABLE = '_documents'
+
+    # load_data 每次都从数据库读取完整文档，不返回共享的缓存对象
+    caches_documents = False
+
+    def __init__(
+        self, data_dir: str = 'data', codec: Optional[JSONCodec] = None, fsync: bool = True
+    ):
+        """
+        初始化数据管理器
+
+        Args:
+            data_dir: 数据存储目录，默认为项目根目录下的data文件夹
+            codec: 记录值的JSON编解码器，默认自动选择已安装的最快实现
+            fsync: 每次提交是否同步到磁盘（synchronous=FULL）；否则断电时可能丢失最近的提交
+        """
+        # 获取项目根目录
+        self.project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.data_dir = os.path.join(self.project_root, data_dir)
+        if not os.path.exists(self.data_dir):
+            os.makedirs(self.data_dir, exist_ok=True)
+            print(f'创建数据目录: {self.data_dir}')
+
+        self.codec = codec or get_codec()
+        self.fsync = fsync
+
+        self.db_path = os.path.join(self.data_dir, self.DB_FILENAME)
+        is_new_db = not os.path.exists(self.db_path)
+
+        # 每个线程持有一个独立连接，WAL模式下读操作互不阻塞
+        self._local = threading.local()
+
+        conn = self._get_connection()
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.DOCUMENTS_TABLE} '
+            '(name TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT)'
+        )
+
+        if is_new_db:
+            self._import_json_documents()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """获取当前线程的数据库连接（首次使用时创建）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(f'PRAGMA synchronous={"FULL" if self.fsync else "NORMAL"}')
+            self._local.conn = conn
+        return conn
+
+    def _dumps(self, value: Any) -> str:
+        """序列化记录值（紧凑格式，存入TEXT列）"""
+        return self.codec.encode(value).decode('utf-8')
+
+    @staticmethod
+    def _rollback(conn: sqlite3.Connection):
+        """回滚当前事务（事务未开启时忽略）"""
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+
+    @staticmethod
+    def _table_name(filename: str) -> str:
+        """文档名对应的表名（加引号，允许任意字符）"""
+        if filename.endswith('.json'):
+            filename = filename[:-5]
+        return '"doc_' + filename.replace('"', '""') + '"'
+
+    @staticmethod
+    def _document_name(filename: str) -> str:
+        return filename[:-5] if filename.endswith('.json') else filename
+
+    def _get_kind(self, conn: sqlite3.Connection, filename: str) -> Optional[str]:
+        """获取文档类型：records（按记录存储的字典）、value（整体存储）或None（不存在）"""
+        row = conn.execute(
+            f'SELECT kind FROM {self.DOCUMENTS_TABLE} WHERE name = ?',
+            (self._document_name(filename),),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _ensure_records_table(self, conn: sqlite3.Connection, filename: str):
+        """确保记录表存在并登记为 records 类型文档"""
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self._table_name(filename)} '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID'
+        )
+        conn.execute(
+            f'INSERT OR REPLACE INTO {self.DOCUMENTS_TABLE} (name, kind, value) '
+            "VALUES (?, 'records', NULL)",
+            (self._document_name(filename),),
+        )
+
+    def _drop_internal(self, conn: sqlite3.Connection, filename: str):
+        conn.execute(f'DROP TABLE IF EXISTS {self._table_name(filename)}')
+        conn.execute(
+            f'DELETE FROM {self.DOCUMENTS_TABLE} WHERE name = ?',
+            (self._document_name(filename),),
+        )
+
+    def _save_data_internal(self, conn: sqlite3.Connection, filename: str, data: Any):
+        """内部保存方法，需在事务中调用"""
+        self._drop_internal(conn, filename)
+        if isinstance(data, dict):
+            self._ensure_records_table(conn, filename)
+            conn.executemany(
+                f'INSERT INTO {self._table_name(filename)} (key, value) VALUES (?, ?)',
+                [(key, self._dumps(value)) for key, value in data.items()],
+            )
+        else:
+            conn.execute(
+                f"INSERT INTO {self.DOCUMENTS_TABLE} (name, kind, value) VALUES (?, 'value', ?)",
+                (self._document_name(filename), self._dumps(data)),
+            )
+
+    def _load_data_internal(
+        self, conn: sqlite3.Connection, filename: str, default_value: Any = None
+    ) -> Any:
+        """内部加载方法"""
+        kind = self._get_kind(conn, filename)
+        if kind is None:
+            return default_value
+        if kind == 'value':
+            row = conn.execute(
+                f'SELECT value FROM {self.DOCUMENTS_TABLE} WHERE name = ?',
+                (self._document_name(filename),),
+            ).fetchone()
+            return self.codec.decode(row[0])
+        rows = conn.execute(f'SELECT key, value FROM {self._table_name(filename)}')
+        return {key: self.codec.decode(value) for key, value in rows}
+
+    def _import_json_documents(self):
+        """新建数据库时导入数据目录下已有的JSON文档"""
+        from data_manager import JSONDataManager
+
+        json_manager = JSONDataManager(os.path.relpath(self.data_dir, self.project_root))
+        for filename in json_manager.list_files():
+            data = json_manager.load_data(filename)
+            if data is not None:
+                self.save_data(filename, data)
+                print(f'已将 {filename} 导入SQLite数据库')
+
+    def invalidate_cache(self, filename: Optional[str] = None):
+        """SQLite后端不缓存文档，保留此方法以兼容 JSONDataManager 接口"""
+
+    def flush(self) -> bool:
+        """每次写入都已提交事务，没有延迟写入队列，保留此方法以兼容 JSONDataManager 接口"""
+        return True
+
+    def save_data(self, filename: str, data: Any, pretty: bool = None) -> bool:
+        """
+        保存整个文档
+
+        Args:
+            filename: 文档名
+            data: 要保存的数据
+            pretty: 兼容 JSONDataManager 接口，SQLite后端忽略该参数
+
+        Returns:
+            bool: 保存是否成功
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            self._save_data_internal(conn, filename, data)
+            conn.execute('COMMIT')
+            return True
+        except Exception as e:
+            self._rollback(conn)
+            print(f'保存数据失败 {filename}: {str(e)}')
+            return False
+
+    def load_data(self, filename: str, default_value: Any = None) -> Any:
+        """
+        加载整个文档
+
+        Args:
+            filename: 文档名
+            default_value: 文档不存在时返回的默认值
+
+        Returns:
+            Any: 加载的数据，文档不存在时返回default_value
+        """
+        try:
+            return self._load_data_internal(self._get_connection(), filename, default_value)
+        except Exception as e:
+            print(f'加载数据失败 {filename}: {str(e)}')
+            return default_value
+
+    def update_data(self, filename: str, update_func, default_value: Any = None) -> bool:
+        """
+        在一个事务内读取、更新并保存整个文档
+
+        Args:
+            filename: 文档名
+            update_func: 更新函数，接收当前数据作为参数，返回更新后的数据
+            default_value: 文档不存在时的默认值
+
+        Returns:
+            bool: 更新是否成功
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            current_data = self._load_data_internal(conn, filename, default_value)
+            self._save_data_internal(conn, filename, update_func(current_data))
+            conn.execute('COMMIT')
+            return True
+        except Exception as e:
+            self._rollback(conn)
+            print(f'更新数据失败 {filename}: {str(e)}')
+            return False
+
+    def get(self, filename: str, key: str, default_value: Any = None) -> Any:
+        """
+        读取文档中的单条记录（主键点查）
+
+        Args:
+            filename: 文档名
+            key: 记录键
+            default_value: 记录不存在时返回的默认值
+
+        Returns:
+            Any: 记录值
+        """
+        conn = self._get_connection()
+        try:
+            row = conn.execute(
+                f'SELECT value FROM {self._table_name(filename)} WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.OperationalError:
+            # 表尚未创建
+            return default_value
+        return self.codec.decode(row[0]) if row else default_value
+
+    def _put_internal(self, conn: sqlite3.Connection, filename: str, key: str, value: Any):
+        if self._get_kind(conn, filename) != 'records':
+            self._ensure_records_table(conn, filename)
+        conn.execute(
+            f'INSERT OR REPLACE INTO {self._table_name(filename)} (key, value) VALUES (?, ?)',
+            (key, self._dumps(value)),
+        )
+
+    def _delete_internal(self, conn: sqlite3.Connection, filename: str, key: str):
+        if self._get_kind(conn, filename) == 'records':
+            conn.execute(f'DELETE FROM {self._table_name(filename)} WHERE key = ?', (key,))
+
+    def put(self, filename: str, key: str, value: Any) -> bool:
+        """
+        写入文档中的单条记录
+
+        Args:
+            filename: 文档名
+            key: 记录键
+            value: 记录值
+
+        Returns:
+            bool: 写入是否成功
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            self._put_internal(conn, filename, key, value)
+            conn.execute('COMMIT')
+            return True
+        except Exception as e:
+            self._rollback(conn)
+            print(f'写入记录失败 {filename}/{key}: {str(e)}')
+            return False
+
+    def delete(self, filename: str, key: str) -> bool:
+        """
+        删除文档中的单条记录
+
+        Args:
+            filename: 文档名
+            key: 记录键
+
+        Returns:
+            bool: 是否成功（记录不存在也视为成功）
+        """
+        conn = self._get_connection()
+        try:
+            if self._get_kind(conn, filename) != 'records':
+                return True
+            conn.execute(f'DELETE FROM {self._table_name(filename)} WHERE key = ?', (key,))
+            return True
+        except Exception as e:
+            print(f'删除记录失败 {filename}/{key}: {str(e)}')
+            return False
+
+    def update_key(self, filename: str, key: str, update_func, default_value: Any = None) -> bool:
+        """
+        在一个事务内原子地更新单条记录
+
+        Args:
+            filename: 文档名
+            key: 记录键
+            update_func: 更新函数，接收当前记录值，返回新的记录值；返回None表示删除该记录
+            default_value: 记录不存在时传给更新函数的默认值
+
+        Returns:
+            bool: 更新是否成功
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            value = update_func(self.get(filename, key, default_value))
+            if value is None:
+                self._delete_internal(conn, filename, key)
+            else:
+                self._put_internal(conn, filename, key, value)
+            conn.execute('COMMIT')
+            return True
+        except Exception as e:
+            self._rollback(conn)
+            print(f'更新记录失败 {filename}/{key}: {str(e)}')
+            return False
+
+    def commit_batch(self, operations: Dict[str, list]) -> bool:
+        """
+        在一个事务内提交工作单元收集的所有操作
+
+        Args:
+            operations: 文档名 -> 操作列表，操作为 (方法名, 参数...) 元组，
+                        方法名为 put/delete/update_key/update_data/save_data
+
+        Returns:
+            bool: 是否提交成功
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for filename, document_operations in operations.items():
+                for operation in document_operations:
+                    kind = operation[0]
+                    if kind == 'save_data':
+                        self._save_data_internal(conn, filename, operation[1])
+                    elif kind == 'update_data':
+                        current_data = self._load_data_internal(conn, filename, operation[2])
+                        self._save_data_internal(conn, filename, operation[1](current_data))
+                    elif kind == 'update_key':
+                        key = operation[1]
+                        value = operation[2](self.get(filename, key, operation[3]))
+                        if value is None:
+                            self._delete_internal(conn, filename, key)
+                        else:
+                            self._put_internal(conn, filename, key, value)
+                    elif kind == 'put':
+                        self._put_internal(conn, filename, operation[1], operation[2])
+                    else:
+                        self._delete_internal(conn, filename, operation[1])
+            conn.execute('COMMIT')
+            return True
+        except Exception as e:
+            self._rollback(conn)
+            print(f'批量提交失败: {str(e)}')
+            return False
+
+    def delete_file(self, filename: str) -> bool:
+        """
+        删除整个文档
+
+        Args:
+            filename: 文档名
+
+        Returns:
+            bool: 删除是否成功
+        """
+        conn = self._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            existed = self._get_kind(conn, filename) is not None
+            self._drop_internal(conn, filename)
+            conn.execute('COMMIT')
+            return existed
+        except Exception as e:
+            self._rollback(conn)
+            print(f'删除文档失败 {filename}: {str(e)}')
+            return False
+
+    def list_files(self) -> list:
+        """
+        列出所有文档
+
+        Returns:
+            list: 文档名列表
+        """
+        try:
+            rows = self._get_connection().execute(f'SELECT name FROM {self.DOCUMENTS_TABLE}')
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f'列出文档失败: {str(e)}')
+            return []
+
+    def create_message_journal(self, filename: str, max_messages: int = 100, archive: bool = False):
+        """创建与本后端配套的用户消息存储（archive 为 True 时超出保留数量的消息写入冷归档）"""
+        return SQLiteMessageJournal(self, filename, max_messages, archive)
+
+
+class SQLiteMessageJournal:
+    """用户消息存储 - SQLite表，按 (openid, id) 建索引，每个用户只保留最近的消息"""
+
+    # 待归档的消息累积到这么多条时批量写入一个归档分段
+    ARCHIVE_BATCH = 1000
+    # 批量删除时每条语句绑定的openid数（低于SQLite的参数个数上限）
+    DELETE_BATCH = 500
+
+    def __init__(
+        self,
+        data_manager: SQLiteDataManager,
+        filename: str,
+        max_messages: int = 100,
+        archive: bool = False,
+    ):
+        """
+        初始化消息存储
+
+        Args:
+            data_manager: SQLite数据管理器
+            filename: 消息表名
+            max_messages: 每个用户保留的最近消息数
+            archive: 是否将超出保留数量的消息写入冷归档（先移入待归档表，再批量写入）
+        """
+        self.data_manager = data_manager
+        self.filename = filename
+        self.max_messages = max_messages
+        self.table = '"' + filename.replace('"', '""') + '"'
+        self.pending_table = '"' + filename.replace('"', '""') + '_archive_pending"'
+        self.archive = (
+            MessageArchive(
+                os.path.join(data_manager.data_dir, filename + '_archive'), data_manager.codec
+            )
+            if archive
+            else None
+        )
+
+        conn = data_manager._get_connection()
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table} '
+            '(id INTEGER PRIMARY KEY AUTOINCREMENT, openid TEXT NOT NULL, message TEXT NOT NULL)'
+        )
+        index_name = '"idx_' + filename.replace('"', '""') + '_openid"'
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {self.table} (openid, id)')
+        conn.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.pending_table} '
+            '(id INTEGER PRIMARY KEY, openid TEXT NOT NULL, message TEXT NOT NULL)'
+        )
+        pending_index_name = '"idx_' + filename.replace('"', '""') + '_archive_pending_openid"'
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS {pending_index_name} ON {self.pending_table} (openid, id)'
+        )
+
+        if conn.execute(f'SELECT 1 FROM {self.table} LIMIT 1').fetchone() is None:
+            self._import_json_journal()
+
+    def _import_json_journal(self):
+        """消息表为空时导入JSON后端的消息日志"""
+        from data_manager import JSONDataManager, MessageJournal
+
+        json_manager = JSONDataManager(
+            os.path.relpath(self.data_manager.data_dir, self.data_manager.project_root)
+        )
+        journal = MessageJournal(
+            json_manager, self.filename, self.max_messages, self.archive is not None
+        )
+        if (
+            not os.path.exists(journal.journal_path)
+            and json_manager.load_data(self.filename) is None
+        ):
+            return
+
+        journal._load_internal()
+        conn = self.data_manager._get_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        for openid, messages in journal._evicted.items():
+            conn.executemany(
+                f'INSERT INTO {self.pending_table} (openid, message) VALUES (?, ?)',
+                [(openid, self.data_manager._dumps(message)) for message in messages],
+            )
+        for openid, buffer in journal._buffers.items():
+            conn.executemany(
+                f'INSERT INTO {self.table} (openid, message) VALUES (?, ?)',
+                [(openid, self.data_manager._dumps(message)) for message in buffer],
+            )
+        conn.execute('COMMIT')
+        print(f'已将 {len(journal._buffers)} 个用户的消息记录导入SQLite数据库')
+
+    def append(self, openid: str, message: Dict) -> bool:
+        """
+        追加一条用户消息，并删除超出保留数量的旧消息
+
+        Args:
+            openid: 用户openid
+            message: 消息记录
+
+        Returns:
+            bool: 是否成功
+        """
+        conn = self.data_manager._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                f'INSERT INTO {self.table} (openid, message) VALUES (?, ?)',
+                (openid, self.data_manager._dumps(message)),
+            )
+            expired = (
+                f'openid = ? AND id <= (SELECT id FROM {self.table} WHERE openid = ? '
+                'ORDER BY id DESC LIMIT 1 OFFSET ?)'
+            )
+            params = (openid, openid, self.max_messages)
+            if self.archive is not None:
+                conn.execute(
+                    f'INSERT INTO {self.pending_table} (id, openid, message) '
+                    f'SELECT id, openid, message FROM {self.table} WHERE {expired}',
+                    params,
+                )
+            conn.execute(f'DELETE FROM {self.table} WHERE {expired}', params)
+            conn.execute('COMMIT')
+        except Exception as e:
+            self.data_manager._rollback(conn)
+            print(f'记录消息失败 {openid}: {str(e)}')
+            return False
+
+        if self.archive is not None:
+            pending_count = conn.execute(f'SELECT COUNT(*) FROM {self.pending_table}').fetchone()[0]
+            if pending_count >= self.ARCHIVE_BATCH:
+                self.flush_archive()
+        return True
+
+    def flush_archive(self) -> bool:
+        """
+        将待归档表中的消息批量写入冷归档
+
+        在写事务中进行，避免多个进程重复归档；批次标记由消息ID范围决定，
+        写入归档后、删除待归档记录前崩溃时，重试会跳过已写入的分段
+
+        Returns:
+            bool: 是否成功
+        """
+        if self.archive is None:
+            return True
+        conn = self.data_manager._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                f'SELECT id, openid, message FROM {self.pending_table} ORDER BY id LIMIT ?',
+                (self.ARCHIVE_BATCH,),
+            ).fetchall()
+            if rows:
+                archived = self.archive.write(
+                    (
+                        (openid, self.data_manager.codec.decode(message))
+                        for _, openid, message in rows
+                    ),
+                    f'sqlite-{rows[0][0]}-{rows[-1][0]}',
+                )
+                conn.execute(f'DELETE FROM {self.pending_table} WHERE id <= ?', (rows[-1][0],))
+                print(f'已归档 {archived} 条超出保留数量的消息')
+            conn.execute('COMMIT')
+            return True
+        except Exception as e:
+            self.data_manager._rollback(conn)
+            print(f'归档消息失败: {str(e)}')
+            return False
+
+    def get(self, openid: str, limit: int = 10) -> list:
+        """
+        获取用户最近的消息
+
+        Args:
+            openid: 用户openid
+            limit: 返回消息数量限制，小于等于0时返回全部保留的消息
+
+        Returns:
+            list: 消息列表，按时间从旧到新
+        """
+        if limit <= 0:
+            limit = self.max_messages
+        try:
+            rows = self.data_manager._get_connection().execute(
+                f'SELECT message FROM {self.table} WHERE openid = ? ORDER BY id DESC LIMIT ?',
+                (openid, limit),
+            )
+            return [self.data_manager.codec.decode(row[0]) for row in rows][::-1]
+        except Exception as e:
+            print(f'读取消息失败 {openid}: {str(e)}')
+            return []
+
+    def delete(self, openid: str) -> bool:
+        """
+        删除用户的所有消息
+
+        Args:
+            openid: 用户openid
+
+        Returns:
+            bool: 用户是否有消息被删除
+        """
+        return self.delete_many([openid]) > 0
+
+    def delete_many(self, openids) -> int:
+        """
+        在一个事务中批量删除多个用户的所有消息（归档分段各重写一次）
+
+        Args:
+            openids: 用户openid序列
+
+        Returns:
+            int: 有消息被删除的用户数
+        """
+        openids = list(set(openids))
+        conn = self.data_manager._get_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            deleted = set()
+            for start in range(0, len(openids), self.DELETE_BATCH):
+                chunk = openids[start : start + self.DELETE_BATCH]
+                placeholders = ','.join('?' * len(chunk))
+                for table in (self.table, self.pending_table):
+                    deleted.update(
+                        row[0]
+                        for row in conn.execute(
+                            f'SELECT DISTINCT openid FROM {table} WHERE openid IN ({placeholders})',
+                            chunk,
+                        )
+                    )
+                    conn.execute(f'DELETE FROM {table} WHERE openid IN ({placeholders})', chunk)
+            if self.archive is not None:
+                deleted.update(self.archive.delete_many(openids))
+            conn.execute('COMMIT')
+            return len(deleted)
+        except Exception as e:
+            self.data_manager._rollback(conn)
+            print(f'删除消息失败: {str(e)}')
+            return 0
+
+    def get_history(self, openid: str, limit: int = 20, before: Optional[float] = None) -> list:
+        """
+        分页获取用户的完整消息历史（包括冷归档），从 before 往前取 limit 条
+
+        Args:
+            openid: 用户openid
+            limit: 本页消息数
+            before: 只返回时间戳早于该值的消息，为None时从最新的消息开始
+
+        Returns:
+            list: 消息列表，按时间从旧到新；下一页以第一条消息的时间戳作为 before
+        """
+        try:
+            conn = self.data_manager._get_connection()
+            decode = self.data_manager.codec.decode
+            # 消息表中是最近的消息，待归档的消息在它之前
+            rows = chain(
+                conn.execute(
+                    f'SELECT message FROM {self.table} WHERE openid = ? ORDER BY id DESC',
+                    (openid,),
+                ),
+                conn.execute(
+                    f'SELECT message FROM {self.pending_table} WHERE openid = ? ORDER BY id DESC',
+                    (openid,),
+                ),
+            )
+            newest_first = (
+                message
+                for message in (decode(row[0]) for row in rows)
+                if before is None or message.get('timestamp', 0) < before
+            )
+            if self.archive is not None:
+                newest_first = chain(newest_first, self.archive.iter_messages(openid, before))
+            return list(islice(newest_first, limit))[::-1]
+        except Exception as e:
+            print(f'读取消息失败 {openid}: {str(e)}')
+            return []
+
+    def compact(self) -> bool:
+        """
+        回收WAL日志空间（保留数量已在写入时维护）
+
+        Returns:
+            bool: 是否成功
+        """
+        try:
+            self.data_manager._get_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return True
+        except Exception as e:
+            print(f'压缩消息表失败: {str(e)}')
+            return False
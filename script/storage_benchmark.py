@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# 存储层性能测试脚本
+#
+# 使用方法:
+#   cd script
+#   python storage_benchmark.py locks     # 全局锁与分文件锁的并发读吞吐对比
+#   python storage_benchmark.py stress    # 多进程并发写入，验证没有更新丢失
+#   python storage_benchmark.py codec     # 各JSON编解码器的读写耗时与文件大小对比
+
+import argparse
+import contextlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from data_manager import JSONDataManager
+from json_codec import available_codecs
+from sqlite_data_manager import SQLiteDataManager
+
+
+class GlobalLockDataManager(JSONDataManager):
+    """所有文件共用一把锁的数据管理器（模拟分段锁之前的行为，作为对照组）"""
+
+    def _get_lock(self, filename):
+        return self._lock
+
+
+def _make_messages_document(user_count: int, messages_per_user: int) -> dict:
+    """构造与 user_messages 结构相同的大文档"""
+    return {
+        f'o{i:027d}': [
+            {
+                'type': 'text',
+                'content': f'消息内容 {j}',
+                'timestamp': 1702713000.0 + j,
+                'time_str': '2024-12-16 14:50:00',
+            }
+            for j in range(messages_per_user)
+        ]
+        for i in range(user_count)
+    }
+
+
+def _make_users_document(user_count: int) -> dict:
+    """构造与 users 结构相同的文档"""
+    return {
+        f'o{i:027d}': {
+            'openid': f'o{i:027d}',
+            'status': 'subscribed' if i % 5 else 'unsubscribed',
+            'subscribe_time': str(1702713000 + i),
+            'subscribe_time_str': '2024-12-16 14:50:00',
+            'source': 'wechat_official_account',
+            'first_subscribe': i % 3 != 0,
+            'vip_status': 'vip' if i % 10 == 0 else 'normal',
+            'last_update': 1702713000.123 + i,
+            'last_update_str': '2024-12-16 14:50:00',
+        }
+        for i in range(user_count)
+    }
+
+
+def _make_recipes_document(recipe_count: int) -> dict:
+    """构造与 recipes 结构相同的文档"""
+    recipes = [
+        {
+            'id': i,
+            'name': f'红烧肉 {i}',
+            'content': f'红烧肉 {i}\n五花肉500克、冰糖、生抽、老抽、料酒\n焯水后炒糖色，加调料小火炖一小时',
+            'category': 'meat' if i % 2 else 'veg',
+            'creator_openid': f'o{i % 50:027d}',
+            'creator_name': f'VIP-{i % 50:04d}',
+            'create_time': 1702713000.0 + i,
+            'create_time_str': '2024-12-16 14:50:00',
+        }
+        for i in range(1, recipe_count + 1)
+    ]
+    return {
+        'list': recipes,
+        'next_id': recipe_count + 1,
+        'category_ids': {
+            'meat': [r['id'] for r in recipes if r['category'] == 'meat'],
+            'veg': [r['id'] for r in recipes if r['category'] == 'veg'],
+        },
+    }
+
+
+def benchmark_codecs(user_count: int, repeat: int):
+    """对比各编解码器在紧凑/格式化两种模式下的序列化、解析耗时和文件大小"""
+    documents = {
+        'users': _make_users_document(user_count),
+        'user_messages': _make_messages_document(user_count, 20),
+        'recipes': _make_recipes_document(user_count // 10),
+    }
+    codecs = available_codecs()
+    print(f'=== JSON编解码器对比（{user_count} 个用户，每项取 {repeat} 次中的最快值）===')
+    print(f'可用编解码器: {", ".join(codecs)}')
+
+    for doc_name, document in documents.items():
+        print(f'\n{doc_name}:')
+        print(f'{"编解码器":<18}{"写入(ms)":>10}{"读取(ms)":>10}{"大小(KB)":>12}')
+        for codec_name, codec in codecs.items():
+            for pretty in (False, True):
+                dump_times, load_times = [], []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    encoded = codec.encode(document, pretty)
+                    dump_times.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    codec.decode(encoded)
+                    load_times.append(time.perf_counter() - start)
+                label = f'{codec_name} ({"格式化" if pretty else "紧凑"})'
+                print(
+                    f'{label:<18}{min(dump_times) * 1000:>10.1f}'
+                    f'{min(load_times) * 1000:>10.1f}{len(encoded) / 1024:>12.1f}'
+                )
+
+
+def _run_locks_round(manager_class, data_dir: str, duration: float, reader_count: int) -> int:
+    """一个线程持续重写大文档，其余线程读取小文档，返回读操作总数"""
+    manager = manager_class(data_dir)
+    big_document = _make_messages_document(2000, 20)
+    manager.save_data('vip_users', {f'o{i:027d}': {'status': 'active'} for i in range(100)})
+    manager.load_data('vip_users')
+
+    stop = threading.Event()
+    read_counts = [0] * reader_count
+
+    def writer():
+        while not stop.is_set():
+            manager.save_data('user_messages', big_document)
+
+    def reader(index):
+        count = 0
+        while not stop.is_set():
+            manager.get('vip_users', 'o000000000000000000000000042')
+            count += 1
+        read_counts[index] = count
+
+    threads = [threading.Thread(target=writer)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(reader_count)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(read_counts)
+
+
+def benchmark_locks(duration: float, reader_count: int):
+    """对比全局锁与分文件锁下的并发读吞吐"""
+    print(f'=== 锁分段吞吐测试（{reader_count} 个读线程，持续 {duration} 秒）===')
+    results = {}
+    for name, manager_class in (
+        ('全局锁', GlobalLockDataManager),
+        ('分文件锁', JSONDataManager),
+    ):
+        data_dir = tempfile.mkdtemp(prefix='storage_benchmark_')
+        try:
+            # 屏蔽数据管理器的逐次保存日志
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                reads = _run_locks_round(manager_class, data_dir, duration, reader_count)
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        results[name] = reads
+        print(f'{name}: vip_users 读取 {reads / duration:,.0f} 次/秒')
+
+    if results['全局锁']:
+        print(f'提升: {results["分文件锁"] / results["全局锁"]:.1f} 倍')
+
+
+def _create_manager(backend: str, data_dir: str):
+    if backend == 'sqlite':
+        return SQLiteDataManager(data_dir)
+    return JSONDataManager(data_dir)
+
+
+def _stress_worker(backend: str, data_dir: str, worker_id: int, iterations: int):
+    """压力测试工作进程：交替执行计数器自增、整文档更新、记录写入和消息追加"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        manager = _create_manager(backend, data_dir)
+        journal = manager.create_message_journal('user_messages', iterations)
+        openid = f'worker_{worker_id}'
+
+        def increment_total(stats):
+            stats['total'] = stats.get('total', 0) + 1
+            return stats
+
+        for i in range(iterations):
+            manager.update_key('counters', 'shared', lambda value: value + 1, 0)
+            manager.update_data('statistics', increment_total, {})
+            manager.put('users', f'{openid}_{i}', {'worker': worker_id, 'index': i})
+            journal.append(openid, {'content': i})
+
+
+def stress_test(backend: str, process_count: int, iterations: int) -> bool:
+    """多进程共用同一数据目录并发写入，检查是否有更新丢失"""
+    print(f'=== 多进程压力测试（{backend} 后端，{process_count} 个进程 × {iterations} 次）===')
+    data_dir = tempfile.mkdtemp(prefix='storage_stress_')
+    try:
+        context = multiprocessing.get_context('spawn')
+        processes = [
+            context.Process(target=_stress_worker, args=(backend, data_dir, i, iterations))
+            for i in range(process_count)
+        ]
+        start = time.time()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        elapsed = time.time() - start
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            manager = _create_manager(backend, data_dir)
+            journal = manager.create_message_journal('user_messages', iterations)
+            expected = process_count * iterations
+            checks = {
+                '计数器 (update_key)': manager.get('counters', 'shared', 0),
+                '统计 (update_data)': manager.load_data('statistics', {}).get('total', 0),
+                '用户记录 (put)': len(manager.load_data('users', {})),
+                '消息 (journal)': sum(
+                    len(journal.get(f'worker_{i}', 0)) for i in range(process_count)
+                ),
+            }
+
+        passed = True
+        for name, actual in checks.items():
+            ok = actual == expected
+            passed = passed and ok
+            print(f'{"✅" if ok else "❌"} {name}: {actual} / {expected}')
+        print(f'耗时 {elapsed:.2f} 秒，{"没有" if passed else "存在"}更新丢失')
+        return passed
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='存储层性能测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    locks_parser = subparsers.add_parser('locks', help='全局锁与分文件锁的并发读吞吐对比')
+    locks_parser.add_argument('--duration', type=float, default=3.0, help='每轮测试时长（秒）')
+    locks_parser.add_argument('--readers', type=int, default=4, help='读线程数')
+
+    stress_parser = subparsers.add_parser('stress', help='多进程并发写入，验证没有更新丢失')
+    stress_parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    stress_parser.add_argument('--processes', type=int, default=4, help='进程数')
+    stress_parser.add_argument('--iterations', type=int, default=200, help='每个进程的写入次数')
+
+    codec_parser = subparsers.add_parser('codec', help='各JSON编解码器的读写耗时与文件大小对比')
+    codec_parser.add_argument('--users', type=int, default=5000, help='构造文档中的用户数')
+    codec_parser.add_argument('--repeat', type=int, default=5, help='每项测试的重复次数')
+
+    args = parser.parse_args()
+    if args.command == 'locks':
+        benchmark_locks(args.duration, args.readers)
+    elif args.command == 'stress':
+        if not stress_test(args.backend, args.processes, args.iterations):
+            raise SystemExit(1)
+    elif args.command == 'codec':
+        benchmark_codecs(args.users, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# 统计时间序列模块：按小时/天/月三种粒度保存事件计数的定长环形数组
+
+import time
+from array import array
+from typing import Dict, List, Optional
+
+# 支持的时间粒度
+HOUR = 'hour'
+DAY = 'day'
+MONTH = 'month'
+RESOLUTIONS = (HOUR, DAY, MONTH)
+
+
+def hour_bucket(timestamp: float) -> int:
+    """时间戳对应的小时序号（按本地时间划分）"""
+    return int((timestamp + time.localtime(timestamp).tm_gmtoff) // 3600)
+
+
+def _month_of_hour(hour: int) -> int:
+    """小时序号对应的月份序号（年 * 12 + 月 - 1）"""
+    local_time = time.gmtime(hour * 3600)
+    return local_time.tm_year * 12 + local_time.tm_mon - 1
+
+
+def bucket_of(resolution: str, timestamp: float) -> int:
+    """时间戳在指定粒度下的序号"""
+    hour = hour_bucket(timestamp)
+    if resolution == HOUR:
+        return hour
+    if resolution == DAY:
+        return hour // 24
+    return _month_of_hour(hour)
+
+
+def bucket_label(resolution: str, bucket: int) -> str:
+    """序号对应的可读时间标签"""
+    if resolution == HOUR:
+        return time.strftime('%Y-%m-%d %H:00', time.gmtime(bucket * 3600))
+    if resolution == DAY:
+        return time.strftime('%Y-%m-%d', time.gmtime(bucket * 86400))
+    return f'{bucket // 12:04d}-{bucket % 12 + 1:02d}'
+
+
+class RingCounter:
+    """定长环形计数数组 - 槽位 = 序号 % 长度，用序号戳区分新旧数据，计数 O(1)"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.stamps = array('q', [-1]) * size
+        self.counts = array('q', [0]) * size
+
+    def add(self, bucket: int, count: int = 1):
+        """给指定序号的计数加上 count，覆盖超出保留范围的旧数据"""
+        slot = bucket % self.size
+        if self.stamps[slot] != bucket:
+            self.stamps[slot] = bucket
+            self.counts[slot] = 0
+        self.counts[slot] += count
+
+    def get_range(self, first: int, last: int) -> List[int]:
+        """
+        获取 [first, last] 序号区间内的计数（超出保留范围的部分为0）
+
+        区间在环上最多分成两段连续切片，按切片批量比对序号戳，不逐个取模
+        """
+        if last < first:
+            return []
+        result = [0] * (last - first + 1)
+        start = max(first, last - self.size + 1)
+        offset = start - first
+        while start <= last:
+            slot = start % self.size
+            length = min(last - start + 1, self.size - slot)
+            stamps = self.stamps[slot : slot + length]
+            counts = self.counts[slot : slot + length]
+            result[offset : offset + length] = [
+                count if stamp == bucket else 0
+                for stamp, count, bucket in zip(stamps, counts, range(start, start + length))
+            ]
+            start += length
+            offset += length
+        return result
+
+    def to_dict(self) -> Dict:
+        """只序列化有数据的槽位"""
+        used = [i for i in range(self.size) if self.stamps[i] >= 0 and self.counts[i]]
+        return {
+            'stamps': [self.stamps[i] for i in used],
+            'counts': [self.counts[i] for i in used],
+        }
+
+    @classmethod
+    def from_dict(cls, size: int, data: Optional[Dict]) -> 'RingCounter':
+        """从序列化数据恢复（保留长度变化时自动重新分布槽位）"""
+        ring = cls(size)
+        if data:
+            for bucket, count in sorted(zip(data['stamps'], data['counts'])):
+                ring.add(bucket, count)
+        return ring
+
+
+class StatisticsTimeSeries:
+    """事件计数时间序列 - 每个事件类型各有小时、天、月三个环形数组，写入时同时汇总"""
+
+    def __init__(self, retention: Dict[str, int], data: Optional[Dict] = None):
+        """
+        初始化时间序列
+
+        Args:
+            retention: 各粒度保留的桶数，如 {'hour': 720, 'day': 365, 'month': 60}
+            data: to_dict() 序列化的数据
+        """
+        self.retention = retention
+        self.series: Dict[str, Dict[str, RingCounter]] = {}
+        for event_type, rings in (data or {}).items():
+            self.series[event_type] = {
+                resolution: RingCounter.from_dict(retention[resolution], rings.get(resolution))
+                for resolution in RESOLUTIONS
+            }
+
+    def _get_rings(self, event_type: str) -> Dict[str, RingCounter]:
+        rings = self.series.get(event_type)
+        if rings is None:
+            rings = self.series[event_type] = {
+                resolution: RingCounter(self.retention[resolution]) for resolution in RESOLUTIONS
+            }
+        return rings
+
+    def add(self, event_type: str, hour: int, count: int = 1):
+        """
+        按小时序号累加计数，并同时汇总到天和月
+
+        Args:
+            event_type: 事件类型
+            hour: 小时序号（hour_bucket 的返回值）
+            count: 增量
+        """
+        rings = self._get_rings(event_type)
+        rings[HOUR].add(hour, count)
+        rings[DAY].add(hour // 24, count)
+        rings[MONTH].add(_month_of_hour(hour), count)
+
+    def add_day(self, event_type: str, day: str, count: int):
+        """导入旧版按日期保存的统计（没有小时数据，只汇总到天和月）"""
+        day_start = time.mktime(time.strptime(day, '%Y-%m-%d'))
+        hour = hour_bucket(day_start)
+        rings = self._get_rings(event_type)
+        rings[DAY].add(hour // 24, count)
+        rings[MONTH].add(_month_of_hour(hour), count)
+
+    def query(
+        self, event_type: str, resolution: str, start_time: Optional[float], end_time: float
+    ) -> Dict:
+        """
+        查询时间区间内每个桶的计数
+
+        Args:
+            event_type: 事件类型
+            resolution: 时间粒度（hour/day/month）
+            start_time: 开始时间戳，为None时从保留范围的起点开始
+            end_time: 结束时间戳
+
+        区间限制在保留范围内（当前时间往前 retention 个桶到当前桶），
+        超出的部分没有数据，不为其生成标签
+
+        Returns:
+            Dict: labels 为时间标签列表，counts 为对应的计数列表，total 为区间合计
+        """
+        current = bucket_of(resolution, time.time())
+        last = min(bucket_of(resolution, end_time), current)
+        first = current - self.retention[resolution] + 1
+        if start_time is not None:
+            first = max(first, bucket_of(resolution, start_time))
+        rings = self.series.get(event_type)
+        if rings is None:
+            counts = [0] * max(last - first + 1, 0)
+        else:
+            counts = rings[resolution].get_range(first, last)
+        return {
+            'event_type': event_type,
+            'resolution': resolution,
+            'labels': [bucket_label(resolution, bucket) for bucket in range(first, last + 1)],
+            'counts': counts,
+            'total': sum(counts),
+        }
+
+    def to_dict(self) -> Dict:
+        return {
+            event_type: {resolution: ring.to_dict() for resolution, ring in rings.items()}
+            for event_type, rings in self.series.items()
+        }
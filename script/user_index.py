@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# 用户属性二级索引模块：按关注状态、VIP状态、是否首次关注和关注日期索引用户，统计和筛选时只读取相关的倒排列表
+
+import time
+from bisect import bisect_left
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# 关注时间索引键的前缀
+DAY_PREFIX = 'subscribe_day='
+
+
+class UserAttributeIndex:
+    """
+    用户属性二级索引
+
+    索引文档 user_attribute_index 的键：
+        '<属性>=<值>/<桶>'             等值索引，值为该桶中用户编号的升序列表；
+                                      属性为 status / vip_status / first_subscribe
+        'subscribe_day=<YYYY-MM-DD>'  关注时间索引，值为当天关注的 [关注时间戳, 用户编号] 升序列表
+        'subscribe_days'              所有出现过的关注日期（升序）
+        'version'                     索引格式版本，与 VERSION 不一致时重建
+    用户以驻留表（UserIdTable）分配的整数编号代替openid，等值索引按编号分桶，修改一个用户
+    只重写所在桶的列表；索引与用户信息通过同一个工作单元提交
+    """
+
+    FIELDS = ('status', 'vip_status', 'first_subscribe')
+    # 等值索引的分桶数（与用户数据分片无关，修改分片数后无需重建索引）
+    BUCKETS = 64
+    # 索引格式版本（2: 以用户编号代替openid）
+    VERSION = 2
+
+    def __init__(self, user_data_manager):
+        """
+        初始化用户属性索引
+
+        Args:
+            user_data_manager: 用户数据管理器（提供存储入口和用户遍历）
+        """
+        self.user_data_manager = user_data_manager
+        self.index_file = 'user_attribute_index'
+
+    @classmethod
+    def _bucket(cls, user_id: int) -> int:
+        return user_id % cls.BUCKETS
+
+    @classmethod
+    def _posting_key(cls, field: str, value, bucket: int) -> str:
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        return f'{field}={value}/{bucket:02x}'
+
+    @staticmethod
+    def _day(timestamp: float) -> str:
+        """时间戳所在的日期（本地时间）"""
+        return time.strftime('%Y-%m-%d', time.localtime(timestamp))
+
+    @staticmethod
+    def _subscribe_timestamp(user_info: Dict) -> Optional[int]:
+        """用户信息中的关注时间戳（微信事件的 CreateTime），缺失或格式不对时为None"""
+        try:
+            return int(float(user_info.get('subscribe_time')))
+        except (TypeError, ValueError):
+            return None
+
+    def _entries(self, user_id: int, user_info: Optional[Dict]) -> set:
+        """用户信息对应的所有索引条目 (索引键, 成员)"""
+        if not user_info:
+            return set()
+        entries = set()
+        bucket = self._bucket(user_id)
+        for field in self.FIELDS:
+            value = user_info.get(field)
+            if value is not None:
+                entries.add((self._posting_key(field, value, bucket), user_id))
+        timestamp = self._subscribe_timestamp(user_info)
+        if timestamp is not None:
+            entries.add((DAY_PREFIX + self._day(timestamp), (timestamp, user_id)))
+        return entries
+
+    @staticmethod
+    def _add_func(member):
+        """返回向有序列表插入成员的更新函数（不修改传入的列表，重复执行结果相同）"""
+        member = list(member) if isinstance(member, tuple) else member
+
+        def add(values):
+            values = list(values or ())
+            position = bisect_left(values, member)
+            if position == len(values) or values[position] != member:
+                values.insert(position, member)
+            return values
+
+        return add
+
+    @staticmethod
+    def _remove_func(user_ids: set):
+        """返回从列表中移除这些用户的更新函数；列表为空时删除该键"""
+
+        def remove(values):
+            remaining = [
+                value
+                for value in values or ()
+                if (value[1] if isinstance(value, list) else value) not in user_ids
+            ]
+            return remaining or None
+
+        return remove
+
+    def ensure_built(self) -> bool:
+        """索引文档不存在或格式版本过旧时从现有用户信息建立索引（升级后只执行一次）"""
+        if self.user_data_manager.data_manager.get(self.index_file, 'version') == self.VERSION:
+            return True
+        return self.rebuild(force=False)
+
+    def rebuild(self, force: bool = True) -> bool:
+        """
+        遍历所有用户信息重建索引
+
+        Args:
+            force: 为False时索引已建立（其他进程抢先完成）则跳过
+
+        Returns:
+            bool: 是否成功
+        """
+
+        users = dict(self.user_data_manager.iter_users())
+        user_ids = self.user_data_manager.user_ids.intern_many(users)
+
+        def build(current):
+            if current and current.get('version') == self.VERSION and not force:
+                return current
+            index: Dict[str, list] = {}
+            for openid, user_info in users.items():
+                for key, member in self._entries(user_ids[openid], user_info):
+                    index.setdefault(key, []).append(
+                        list(member) if isinstance(member, tuple) else member
+                    )
+            for values in index.values():
+                values.sort()
+            index['subscribe_days'] = sorted(
+                key[len(DAY_PREFIX) :] for key in index if key.startswith(DAY_PREFIX)
+            )
+            index['version'] = self.VERSION
+            print(f'已建立用户属性索引: {len(index)} 个索引键')
+            return index
+
+        return self.user_data_manager.data_manager.update_data(self.index_file, build, {})
+
+    def update(self, openid: str, old_info: Optional[Dict], new_info: Optional[Dict]) -> bool:
+        """
+        按用户信息的变化更新索引（通过当前工作单元写入）
+
+        Args:
+            openid: 用户的openid
+            old_info: 修改前的用户信息，新用户为None
+            new_info: 修改后的用户信息，删除用户时为None
+
+        Returns:
+            bool: 是否成功
+        """
+        user_id = self.user_data_manager.user_ids.intern(openid)
+        old_entries = self._entries(user_id, old_info)
+        new_entries = self._entries(user_id, new_info)
+        store = self.user_data_manager.store
+        success = True
+        for key, _ in old_entries - new_entries:
+            success = (
+                store.update_key(self.index_file, key, self._remove_func({user_id})) and success
+            )
+        for key, member in new_entries - old_entries:
+            success = store.update_key(self.index_file, key, self._add_func(member), []) and success
+            if key.startswith(DAY_PREFIX):
+                day = key[len(DAY_PREFIX) :]
+                store.update_key(self.index_file, 'subscribe_days', self._add_func(day), [])
+        return success
+
+    def remove_many(self, users: Dict[str, Optional[Dict]]) -> bool:
+        """
+        批量移除用户的索引条目，每个索引键只更新一次
+
+        Args:
+            users: openid -> 用户信息
+
+        Returns:
+            bool: 是否成功
+        """
+        removals: Dict[str, set] = {}
+        for openid, user_info in users.items():
+            user_id = self.user_data_manager.user_ids.get_id(openid)
+            if user_id is None:
+                continue
+            for key, _ in self._entries(user_id, user_info):
+                removals.setdefault(key, set()).add(user_id)
+        store = self.user_data_manager.store
+        success = True
+        for key, user_ids in removals.items():
+            success = (
+                store.update_key(self.index_file, key, self._remove_func(user_ids)) and success
+            )
+        return success
+
+    def iter_openids(
+        self,
+        filters: Dict[str, object],
+        subscribed_after: Optional[float] = None,
+        subscribed_before: Optional[float] = None,
+    ) -> Iterator[str]:
+        """
+        按条件逐个返回用户
+
+        有关注时间条件时按关注时间从新到旧返回（只读取时间范围内的日期列表），
+        否则按索引桶顺序返回（只读取第一个等值条件的列表，其余条件在同一个桶中检查）
+
+        Args:
+            filters: 等值条件 {属性: 值}，属性为 status / vip_status / first_subscribe
+            subscribed_after: 关注时间不早于该时间戳
+            subscribed_before: 关注时间早于该时间戳
+
+        Returns:
+            Iterator[str]: openid迭代器
+        """
+        unknown = set(filters) - set(self.FIELDS)
+        if unknown:
+            raise ValueError(f'不支持的筛选条件: {", ".join(sorted(unknown))}')
+        if not filters and subscribed_after is None and subscribed_before is None:
+            raise ValueError('至少需要一个筛选条件')
+
+        store = self.user_data_manager.store
+        get_openid = self.user_data_manager.user_ids.get_openid
+        conditions = list(filters.items())
+        postings: Dict[str, set] = {}
+
+        def matches(user_id: int, bucket: int, checks: List[Tuple[str, object]]) -> bool:
+            for field, value in checks:
+                key = self._posting_key(field, value, bucket)
+                if key not in postings:
+                    postings[key] = set(store.get(self.index_file, key) or ())
+                if user_id not in postings[key]:
+                    return False
+            return True
+
+        if subscribed_after is None and subscribed_before is None:
+            (first_field, first_value), others = conditions[0], conditions[1:]
+            for bucket in range(self.BUCKETS):
+                key = self._posting_key(first_field, first_value, bucket)
+                for user_id in store.get(self.index_file, key) or ():
+                    if matches(user_id, bucket, others):
+                        yield get_openid(user_id)
+            return
+
+        first_day = self._day(subscribed_after) if subscribed_after is not None else ''
+        last_day = self._day(subscribed_before) if subscribed_before is not None else '9999'
+        days = [
+            day
+            for day in store.get(self.index_file, 'subscribe_days') or ()
+            if first_day <= day <= last_day
+        ]
+        for day in reversed(days):
+            for timestamp, user_id in reversed(store.get(self.index_file, DAY_PREFIX + day) or ()):
+                if subscribed_after is not None and timestamp < subscribed_after:
+                    continue
+                if subscribed_before is not None and timestamp >= subscribed_before:
+                    continue
+                if matches(user_id, self._bucket(user_id), conditions):
+                    yield get_openid(user_id)
+
+    def count(
+        self,
+        filters: Dict[str, object],
+        subscribed_after: Optional[float] = None,
+        subscribed_before: Optional[float] = None,
+    ) -> int:
+        """
+        统计满足条件的用户数（只有一个等值条件时直接累加各桶列表长度）
+
+        Args:
+            filters: 等值条件 {属性: 值}
+            subscribed_after: 关注时间不早于该时间戳
+            subscribed_before: 关注时间早于该时间戳
+
+        Returns:
+            int: 用户数
+        """
+        if len(filters) == 1 and subscribed_after is None and subscribed_before is None:
+            field, value = next(iter(filters.items()))
+            if field in self.FIELDS:
+                store = self.user_data_manager.store
+                return sum(
+                    len(store.get(self.index_file, self._posting_key(field, value, bucket)) or ())
+                    for bucket in range(self.BUCKETS)
+                )
+        return sum(1 for _ in self.iter_openids(filters, subscribed_after, subscribed_before))
+
+    def list_openids(
+        self,
+        filters: Dict[str, object],
+        subscribed_after: Optional[float] = None,
+        subscribed_before: Optional[float] = None,
+        offset: int = 0,
+        limit: int = 20,
+    ) -> List[str]:
+        """
+        分页列出满足条件的用户
+
+        Args:
+            filters: 等值条件 {属性: 值}
+            subscribed_after: 关注时间不早于该时间戳
+            subscribed_before: 关注时间早于该时间戳
+            offset: 跳过的用户数
+            limit: 本页用户数
+
+        Returns:
+            List[str]: openid列表
+        """
+        matches = self.iter_openids(filters, subscribed_after, subscribed_before)
+        return list(islice(matches, offset, offset + limit))